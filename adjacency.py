@@ -0,0 +1,99 @@
+"""
+Includes the `Adjacency` class, which stores which nodes each node is joined to (the `d_joined` returned by
+`build_through_pixels_dict`)
+"""
+
+from dataclasses import dataclass, field
+
+import numpy as np
+import torch as t
+from jaxtyping import Int
+from torch import Tensor
+
+t.classes.__path__ = []
+
+
+@dataclass(eq=False)
+class Adjacency:
+    """
+    CSR adjacency: node `i` is joined to `indices[indptr[i] : indptr[i + 1]]` (sorted). This replaces the old
+    `dict[int, list[int]]`, which meant converting a Python list to a tensor / array for every line we drew. Here
+    `d_joined[i]` is a numpy view and `d_joined.neighbours(i)` a torch view (of the same memory), so neither allocates.
+
+    It still supports the dict-style access (`d_joined[i]`, `len`, `keys`, `items`, `in`) that older code uses.
+    """
+
+    indptr: Int[np.ndarray, "n_nodes_plus_1"]
+    indices: Int[np.ndarray, "n_edges"]
+    indices_torch: Int[Tensor, "n_edges"] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.indptr = np.asarray(self.indptr, dtype=np.int64)
+        self.indices = np.asarray(self.indices, dtype=np.int32)
+        self.indices_torch = t.from_numpy(self.indices)
+
+    @classmethod
+    def from_dict(cls, d_joined: dict[int, list[int]]) -> "Adjacency":
+        n_nodes = len(d_joined)
+        assert sorted(d_joined.keys()) == list(range(n_nodes)), "Expected keys 0, 1, ..., n_nodes - 1"
+        indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(d_joined[i]) for i in range(n_nodes)])
+        indices = np.fromiter((j for i in range(n_nodes) for j in d_joined[i]), dtype=np.int32, count=indptr[-1])
+        return cls(indptr, indices)
+
+    def to_dict(self) -> dict[int, list[int]]:
+        return {i: self[i].tolist() for i in range(self.n_nodes)}
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def nbytes(self) -> int:
+        return self.indptr.nbytes + self.indices.nbytes
+
+    @property
+    def degrees(self) -> Int[np.ndarray, "n_nodes"]:
+        return np.diff(self.indptr)
+
+    def __repr__(self) -> str:
+        return f"Adjacency(n_nodes={self.n_nodes}, n_edges={len(self.indices)})"
+
+    def __len__(self) -> int:
+        return self.n_nodes
+
+    def __getitem__(self, i: int) -> Int[np.ndarray, "degree"]:
+        return self.indices[self.indptr[i] : self.indptr[i + 1]]
+
+    def __contains__(self, i: int) -> bool:
+        return 0 <= i < self.n_nodes
+
+    def __iter__(self):
+        return iter(range(self.n_nodes))
+
+    def keys(self) -> range:
+        return range(self.n_nodes)
+
+    def items(self):
+        return ((i, self[i]) for i in range(self.n_nodes))
+
+    def neighbours(self, i: int) -> Int[Tensor, "degree"]:
+        """Returns the nodes joined to `i`, as a torch view (int32)."""
+        return self.indices_torch[self.indptr[i] : self.indptr[i + 1]]
+
+    def symmetrized(self) -> "Adjacency":
+        """
+        Returns the adjacency with only the edges (i, j) for which (j, i) is also an edge. Every row stays sorted, since
+        we only ever remove edges.
+        """
+        src = np.repeat(np.arange(self.n_nodes, dtype=np.int64), self.degrees)
+        dst = self.indices.astype(np.int64)
+        # Edges are sorted by (src, dst), so we can look up the reversed edges with a binary search
+        keys = src * self.n_nodes + dst
+        reversed_keys = dst * self.n_nodes + src
+        positions = np.searchsorted(keys, reversed_keys).clip(max=len(keys) - 1)
+        keep = keys[positions] == reversed_keys if len(keys) else np.zeros(0, dtype=bool)
+
+        indptr = np.zeros(self.n_nodes + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(src[keep], minlength=self.n_nodes))
+        return Adjacency(indptr, self.indices[keep])
@@ -0,0 +1,189 @@
+"""
+Benchmarks for the slow parts of the pipeline. Run e.g. `python benchmarks.py ellipse` from the repo root.
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+import torch as t
+from PIL import Image
+from rich import print as rprint
+from rich.table import Table
+
+from coordinates import build_through_pixels_dict, pair_to_index, pair_to_index_np
+from line_engines import ENGINES, NUMBA_AVAILABLE, score_lines
+from line_table import index_to_pair
+
+t.classes.__path__ = []
+
+
+def time_it(fn, *args, **kwargs):
+    t0 = time.time()
+    out = fn(*args, **kwargs)
+    return out, time.time() - t0
+
+
+def bench_ellipse_build(n_nodes_list: list[int] = [200, 400, 800], x: int = 600, step_size: float = 1.0):
+    """
+    Compares the loop & vectorized versions of the Ellipse branch of `build_through_pixels_dict`, checking that they
+    produce identical line tables.
+    """
+    table = Table("n_nodes", "loop (s)", "vectorized (s)", "speedup", "identical")
+
+    for n_nodes in n_nodes_list:
+        kwargs = dict(x=x, y=x, n_nodes=n_nodes, shape="Ellipse", critical_fracs=(0.02, 0.02), step_size=step_size)
+        (_, _, _, line_table_loop), t_loop = time_it(build_through_pixels_dict, **kwargs, vectorized=False)
+        (_, _, _, line_table_vec), t_vec = time_it(build_through_pixels_dict, **kwargs, vectorized=True)
+        is_identical = line_table_loop.equals(line_table_vec)
+        table.add_row(str(n_nodes), f"{t_loop:.2f}", f"{t_vec:.2f}", f"{t_loop / t_vec:.1f}x", str(is_identical))
+
+    rprint(table)
+
+
+def bench_rectangle_build(n_nodes_list: list[int] = [200, 400], x: int = 600, y: int = 400, step_size: float = 1.0):
+    """
+    Compares the loop & vectorized versions of the Rectangle branch of `build_through_pixels_dict` (on a non-square
+    frame), checking that they produce identical line tables.
+    """
+    table = Table("n_nodes", "loop (s)", "vectorized (s)", "speedup", "identical")
+
+    for n_nodes in n_nodes_list:
+        kwargs = dict(x=x, y=y, n_nodes=n_nodes, shape="Rectangle", critical_fracs=(0.02, 0.02), step_size=step_size)
+        (_, _, _, line_table_loop), t_loop = time_it(build_through_pixels_dict, **kwargs, vectorized=False)
+        (_, _, _, line_table_vec), t_vec = time_it(build_through_pixels_dict, **kwargs, vectorized=True)
+        is_identical = line_table_loop.equals(line_table_vec)
+        table.add_row(str(n_nodes), f"{t_loop:.2f}", f"{t_vec:.2f}", f"{t_loop / t_vec:.1f}x", str(is_identical))
+
+    rprint(table)
+
+
+def bench_rasterizer(n_nodes: int = 400, x: int = 600, step_size: float = 1.0):
+    """
+    Compares the "sampled" & "exact" rasterizers, in terms of build time and the total number of pixels in the line
+    table (which is what scoring & subtracting lines scales with).
+    """
+    table = Table("shape", "rasterizer", "build (s)", "total pixels", "mean pixels per line")
+
+    for shape in ["Ellipse", "Rectangle"]:
+        for rasterizer in ["sampled", "exact"]:
+            kwargs = dict(x=x, y=x, n_nodes=n_nodes, shape=shape, critical_fracs=(0.02, 0.02), step_size=step_size)
+            (_, _, _, line_table), t_build = time_it(build_through_pixels_dict, **kwargs, rasterizer=rasterizer)
+            lengths = line_table.lengths
+            mean_length = lengths[lengths > 0].float().mean().item()
+            table.add_row(shape, rasterizer, f"{t_build:.2f}", str(line_table.pixels.size(0)), f"{mean_length:.1f}")
+
+    rprint(table)
+
+
+def check_index_to_pair(n_nodes: int) -> None:
+    """Checks `index_to_pair` inverts `pair_to_index` for every pair (the symmetric & lazy stores decode with it)."""
+    i, j = np.triu_indices(n_nodes, 1)
+    i_decoded, j_decoded = index_to_pair(t.from_numpy(pair_to_index_np(i, j, n_nodes)), n_nodes)
+    assert (i_decoded.numpy() == i).all() and (j_decoded.numpy() == j).all(), f"index_to_pair is wrong for {n_nodes=}"
+
+
+def bench_line_store(n_nodes_list: list[int] = [400, 1000], x: int = 600, n_lookups: int = 200, n_checked: int = 2000):
+    """
+    Compares the full line table with the symmetric circle & lazy line stores, in terms of build time, memory, and the
+    time to fetch all the lines from `n_lookups` random nodes (which is what `choose_and_subtract_best_line` does). We
+    also check the lazy store gives exactly the same pixels as the full table for `n_checked` random lines, and report
+    the fraction of those lines' pixels which the symmetric store (whose lines are rotated, not sampled) gets wrong.
+    """
+    table = Table("n_nodes", "line store", "build (s)", "size (MB)", "lookups (s)", "pixels differing")
+
+    for n_nodes in n_nodes_list:
+        check_index_to_pair(n_nodes)
+        line_idx = t.randint(0, n_nodes * (n_nodes - 1) // 2, (n_checked,))
+        for line_store in ["table", "symmetric", "lazy"]:
+            kwargs = dict(x=x, y=x, n_nodes=n_nodes, shape="Ellipse", critical_fracs=(0.02, 0.02))
+            (_, d_joined, _, line_table), t_build = time_it(build_through_pixels_dict, **kwargs, line_store=line_store)
+
+            t0 = time.time()
+            for i in t.randint(0, n_nodes, (n_lookups,)).tolist():
+                line_table.get_lines(pair_to_index(i, d_joined.neighbours(i).long(), n_nodes))
+            t_lookups = time.time() - t0
+
+            if line_store == "table":
+                full_table = line_table
+                differing = ""
+            else:
+                pixels, line_ids, lengths, _ = line_table.get_lines(line_idx)
+                pixels_full, line_ids_full, lengths_full, _ = full_table.get_lines(line_idx)
+                is_identical = t.equal(lengths, lengths_full) and t.equal(pixels, pixels_full)
+                assert is_identical or line_store == "symmetric", (
+                    f"Lazy line store doesn't match the full table, {n_nodes=}"
+                )
+                # Count the pixels in one line but not the other (as multisets, since rotated lines can be reversed)
+                keys = t.cat([line_ids * x * x + pixels, line_ids_full * x * x + pixels_full])
+                _, inverse = t.unique(keys, return_inverse=True)
+                counts = t.bincount(inverse[: len(pixels)], minlength=len(keys))
+                counts_full = t.bincount(inverse[len(pixels) :], minlength=len(keys))
+                differing = f"{(counts - counts_full).abs().sum().item() / (2 * len(pixels_full)):.1%}"
+
+            size_mb = line_table.nbytes / (1024 * 1024)
+            table.add_row(str(n_nodes), line_store, f"{t_build:.2f}", f"{size_mb:.1f}", f"{t_lookups:.2f}", differing)
+
+    rprint(table)
+
+
+def bench_engines(
+    filenames: list[str] = ["butterfly.png", "black-hole.jpg"],
+    n_nodes: int = 400,
+    x: int = 600,
+    n_lines: int = 500,
+    darkness: float = 0.15,
+):
+    """
+    Compares the line engines on some of the bundled images, running a plain greedy loop (score all the lines from the
+    current node, subtract the best one, move to its other end). We check every engine draws the same lines as torch.
+    """
+    table = Table("image", "engine", "lines/s", "same lines as torch")
+    kwargs = dict(x=x, y=x, n_nodes=n_nodes, shape="Ellipse", critical_fracs=(0.02, 0.02))
+    _, d_joined, _, line_table = build_through_pixels_dict(**kwargs)
+
+    for filename in filenames:
+        image = Image.open(Path(__file__).parent / "images" / filename).convert(mode="L").resize((x, x))
+        base_image = 1 - t.tensor(image.getdata()).reshape(-1).float() / 255
+
+        lines = {}
+        for engine in [engine for engine in ENGINES if engine != "numba" or NUMBA_AVAILABLE]:
+            m_image = base_image.clone()
+            if engine == "numba":  # compile before timing
+                score_lines(engine, line_table, m_image, t.tensor([1]), darkness)
+
+            i = 0
+            lines[engine] = []
+            t0 = time.time()
+            for _ in range(n_lines):
+                j_choices = d_joined.neighbours(i)
+                scores = score_lines(engine, line_table, m_image, pair_to_index(i, j_choices, n_nodes), darkness)
+                j = j_choices[scores.argmax()].item()
+                m_image[line_table.get_line(pair_to_index(i, j, n_nodes))] -= darkness
+                lines[engine].append(j)
+                i = j
+            t_total = time.time() - t0
+
+            table.add_row(filename, engine, f"{n_lines / t_total:.0f}", str(lines[engine] == lines["torch"]))
+
+    rprint(table)
+
+
+BENCHMARKS = {
+    "ellipse": bench_ellipse_build,
+    "rectangle": bench_rectangle_build,
+    "rasterizer": bench_rasterizer,
+    "line_store": bench_line_store,
+    "engines": bench_engines,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("benchmark", choices=list(BENCHMARKS), nargs="?", default=None)
+    args = parser.parse_args()
+
+    for name, bench_fn in BENCHMARKS.items():
+        if args.benchmark in [None, name]:
+            rprint(f"[bold]{name}[/]")
+            bench_fn()
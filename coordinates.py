@@ -4,15 +4,28 @@ Includes all funcs related to coordinate placement
 
 import gc
 import random
+from collections import defaultdict
+from functools import lru_cache
+from typing import Callable, Generator, Literal
 
 import matplotlib.pyplot as plt
 import numpy as np
 import torch as t
 from IPython.display import clear_output
-from jaxtyping import Float, Int
+from jaxtyping import Bool, Float, Int
 from torch import Tensor
+from torch.nn.utils.rnn import pad_sequence
 from tqdm import tqdm
 
+from adjacency import Adjacency
+from line_table import (
+    LazyLineTable,
+    LineTable,
+    SymmetricCircleLineTable,
+    build_pixel_index,
+    index_to_pair,
+    yx_to_linear,
+)
 from misc import get_size_mb
 
 t.classes.__path__ = []
@@ -85,6 +98,287 @@ def through_pixels(p0: Float[Tensor, "2"], p1: Float[Tensor, "2"], step_size: fl
     return pixels_in_line.T
 
 
+# Batched version of `through_pixels`, yielding lines in groups of equal length (used in `build_through_pixels_dict`)
+def iter_through_pixels_batch(
+    p0: Float[Tensor, "batch 2"],
+    p1: Float[Tensor, "batch 2"],
+    step_size: float = 1.0,
+    memory_budget_mb: float = 256.0,
+) -> Generator[tuple[Int[Tensor, "chunk"], Float[Tensor, "chunk 2 n_steps"]], None, None]:
+    """
+    Yields `(batch_idx, pixels)` where `pixels[k]` is bitwise identical to `through_pixels(p0[batch_idx[k]],
+    p1[batch_idx[k]], step_size)`. We group the lines by their number of steps, so every line in a group is computed
+    from exactly the `t.linspace` that `through_pixels` would have used. Each group is yielded in chunks of at most
+    `memory_budget_mb`.
+    """
+    δ = p1 - p0
+    distance = t.sqrt((δ**2).sum(-1))
+    assert (distance > 0).all(), "Error: some pairs of points have distance zero."
+    num_steps = (distance / step_size).to(t.int64) + 1
+
+    for n_steps in num_steps.unique().tolist():
+        linspace = t.linspace(0, 1, n_steps, dtype=t.float32, device=p0.device)
+        chunk_size = max(1, int(memory_budget_mb * 2**20 / (n_steps * 2 * p0.element_size() * 3)))
+        for batch_idx in (num_steps == n_steps).nonzero().squeeze(-1).split(chunk_size):
+            yield batch_idx, p0[batch_idx, :, None] + linspace * δ[batch_idx, :, None]
+
+
+# `t.linspace(0, 1, n_steps)`, cached because `through_pixels_batch` can get batches with lots of different lengths
+@lru_cache(maxsize=4096)
+def unit_linspace(n_steps: int) -> Float[Tensor, "n_steps"]:
+    return t.linspace(0, 1, n_steps, dtype=t.float32)
+
+
+# Batched version of `truncate_pixels(through_pixels(...).to(t.int16), limits)` (used in `build_through_pixels_dict`)
+def through_pixels_batch(
+    p0: Float[Tensor, "batch 2"],
+    p1: Float[Tensor, "batch 2"],
+    limits: list[int],
+    n_pixels: int,
+    step_size: float = 1.0,
+    memory_budget_mb: float = 256.0,
+) -> tuple[Int[Tensor, "batch 2 n_pixels"], Int[Tensor, "batch"]]:
+    """
+    Returns the truncated int16 pixels of the lines p0[k] -> p1[k], zero-padded to `n_pixels`, along with their lengths.
+    This is bitwise identical to calling `through_pixels` & `truncate_pixels` one line at a time.
+
+    Unlike `iter_through_pixels_batch`, we don't group the lines by length (the ellipse builder calls this with small
+    batches where most lines have different lengths, so that would be one group per line). Instead each line gets its
+    own zero-padded `t.linspace`, and we mask out the padding along with the pixels outside `limits`. It's the same
+    float32 ops on the same values, so the pixels are identical.
+    """
+    pixels = t.zeros((p0.size(0), 2, n_pixels), dtype=t.int16)
+    lengths = t.zeros(p0.size(0), dtype=t.int64)
+
+    δ = p1 - p0
+    distance = t.sqrt((δ**2).sum(-1))
+    assert (distance > 0).all(), "Error: some pairs of points have distance zero."
+    num_steps = (distance / step_size).to(t.int64) + 1
+    assert num_steps.max() <= n_pixels, f"Error: lines have {num_steps.max()} pixels, {n_pixels=}"
+
+    chunk_size = max(1, int(memory_budget_mb * 2**20 / (n_pixels * 2 * p0.element_size() * 3)))
+    for batch_idx in t.arange(p0.size(0)).split(chunk_size):
+        steps, inverse = num_steps[batch_idx].unique(return_inverse=True)
+        linspaces = pad_sequence([unit_linspace(n_steps) for n_steps in steps.tolist()], batch_first=True)
+        pixels_in_lines = p0[batch_idx, :, None] + linspaces[inverse, None] * δ[batch_idx, :, None]
+        pixels_in_lines = pixels_in_lines.to(t.int16)
+        mask = (pixels_in_lines[:, 0] >= 0) & (pixels_in_lines[:, 0] <= limits[0])
+        mask &= (pixels_in_lines[:, 1] >= 0) & (pixels_in_lines[:, 1] <= limits[1])
+        mask &= t.arange(linspaces.size(-1)) < num_steps[batch_idx, None]
+        pixels[batch_idx, :, : linspaces.size(-1)], lengths[batch_idx] = compact_rows(pixels_in_lines, mask)
+
+    return pixels, lengths
+
+
+# Batched version of `truncate_pixels`, which moves the pixels that survive truncation to the start of each row
+def compact_pixels(
+    pixels: Int[Tensor, "batch 2 n_pixels"], limits: list[int]
+) -> tuple[Int[Tensor, "batch 2 n_pixels"], Int[Tensor, "batch"]]:
+    """
+    Applies the same bounds check as `truncate_pixels` to every row of `pixels`, and returns the surviving pixels (in
+    their original order, zero-padded at the end) along with how many survived in each row.
+    """
+    mask = (pixels[:, 0] >= 0) & (pixels[:, 0] <= limits[0]) & (pixels[:, 1] >= 0) & (pixels[:, 1] <= limits[1])
+    return compact_rows(pixels, mask)
+
+
+# Moves the elements of each row where `mask` is True to the start of that row (used by `compact_pixels`)
+def compact_rows(values: Tensor, mask: Bool[Tensor, "batch n"]) -> tuple[Tensor, Int[Tensor, "batch"]]:
+    """
+    `values` has shape (batch, ..., n), and we keep the elements `values[b, ..., k]` for which `mask[b, k]` is True.
+    Returns the compacted values (zero-padded at the end) along with how many elements were kept in each row.
+    """
+    lengths = mask.sum(-1)
+    if mask.all():
+        return values, lengths
+
+    # Kept elements move to their rank among the kept elements of the row, dropped ones to a spare last column
+    n = mask.size(-1)
+    dest_idx = t.where(mask, mask.cumsum(-1) - 1, n)
+    dest_idx = dest_idx.view(mask.size(0), *[1] * (values.dim() - 2), n).expand_as(values)
+    values_compacted = t.zeros((*values.shape[:-1], n + 1), dtype=values.dtype)
+    values_compacted.scatter_(-1, dest_idx, values)
+
+    return values_compacted[..., :n], lengths
+
+
+# Exact alternative to `iter_through_pixels_batch`, where each pixel the line crosses is yielded exactly once
+def iter_exact_pixels_batch(
+    p0: Float[Tensor, "batch 2"],
+    p1: Float[Tensor, "batch 2"],
+    memory_budget_mb: float = 256.0,
+) -> Generator[tuple[Int[Tensor, "chunk"], Int[Tensor, "chunk 2 n_pixels"]], None, None]:
+    """
+    Yields `(batch_idx, pixels)` where `pixels[k]` is the DDA / Bresenham rasterization of the line p0[batch_idx[k]]
+    -> p1[batch_idx[k]]: we take the pixels containing the 2 endpoints (truncating, like `.to(t.int16)` does in the
+    sampled version), and then step 1 pixel at a time along the major axis, rounding the minor axis. So unlike
+    `through_pixels` (which samples every `step_size` and rounds, hitting most pixels several times) no pixel is
+    repeated, and the number of pixels doesn't depend on `step_size`.
+
+    Everything is done in integer arithmetic, so the result doesn't depend on float precision. Lines are grouped by
+    their number of pixels like in `iter_through_pixels_batch`.
+    """
+    c0, c1 = p0.to(t.int64), p1.to(t.int64)
+    δ = c1 - c0  # [batch 2]
+    n_pixels = δ.abs().amax(-1) + 1  # [batch]
+
+    for n in n_pixels.unique().tolist():
+        # For pixel k, the coordinate along each axis is c0 + round(k * δ / m) = c0 + floor((2kδ + m) / 2m). For the
+        # major axis this is exactly c0 ± k.
+        m = max(n - 1, 1)
+        k = t.arange(n)
+        chunk_size = max(1, int(memory_budget_mb * 2**20 / (n * 2 * 8 * 3)))
+        for batch_idx in (n_pixels == n).nonzero().squeeze(-1).split(chunk_size):
+            numerator = 2 * k * δ[batch_idx, :, None] + m  # [chunk 2 n]
+            yield batch_idx, (c0[batch_idx, :, None] + t.div(numerator, 2 * m, rounding_mode="floor")).to(t.int16)
+
+
+# Anti-aliased version of `iter_exact_pixels_batch`, which also yields how much of each pixel the line covers
+def iter_wu_pixels_batch(
+    p0: Float[Tensor, "batch 2"],
+    p1: Float[Tensor, "batch 2"],
+    memory_budget_mb: float = 256.0,
+) -> Generator[
+    tuple[Int[Tensor, "chunk"], Int[Tensor, "chunk 2 n_pixels"], Float[Tensor, "chunk n_pixels"]], None, None
+]:
+    """
+    Yields `(batch_idx, pixels, weights)` using Xiaolin Wu's algorithm: we step 1 pixel at a time along the major axis
+    (over the same pixels as `iter_exact_pixels_batch`), and at each step the line sits somewhere between 2 pixel
+    centres on the minor axis, so we yield both of them, weighted by how close the line is to each (the 2 weights sum
+    to 1). This means lines are rendered with sub-pixel accuracy, which matters most at low resolution.
+
+    We skip Wu's special handling of the endpoints, since ours are always hooks on the edge of the frame.
+    """
+    c0, c1 = p0.to(t.int64), p1.to(t.int64)
+    δc = c1 - c0  # [batch 2]
+    n_pixels = δc.abs().amax(-1) + 1  # [batch]
+    is_x_major = δc[:, 1].abs() > δc[:, 0].abs()  # [batch]
+
+    for n in n_pixels.unique().tolist():
+        k = t.arange(n)
+        chunk_size = max(1, int(memory_budget_mb * 2**20 / (n * 2 * 2 * 8 * 4)))
+        for batch_idx in (n_pixels == n).nonzero().squeeze(-1).split(chunk_size):
+            # Rearrange so that the major axis comes first in every line
+            swap = is_x_major[batch_idx, None]
+            q0, q1 = [t.where(swap, p[batch_idx].flip(-1), p[batch_idx]).double() for p in [p0, p1]]
+            major0, major1 = q0[:, 0].to(t.int64), q1[:, 0].to(t.int64)
+            major = major0[:, None] + (major1 - major0).sign()[:, None] * k  # [chunk n]
+
+            # Find where the line is on the minor axis at the centre of each pixel on the major axis
+            span = q1[:, 0] - q0[:, 0]
+            frac_along = (major + 0.5 - q0[:, :1]) / t.where(span == 0, 1.0, span)[:, None]
+            frac_along = t.where(span[:, None] == 0, 0.0, frac_along).clamp(0.0, 1.0)
+            minor = q0[:, 1:] + frac_along * (q1[:, 1:] - q0[:, 1:]) - 0.5  # relative to pixel centres
+            minor_lo = minor.floor()
+            weight_hi = minor - minor_lo
+
+            # Interleave the 2 pixels at each step, and put the axes back in (y, x) order
+            major = major.repeat_interleave(2, dim=-1)  # [chunk 2n]
+            minor = t.stack([minor_lo, minor_lo + 1], dim=-1).flatten(1).to(t.int64)  # [chunk 2n]
+            weights = t.stack([1 - weight_hi, weight_hi], dim=-1).flatten(1).float()  # [chunk 2n]
+            pixels = t.stack([major, minor], dim=1)  # [chunk 2 2n]
+            pixels = t.where(swap[:, :, None], pixels.flip(1), pixels)
+            yield batch_idx, pixels.to(t.int16), weights
+
+
+def build_exact_line_table(
+    coords: Float[Tensor, "n_nodes 2"],
+    d_joined: dict[int, list[int]],
+    limits: list[int],
+    width: int,
+    memory_budget_mb: float = 256.0,
+    rasterizer: Literal["exact", "wu"] = "exact",
+) -> LineTable:
+    """
+    Builds the line table for any shape using `iter_exact_pixels_batch`, i.e. every line between 2 joined nodes
+    contains each pixel it crosses exactly once. This is what `rasterizer="exact"` uses in `build_through_pixels_dict`.
+
+    If `rasterizer="wu"` then we use `iter_wu_pixels_batch` instead, and also store the coverage weight of each pixel
+    in the line table.
+    """
+    n_nodes = coords.size(0)
+    pairs = np.array(sorted({(min(i, j), max(i, j)) for i, j_list in d_joined.items() for j in j_list}), dtype=np.int64)
+    pairs = pairs.reshape(-1, 2)
+    rows = t.from_numpy(pair_to_index_np(pairs[:, 0], pairs[:, 1], n_nodes))
+    p0, p1 = coords[t.from_numpy(pairs[:, 0])], coords[t.from_numpy(pairs[:, 1])]
+
+    progress_bar = tqdm(desc="Building pixels dict", total=len(pairs))
+    line_table = rasterize_lines(
+        p0, p1, rows, n_nodes * (n_nodes - 1) // 2, limits, width, rasterizer, 1.0, memory_budget_mb, progress_bar
+    )
+    progress_bar.close()
+
+    return line_table
+
+
+def build_lazy_line_table(
+    coords: Float[Tensor, "n_nodes 2"],
+    limits: list[int],
+    width: int,
+    rasterizer: Literal["sampled", "exact", "wu"] = "sampled",
+    step_size: float = 1.0,
+    max_cache_mb: float = 512.0,
+    memory_budget_mb: float = 256.0,
+) -> LazyLineTable:
+    """
+    Returns a `LazyLineTable`, which rasterizes each line directly from the node coordinates the first time it's used.
+    For the "exact" & "wu" rasterizers this gives the same pixels as the full table. For "sampled" it doesn't (the
+    Ellipse builder reflects some lines rather than sampling them, and the Rectangle builder translates them), so we use
+    `ellipse_line_builder` & `rectangle_line_builder` instead.
+    """
+    n_nodes = coords.size(0)
+
+    def build_lines(line_idx: Int[Tensor, "batch"]) -> LineTable:
+        i, j = index_to_pair(line_idx, n_nodes)
+        rows = t.arange(len(line_idx))
+        return rasterize_lines(
+            coords[i], coords[j], rows, len(line_idx), limits, width, rasterizer, step_size, memory_budget_mb
+        )
+
+    return LazyLineTable(build_lines, n_lines=n_nodes * (n_nodes - 1) // 2, width=width, max_cache_mb=max_cache_mb)
+
+
+def rasterize_lines(
+    p0: Float[Tensor, "batch 2"],
+    p1: Float[Tensor, "batch 2"],
+    rows: Int[Tensor, "batch"],
+    n_lines: int,
+    limits: list[int],
+    width: int,
+    rasterizer: Literal["sampled", "exact", "wu"],
+    step_size: float = 1.0,
+    memory_budget_mb: float = 256.0,
+    progress_bar: tqdm | None = None,
+) -> LineTable:
+    """
+    Rasterizes the lines p0[k] -> p1[k] (dropping pixels outside `limits`), and returns a LineTable with `n_lines` rows
+    where the k-th line is stored in row `rows[k]`. Used by the line stores which don't have a shape-specific builder.
+    """
+    if rasterizer == "wu":
+        batches = iter_wu_pixels_batch(p0, p1, memory_budget_mb)
+    elif rasterizer == "exact":
+        batches = ((batch_idx, pixels, None) for batch_idx, pixels in iter_exact_pixels_batch(p0, p1, memory_budget_mb))
+    else:
+        batches = (
+            (batch_idx, points.to(t.int16), None)
+            for batch_idx, points in iter_through_pixels_batch(p0, p1, step_size, memory_budget_mb)
+        )
+
+    chunks = []
+    weight_chunks = [] if rasterizer == "wu" else None
+    for batch_idx, pixels, weights in batches:
+        mask = (pixels[:, 0] >= 0) & (pixels[:, 0] <= limits[0]) & (pixels[:, 1] >= 0) & (pixels[:, 1] <= limits[1])
+        if weights is not None:
+            mask &= weights > 0
+            weight_chunks.append(weights.masked_select(mask))
+        linear = yx_to_linear(pixels.transpose(0, 1), width)
+        chunks.append((rows[batch_idx], mask.sum(-1), linear.masked_select(mask)))
+        if progress_bar is not None:
+            progress_bar.update(len(batch_idx))
+
+    return LineTable.from_ragged_chunks(n_lines, chunks, width=width, weight_chunks=weight_chunks)
+
+
 def get_thick_line(p0, p1, all_coords, thickness=1):
     p0y, p0x = p0
     p1y, p1x = p1
@@ -140,6 +434,12 @@ def pair_to_index(
     return (n - 1) * i - i * (i + 1) // 2 + j - 1
 
 
+# Same as `pair_to_index`, but for numpy arrays of `i` and `j` (used when we build the whole pixel tensor at once)
+def pair_to_index_np(i: np.ndarray, j: np.ndarray, n: int) -> np.ndarray:
+    i, j = np.minimum(i, j).astype(np.int64), np.maximum(i, j).astype(np.int64)
+    return (n - 1) * i - i * (i + 1) // 2 + j - 1
+
+
 # pairs = [(0, 1), (0, 2), (1, 2)]
 # n = 3
 
@@ -150,6 +450,538 @@ def pair_to_index(
 # ================================================================
 
 
+def fill_rectangle_pixels_loop(
+    t_pixels: Tensor,
+    d_coords: dict[int, Float[Tensor, "2"]],
+    d_joined: dict[int, list[int]],
+    d_sides: dict[int, int],
+    d_archetypes: dict[str, Tensor],
+    nx: int,
+    ny: int,
+    x: int,
+    y: int,
+    step_size: float,
+) -> Int[Tensor, "n_lines"]:
+    """
+    Fills `t_pixels` for the Rectangle shape, one pair of nodes at a time (cloning and transforming "archetype" lines,
+    which get stored in `d_archetypes`), and returns the length of each line. This is the original (slow) version of
+    `build_rectangle_line_table`, which we only keep around as a reference. Note `x` and `y` are the max pixel
+    coordinates here.
+    """
+    lengths = t.zeros(t_pixels.size(0), dtype=t.int64)
+    nodes_per_side_list = [ny, nx, ny, nx]
+    starting_idx_list = np.cumsum([0] + nodes_per_side_list).tolist()
+    n0, n1, n2, n3, n4 = starting_idx_list
+    n_nodes = n4
+    xd = x / nx
+    yd = y / ny
+
+    progress_bar = tqdm(
+        desc="Building pixels dict",
+        # total=sum([len(d_joined[i]) for i in d_joined]) // 2,
+        total=len(d_joined),
+    )
+
+    # Build archetypes only when needed and store them in a dictionary
+    def get_archetype(key_type, a, b=None):
+        key = f"{key_type}_{a}" if b is None else f"{key_type}_{a}_{b}"
+        if key not in d_archetypes:
+            if key_type == "vertical":
+                i, j = n2, (n3 + a) % n4
+            elif key_type == "horizontal":
+                i, j = n1, n2 + a
+            elif key_type == "diagonal":
+                if nx >= ny:
+                    i, j = n2 + a, n2 - b
+                else:
+                    i, j = n2 - a, n2 + b
+            d_archetypes[key] = through_pixels(d_coords[i], d_coords[j], step_size=step_size)
+        return d_archetypes[key].clone()
+
+    for idx, i in enumerate(d_joined):
+        for j in d_joined[i]:
+            if i >= j:
+                continue
+
+            # === first, check if they're opposite vertical, if so then populate using the archetypes ===
+            if (d_sides[i], d_sides[j]) == (1, 3):
+                # this makes sure the node with vertex 0 is seen as being on side 3, not side 0
+                if i == 0:
+                    i_, j_ = j, n4
+                else:
+                    i_, j_ = i, j
+                δ = (i_ + j_) - (2 * n2 + ny)
+                pixels = get_archetype("vertical", abs(δ))
+                if δ < 0:
+                    pixels[1] = -pixels[1]
+                pixels[1] += (n2 - i_) * xd
+                pixels_truncated = truncate_pixels(pixels.to(t.int16), [y, x])
+                t_pixels[pair_to_index(i, j, n_nodes), :, : pixels_truncated.size(1)] = pixels_truncated
+                lengths[pair_to_index(i, j, n_nodes)] = pixels_truncated.size(1)
+
+            # === then, check if they're opposite horizontal, if so then populate using the archetypes ===
+            elif (d_sides[i], d_sides[j]) == (0, 2):
+                δ = (i + j) - (2 * n1 + nx)
+                pixels = get_archetype("horizontal", abs(δ))
+                if δ < 0:
+                    pixels[0] = -pixels[0]
+                pixels[0] += (n1 - i) * yd
+                pixels_truncated = truncate_pixels(pixels.to(t.int16), [y, x])
+                t_pixels[pair_to_index(i, j, n_nodes), :, : pixels_truncated.size(1)] = pixels_truncated
+                lengths[pair_to_index(i, j, n_nodes)] = pixels_truncated.size(1)
+
+            # === finally, the diagonal case ===
+            else:
+                i_side = d_sides[i]
+                j_side = d_sides[j]
+
+                x_side = i_side if (i_side % 2 == 1) else j_side
+                y_side = i_side if (i_side % 2 == 0) else j_side
+
+                if i_side == 0 and j_side == 3:
+                    i_, j_ = j, i
+                    i_side, j_side = 3, 0
+                else:
+                    i_, j_ = i, j
+
+                i_len = starting_idx_list[i_side + 1] - i_
+                j_len = j_ - starting_idx_list[j_side]
+
+                x_len = i_len if (i_side % 2 == 1) else j_len
+                y_len = i_len if (i_side % 2 == 0) else j_len
+
+                adj = min(i_len, j_len)
+                opp = max(i_len, j_len)
+
+                pixels = get_archetype("diagonal", adj, opp)
+
+                # flip in x = y
+                if ((x_len > y_len) != (x > y)) and (x_len != y_len):
+                    pixels = pixels.flip(0)
+                # flip in x
+                if x_side == 3:
+                    pixels[0] = y - pixels[0]
+                # flip in y
+                if y_side == 0:
+                    pixels[1] = x - pixels[1]
+
+                pixels_truncated = truncate_pixels(pixels.to(t.int16), [y, x])
+                t_pixels[pair_to_index(i, j, n_nodes), :, : pixels_truncated.size(1)] = pixels_truncated
+                lengths[pair_to_index(i, j, n_nodes)] = pixels_truncated.size(1)
+
+        progress_bar.update(1)
+
+    # progress_bar.n = sum([len(d_joined[i]) for i in d_joined]) // 2
+    progress_bar.n = len(d_joined)
+
+    return lengths
+
+
+def build_rectangle_line_table(
+    d_coords: dict[int, Float[Tensor, "2"]],
+    d_joined: dict[int, list[int]],
+    d_sides: dict[int, int],
+    nx: int,
+    ny: int,
+    x: int,
+    y: int,
+    step_size: float,
+    memory_budget_mb: float = 256.0,
+    show_progress: bool = True,
+) -> LineTable:
+    """
+    Builds the line table for the Rectangle shape with batched tensor ops, giving exactly the same pixels as
+    `fill_rectangle_pixels_loop`. Note `x` and `y` are the max pixel coordinates here.
+
+    Every line is a flipped / reflected / translated copy of an "archetype" line between 2 specific nodes. Rather than
+    cloning the archetypes one pair at a time, we work out each pair's archetype endpoints and transformation as arrays,
+    then compute all the lines at once (grouped by length) and apply the transformations with broadcasting. These are
+    float32 ops which give bitwise the same results as the loop's (see the comments below), so the pixels are identical.
+    The surviving pixels of each chunk are flattened straight into linear indices, and laid out into the table in one
+    go by `LineTable.from_ragged_chunks`.
+    """
+    n0, n1, n2, n3, n4 = np.cumsum([0, ny, nx, ny, nx]).tolist()
+    starting_idx = np.array([n0, n1, n2, n3, n4])
+    xd = x / nx
+    yd = y / ny
+
+    coords = t.stack([d_coords[k] for k in range(n4)])
+    sides = np.array([d_sides[k] for k in range(n4)])
+
+    # Get every pair (i, j) with i < j which the loop would fill in
+    i = np.repeat(np.arange(n4), [len(d_joined[k]) for k in range(n4)])
+    j = np.concatenate([np.asarray(d_joined[k], dtype=np.int64) for k in range(n4)])
+    i, j = i[i < j], j[i < j]
+    side_i, side_j = sides[i], sides[j]
+    n_pairs = len(i)
+
+    # Each line is computed as: archetype (arch_0 -> arch_1), maybe flipped in x = y, then multiplied by `sign` & added
+    # to `offset` (elementwise over the yx dimension), then maybe reflected (y -> y_max - y and/or x -> x_max - x).
+    arch_0 = np.zeros(n_pairs, dtype=np.int64)
+    arch_1 = np.zeros(n_pairs, dtype=np.int64)
+    flip_xy = np.zeros(n_pairs, dtype=bool)
+    sign = np.ones((n_pairs, 2), dtype=np.float32)
+    offset = np.zeros((n_pairs, 2), dtype=np.float64)
+    reflect = np.zeros((n_pairs, 2), dtype=bool)
+
+    # Opposite vertical sides (this makes sure the node with vertex 0 is seen as being on side 3, not side 0)
+    is_vertical = (side_i == 1) & (side_j == 3)
+    i_ = np.where(i == 0, j, i)
+    j_ = np.where(i == 0, n4, j)
+    δ = (i_ + j_) - (2 * n2 + ny)
+    arch_0[is_vertical] = n2
+    arch_1[is_vertical] = (n3 + np.abs(δ[is_vertical])) % n4
+    sign[is_vertical & (δ < 0), 1] = -1.0
+    offset[is_vertical, 1] = (n2 - i_[is_vertical]) * xd
+
+    # Opposite horizontal sides
+    is_horizontal = (side_i == 0) & (side_j == 2)
+    δ = (i + j) - (2 * n1 + nx)
+    arch_0[is_horizontal] = n1
+    arch_1[is_horizontal] = n2 + np.abs(δ[is_horizontal])
+    sign[is_horizontal & (δ < 0), 0] = -1.0
+    offset[is_horizontal, 0] = (n1 - i[is_horizontal]) * yd
+
+    # Adjacent sides (the diagonal case)
+    is_diagonal = ~(is_vertical | is_horizontal)
+    x_side = np.where(side_i % 2 == 1, side_i, side_j)
+    y_side = np.where(side_i % 2 == 0, side_i, side_j)
+    is_swapped = (side_i == 0) & (side_j == 3)
+    i_, j_ = np.where(is_swapped, j, i), np.where(is_swapped, i, j)
+    i_side, j_side = np.where(is_swapped, 3, side_i), np.where(is_swapped, 0, side_j)
+    i_len = starting_idx[i_side + 1] - i_
+    j_len = j_ - starting_idx[j_side]
+    x_len = np.where(i_side % 2 == 1, i_len, j_len)
+    y_len = np.where(i_side % 2 == 0, i_len, j_len)
+    adj = np.minimum(i_len, j_len)
+    opp = np.maximum(i_len, j_len)
+    arch_0[is_diagonal] = (n2 + adj if nx >= ny else n2 - adj)[is_diagonal]
+    arch_1[is_diagonal] = (n2 - opp if nx >= ny else n2 + opp)[is_diagonal]
+    flip_xy[is_diagonal] = (((x_len > y_len) != (x > y)) & (x_len != y_len))[is_diagonal]
+    reflect[is_diagonal, 0] = (x_side == 3)[is_diagonal]
+    reflect[is_diagonal, 1] = (y_side == 0)[is_diagonal]
+
+    assert ((0 <= arch_0) & (arch_0 < n4) & (0 <= arch_1) & (arch_1 < n4)).all(), "Error: archetype out of range"
+
+    rows = t.from_numpy(pair_to_index_np(i, j, n4))
+    flip_xy, reflect = t.from_numpy(flip_xy), t.from_numpy(reflect)
+    sign, offset = t.from_numpy(sign).to(coords.dtype), t.from_numpy(offset).to(coords.dtype)
+    yx_max = t.tensor([y, x], dtype=coords.dtype)
+
+    # The y & x coords of a line are computed independently (and the line length is symmetric in them), so flipping the
+    # archetype's endpoints gives exactly the flipped pixels
+    p0, p1 = coords[t.from_numpy(arch_0)], coords[t.from_numpy(arch_1)]
+    p0 = t.where(flip_xy[:, None], p0.flip(-1), p0)
+    p1 = t.where(flip_xy[:, None], p1.flip(-1), p1)
+
+    # Reflecting `pixels * sign + offset` gives `yx_max - (pixels * sign + offset)`. Negating is exact in floating
+    # point, so this is bitwise equal to `(pixels * -sign + -offset) + yx_max`, which saves us a `t.where` per chunk.
+    # For the same reason `t.addcmul` gives the same result as multiplying by `sign` then adding `offset`.
+    sign = t.where(reflect, -sign, sign)
+    offset = t.where(reflect, -offset, offset)
+    reflect_offset = t.where(reflect, yx_max, 0.0)
+
+    chunks = []
+    progress_bar = tqdm(desc="Building pixels dict", total=n_pairs, disable=not show_progress)
+    for batch_idx, pixels in iter_through_pixels_batch(p0, p1, step_size, memory_budget_mb):
+        pixels = t.addcmul(offset[batch_idx, :, None], pixels, sign[batch_idx, :, None])
+        pixels = (pixels + reflect_offset[batch_idx, :, None]).to(t.int16)
+        mask = (pixels[:, 0] >= 0) & (pixels[:, 0] <= y) & (pixels[:, 1] >= 0) & (pixels[:, 1] <= x)
+        linear = yx_to_linear(pixels.transpose(0, 1), x + 1)
+        chunks.append((rows[batch_idx], mask.sum(-1), linear.masked_select(mask)))
+        progress_bar.update(len(batch_idx))
+    progress_bar.close()
+
+    return LineTable.from_ragged_chunks(n4 * (n4 - 1) // 2, chunks, width=x + 1)
+
+
+def fill_ellipse_pixels_loop(
+    t_pixels: Tensor,
+    d_coords: dict[int, Float[Tensor, "2"]],
+    d_joined: dict[int, list[int]],
+    x: int,
+    y: int,
+    n_nodes: int,
+    step_size: float,
+) -> Int[Tensor, "n_lines"]:
+    """
+    Fills `t_pixels` for the Ellipse shape one pair of nodes at a time, and returns the length of each line. This is the
+    original (slow) version of `build_ellipse_line_table`, which we only keep around as a reference.
+    """
+    lengths = t.zeros(t_pixels.size(0), dtype=t.int64)
+    # The second half are added via symmetry
+    # total = sum([len(d_joined[i]) for i in d_joined]) // 4
+    total = len(d_joined)
+    progress_bar = tqdm(desc="Building pixels dict", total=total)
+
+    for i1 in d_joined:
+        p1 = d_coords[i1]
+        for i0 in d_joined[i1]:
+            # # Avoid double counting: only consider (i0, i1) for i0 < i1
+            # if i0 > i1:
+            #     break
+
+            # # Check if the reflection of this line is already in the dict
+            idx = pair_to_index(i0, i1, n_nodes)
+            reflection_idx = pair_to_index(n_nodes - i1, n_nodes - i0, n_nodes)
+            if t_pixels[reflection_idx].max() > 0:
+                y_reflected, x_reflected = t_pixels[reflection_idx]
+                pixels = t.stack([(y - y_reflected).flip(0), x_reflected.flip(0)])
+
+            # If reflection isn't in the dict, we need to create it
+            else:
+                p0 = d_coords[i0]
+                pixels = through_pixels(p0, p1, step_size=step_size)
+
+            pixels_truncated = truncate_pixels(pixels.to(t.int16), [y - 1, x - 1])
+            t_pixels[idx, :, : pixels_truncated.size(1)] = pixels_truncated
+            lengths[idx] = max(lengths[idx], pixels_truncated.size(1))  # we only overwrite the start of the row
+
+        progress_bar.update(1)
+
+    return lengths
+
+
+def build_ellipse_line_table(
+    coords: Float[Tensor, "n_nodes 2"],
+    d_joined: dict[int, list[int]],
+    x: int,
+    y: int,
+    step_size: float,
+    n_pixels: int,
+    memory_budget_mb: float = 256.0,
+    show_progress: bool = True,
+) -> LineTable:
+    """
+    Builds the line table for the Ellipse shape with batched tensor ops, giving exactly the same pixels as
+    `fill_ellipse_pixels_loop` (see `ellipse_write_replayer` for how).
+    """
+    n_nodes = coords.size(0)
+    replay_rows = ellipse_write_replayer(coords, d_joined, x, y, step_size, n_pixels, memory_budget_mb)
+
+    progress_bar = tqdm(desc="Building pixels dict", total=sum(map(len, d_joined.values())), disable=not show_progress)
+    chunks = replay_rows(None, progress_bar)
+    progress_bar.close()
+
+    return LineTable.from_chunks(n_nodes * (n_nodes - 1) // 2, chunks, width=x)
+
+
+# Concatenates `np.arange(starts[k], ends[k])` for every k (used by `ellipse_write_replayer`)
+def concat_ranges(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    lengths = ends - starts
+    return np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+
+
+def ellipse_write_replayer(
+    coords: Float[Tensor, "n_nodes 2"],
+    d_joined: dict[int, list[int]],
+    x: int,
+    y: int,
+    step_size: float,
+    n_pixels: int,
+    memory_budget_mb: float = 256.0,
+) -> Callable[[np.ndarray | None, tqdm | None], list[tuple[Tensor, Tensor, Tensor]]]:
+    """
+    Returns a function `replay_rows(line_idx, progress_bar)`, which replays the writes `fill_ellipse_pixels_loop` does
+    to get the rows `line_idx` (or every row, if it's None), and returns them as `(line_idx, lengths, pixels)` chunks
+    for `LineTable.from_chunks`. The chunks can contain extra rows, which were needed along the way.
+
+    The loop visits each (i1, i0) in `d_joined` in order, and writes either the line i0 -> i1, or (if the row of the
+    reflected pair (n - i1, n - i0) is already nonzero) the reflection of that row. Note each write only overwrites the
+    first `len(pixels)` elements of the row. Since a pair and its reflection only ever read & write each other's rows,
+    we group the writes into "orbits" {pair, reflected pair} of at most 4 writes each, and replay the k-th write of
+    every orbit in a chunk at once (so we only ever need the padded rows of one chunk of orbits in memory). The
+    exception is pairs containing node 0, whose reflection index points at an unrelated row; these never get read by
+    anything else, so we replay them at the end using snapshots of the rows they read.
+
+    Everything which only depends on `d_joined` (the order of the writes, and where each orbit starts) is worked out
+    once here, so replaying the rows for a batch of lines costs O(batch * n_pixels) rather than O(n_lines).
+    """
+    n_nodes = coords.size(0)
+    n_lines = n_nodes * (n_nodes - 1) // 2
+    limits = [y - 1, x - 1]
+
+    # Get every write the loop would do, and the order it would do them in (d_joined[i1] is sorted)
+    i1 = np.repeat(np.arange(n_nodes), [len(d_joined[i]) for i in range(n_nodes)])
+    i0 = np.concatenate([np.asarray(d_joined[i], dtype=np.int64) for i in range(n_nodes)])
+    write_order = i1 * n_nodes + i0
+    rows = pair_to_index_np(i0, i1, n_nodes)
+    reflected_rows = pair_to_index_np(n_nodes - i1, n_nodes - i0, n_nodes)  # can be `n_lines` for pairs with node 0
+    has_node_0 = (i0 == 0) | (i1 == 0)
+
+    # Sort the writes which don't contain node 0 by orbit, and then by the order the loop does them. Orbit k is the
+    # writes `orbit_writes[orbit_starts[k] : orbit_starts[k + 1]]`, and `orbit_of_row` maps each row to its orbit.
+    orbit_writes = np.nonzero(~has_node_0)[0]
+    orbits = np.minimum(rows[orbit_writes], reflected_rows[orbit_writes])
+    orbit_writes = orbit_writes[np.lexsort((write_order[orbit_writes], orbits))]
+    orbits = np.minimum(rows[orbit_writes], reflected_rows[orbit_writes])
+    orbit_ranks = np.arange(len(orbit_writes)) - np.searchsorted(orbits, orbits)
+    orbit_starts = np.append(np.nonzero(orbit_ranks == 0)[0], len(orbit_writes))
+    orbit_of_row = np.full(n_lines + 1, -1, dtype=np.int64)
+    orbit_of_row[rows[orbit_writes]] = np.cumsum(orbit_ranks == 0) - 1
+
+    # Sort the writes of the pairs containing node 0 by row, and then by the order the loop does them
+    node_0_writes = np.nonzero(has_node_0)[0]
+    node_0_writes = node_0_writes[np.lexsort((write_order[node_0_writes], rows[node_0_writes]))]
+    node_0_rows = rows[node_0_writes]
+    node_0_ranks = np.arange(len(node_0_writes)) - np.searchsorted(node_0_rows, node_0_rows)
+
+    chunk_size = max(1, int(memory_budget_mb * 2**20 / (n_pixels * 2 * 8 * 4)))
+
+    def replay_rows(
+        line_idx: np.ndarray | None, progress_bar: tqdm | None = None
+    ) -> list[tuple[Tensor, Tensor, Tensor]]:
+        if line_idx is None:
+            orbit_ids = np.arange(len(orbit_starts) - 1)
+            node_0_idx = np.arange(len(node_0_writes))
+        else:
+            line_idx = np.unique(line_idx)
+            node_0_idx = concat_ranges(
+                np.searchsorted(node_0_rows, line_idx, side="left"),
+                np.searchsorted(node_0_rows, line_idx, side="right"),
+            )
+            # We need the orbits of the requested rows, and of the rows which the pairs containing node 0 read from
+            orbit_ids = np.unique(orbit_of_row[np.concatenate([line_idx, reflected_rows[node_0_writes[node_0_idx]]])])
+            orbit_ids = orbit_ids[orbit_ids >= 0]
+
+        # Rows read by the pairs containing node 0 need their history recorded, since they might be read mid-way through
+        snapshot_rows = list(set(reflected_rows[node_0_writes[node_0_idx]].tolist()))
+        snapshots = defaultdict(list)  # maps row -> list of (write_order, state of row after that write)
+
+        chunks = []
+
+        def replay_writes(
+            writes: np.ndarray,
+            states: Int[Tensor, "local_rows 2 n_pixels"],
+            lengths: Int[Tensor, "local_rows"],
+            local_rows: np.ndarray,
+            reflected_states: Int[Tensor, "batch 2 n_pixels"],
+        ) -> None:
+            p0, p1 = coords[t.from_numpy(i0[writes])], coords[t.from_numpy(i1[writes])]
+            is_reflected = reflected_states.flatten(1).amax(-1) > 0
+
+            new_pixels = t.zeros_like(reflected_states)
+            new_lengths = t.zeros(len(writes), dtype=t.int64)
+            if is_reflected.any():
+                reflected_states = reflected_states[is_reflected]
+                new_pixels[is_reflected], new_lengths[is_reflected] = compact_pixels(
+                    t.stack([(y - reflected_states[:, 0]).flip(-1), reflected_states[:, 1].flip(-1)], dim=1), limits
+                )
+            if (~is_reflected).any():
+                new_pixels[~is_reflected], new_lengths[~is_reflected] = through_pixels_batch(
+                    p0[~is_reflected], p1[~is_reflected], limits, n_pixels, step_size, memory_budget_mb
+                )
+
+            # Only the first `length` pixels of each row get overwritten
+            local_idx = t.from_numpy(np.searchsorted(local_rows, rows[writes]))
+            states[local_idx] = t.where(t.arange(n_pixels) < new_lengths[:, None, None], new_pixels, states[local_idx])
+            lengths[local_idx] = t.maximum(lengths[local_idx], new_lengths)
+
+            for k in np.nonzero(np.isin(rows[writes], snapshot_rows))[0]:
+                snapshots[rows[writes[k]]].append((write_order[writes[k]], states[local_idx[k]].clone()))
+            if progress_bar is not None:
+                progress_bar.update(len(writes))
+
+        # Replay the orbits which don't contain node 0, a chunk of orbits at a time
+        for chunk_start in range(0, len(orbit_ids), chunk_size):
+            chunk_orbit_ids = orbit_ids[chunk_start : chunk_start + chunk_size]
+            positions = concat_ranges(orbit_starts[chunk_orbit_ids], orbit_starts[chunk_orbit_ids + 1])
+            chunk, chunk_ranks = orbit_writes[positions], orbit_ranks[positions]
+            local_rows = np.unique(np.concatenate([rows[chunk], reflected_rows[chunk]]))
+            states = t.zeros((len(local_rows), 2, n_pixels), dtype=t.int16)
+            lengths = t.zeros(len(local_rows), dtype=t.int64)
+            for rank in range(chunk_ranks.max() + 1):
+                writes_with_rank = chunk[chunk_ranks == rank]
+                reflected_local_idx = t.from_numpy(np.searchsorted(local_rows, reflected_rows[writes_with_rank]))
+                replay_writes(writes_with_rank, states, lengths, local_rows, states[reflected_local_idx])
+            chunks.append((t.from_numpy(local_rows), lengths, states))
+
+        # Replay the pairs containing node 0, reading the rows they reflect from as they were at the time of the write
+        writes, ranks = node_0_writes[node_0_idx], node_0_ranks[node_0_idx]
+        local_rows = np.unique(rows[writes])
+        states = t.zeros((len(local_rows), 2, n_pixels), dtype=t.int16)
+        lengths = t.zeros(len(local_rows), dtype=t.int64)
+        for rank in range(ranks.max() + 1 if len(writes) else 0):
+            writes_with_rank = writes[ranks == rank]
+            reflected_states = t.zeros((len(writes_with_rank), 2, n_pixels), dtype=t.int16)
+            for k, write in enumerate(writes_with_rank):
+                history = [state for order, state in snapshots[reflected_rows[write]] if order < write_order[write]]
+                if history:
+                    reflected_states[k] = history[-1]
+            replay_writes(writes_with_rank, states, lengths, local_rows, reflected_states)
+        chunks.append((t.from_numpy(local_rows), lengths, states))
+
+        return chunks
+
+    return replay_rows
+
+
+def ellipse_line_builder(
+    coords: Float[Tensor, "n_nodes 2"],
+    d_joined: dict[int, list[int]],
+    x: int,
+    y: int,
+    step_size: float,
+    n_pixels: int,
+    memory_budget_mb: float = 256.0,
+) -> Callable[[Int[Tensor, "batch"]], LineTable]:
+    """
+    Returns a function which builds any batch of rows of the Ellipse line table (the k-th line of the result is row
+    `line_idx[k]`), with exactly the same pixels as `build_ellipse_line_table`. We only replay the writes the requested
+    rows depend on (see `ellipse_write_replayer`), and number the rows we get locally, so a batch costs O(batch *
+    n_pixels) rather than O(n_lines).
+    """
+    replay_rows = ellipse_write_replayer(coords, d_joined, x, y, step_size, n_pixels, memory_budget_mb)
+
+    def build_lines(line_idx: Int[Tensor, "batch"]) -> LineTable:
+        chunks = replay_rows(line_idx.numpy())
+        # Requested rows which aren't in `d_joined` don't get any writes, so they end up with zero length
+        local_rows = np.unique(np.concatenate([line_idx.numpy(), *[chunk_rows.numpy() for chunk_rows, _, _ in chunks]]))
+        chunks = [
+            (t.from_numpy(np.searchsorted(local_rows, chunk_rows.numpy())), lengths, pixels)
+            for chunk_rows, lengths, pixels in chunks
+        ]
+        line_table = LineTable.from_chunks(len(local_rows), chunks, width=x)
+        return line_table.select(t.from_numpy(np.searchsorted(local_rows, line_idx.numpy())))
+
+    return build_lines
+
+
+def rectangle_line_builder(
+    d_coords: dict[int, Float[Tensor, "2"]],
+    d_joined: dict[int, list[int]],
+    d_sides: dict[int, int],
+    nx: int,
+    ny: int,
+    x: int,
+    y: int,
+    step_size: float,
+    memory_budget_mb: float = 256.0,
+) -> Callable[[Int[Tensor, "batch"]], LineTable]:
+    """
+    Returns a function which builds any batch of rows of the Rectangle line table (the k-th line of the result is row
+    `line_idx[k]`), with exactly the same pixels as `build_rectangle_line_table`. Each row only depends on its own pair
+    of nodes, so we just pass it the requested pairs (the ones it would fill in, i.e. i < j with j in d_joined[i]).
+    """
+    n_nodes = len(d_coords)
+    i = np.repeat(np.arange(n_nodes), [len(d_joined[k]) for k in range(n_nodes)])
+    j = np.concatenate([np.asarray(d_joined[k], dtype=np.int64) for k in range(n_nodes)])
+    is_filled = np.zeros(n_nodes * (n_nodes - 1) // 2, dtype=bool)
+    is_filled[pair_to_index_np(i[i < j], j[i < j], n_nodes)] = True
+
+    def build_lines(line_idx: Int[Tensor, "batch"]) -> LineTable:
+        line_idx_filled = line_idx[t.from_numpy(is_filled[line_idx.numpy()])].unique()
+        i, j = [arr.numpy() for arr in index_to_pair(line_idx_filled, n_nodes)]
+        splits = np.cumsum(np.bincount(i, minlength=n_nodes))[:-1]
+        d_joined_subset = dict(enumerate(np.split(j, splits)))
+        line_table = build_rectangle_line_table(
+            d_coords, d_joined_subset, d_sides, nx, ny, x, y, step_size, memory_budget_mb, show_progress=False
+        )
+        return line_table.select(line_idx)
+
+    return build_lines
+
+
 def build_through_pixels_dict(
     x,
     y,
@@ -161,7 +993,22 @@ def build_through_pixels_dict(
     step_size: float = 1.0,
     make_symmetric: bool = True,
     debug: bool = False,
-) -> dict[int, Tensor] | tuple[dict[int, Tensor], dict[int, list[int]], dict[int, list[int]], Tensor]:
+    vectorized: bool = True,
+    memory_budget_mb: float = 256.0,
+    rasterizer: Literal["sampled", "exact", "wu"] = "sampled",
+    line_store: Literal["table", "symmetric", "lazy"] = "table",
+    lazy_cache_mb: float = 512.0,
+    pixel_index: bool = False,
+    pixel_index_max_mb: float = 1024.0,
+) -> (
+    dict[int, Tensor]
+    | tuple[
+        dict[int, Tensor],
+        Adjacency,
+        dict[int, list[int]],
+        LineTable | SymmetricCircleLineTable | LazyLineTable,
+    ]
+):
     """
     Args:
         x: width of the image
@@ -173,8 +1020,8 @@ def build_through_pixels_dict(
             this is a tuple, referring to the strict and lenient fractions respectively (the former is the strict one
             because it refers to the kind of lines where the string crosses over itself; the latter is merely a sharp
             angle).
-        only_return_d_coords: if True, only returns the d_coords dictionary, not the pixel tensor. This is used when
-            we're painting the canvas (the tensor is a more useful form when generating the image).
+        only_return_d_coords: if True, only returns the d_coords dictionary, not the line table. This is used when
+            we're painting the canvas (the line table is a more useful form when generating the image).
         width_to_gap_ratio: ratio of the width of the gap to the width of the line. This makes sure the image looks
             accurate to physical representation.
         step_size: size of the step between pixels. Making this larger than 1 results in a quicker algorithm, but can
@@ -182,8 +1029,35 @@ def build_through_pixels_dict(
         make_symmetric: Experimental, makes connecting lines symmetric (I think the problem happens when we can draw
             a line but then not go back the same way with a similar line).
         debug: if True, we don't clear the output at the end of the function. This is useful for debugging.
+        vectorized: if True, we build the line table with batched tensor ops rather than looping over every pair of
+            nodes in Python. The result is identical, the loop is just kept so the two can be compared (see
+            `benchmarks.py`).
+        memory_budget_mb: rough upper bound on the size of the intermediate tensors when `vectorized` is True.
+        rasterizer: how we turn a line into pixels. "sampled" (the default) samples points every `step_size` along the
+            line and truncates them, so most pixels appear several times in a line (and so get counted several times
+            when scoring it). "exact" uses a DDA rasterizer which gives each pixel the line crosses exactly once, so
+            lines are shorter and faster to score & subtract. "wu" is the anti-aliased version of "exact", which also
+            stores a coverage weight for each pixel (so lines are drawn with sub-pixel accuracy, which means you can use
+            a smaller `x`). Both of these ignore `step_size` and `vectorized`.
+        line_store: "table" (the default) precomputes every line into a `LineTable`. "lazy" works for any frame &
+            rasterizer: it returns a `LazyLineTable` which only computes a line when it's first used, giving exactly
+            the same pixels as the full table. "symmetric" is only for circular frames (Ellipse with x == y) with the
+            "sampled" rasterizer: it returns a `SymmetricCircleLineTable`, which only samples the lines from nodes 0 &
+            1 and rotates them to get the others. This is much faster than "lazy", but the pixels aren't exactly the
+            ones in the full table (see the class docstring). Both keep the most recent lines in an LRU cache of at
+            most `lazy_cache_mb`, and skip the preprocessing & memory of the full table, which is what makes 1000+ node
+            frames practical.
+        lazy_cache_mb: size of the LRU cache when `line_store` is "symmetric" or "lazy".
+        pixel_index: if True (and `line_store="table"`), we also build the inverted index `line_table.pixel_index`,
+            which maps each pixel to the lines through it (used for incremental scoring). We skip it (leaving it as
+            None) if its estimated size is more than `pixel_index_max_mb`.
 
     """
+    assert rasterizer in ["sampled", "exact", "wu"], f"Unknown rasterizer {rasterizer!r}"
+    assert line_store in ["table", "symmetric", "lazy"], f"Unknown line store {line_store!r}"
+    if line_store == "symmetric":
+        assert shape == "Ellipse" and x == y, "Symmetric line store only works for circular frames (Ellipse, x == y)"
+        assert rasterizer == "sampled", "Symmetric line store only works with the sampled rasterizer"
     if shape == "Rectangle" and isinstance(n_nodes, int):
         assert (n_nodes % 4) == 0, f"n_nodes = {n_nodes} needs to be divisible by 4, or else there will be an error"
 
@@ -193,16 +1067,14 @@ def build_through_pixels_dict(
 
     d_archetypes = {}  # see later in code
 
-    # Note - we used to have `d_pixels` which mapped tuples of f(i, j) -> Int[Tensor, "2 len"], but now we just use a
-    # tensor `t_pixels` of size (0.5 * n_nodes * (n_nodes + 1), 2, max_pixels), where the first dimension is the one
-    # we use to index some pair f(i, j) into the tensor. This is faster in the actual generation phase cause we get to
-    # just index once and concatenate, and do everything as a single tensor. Note, the use of `max_pixels` means there's
-    # some buffer room in the tensor (which we pad with zeros), but this small memory inefficiency is basically fine.
-    # Note, f(i, j) is the function pair_to_index above.
+    # Note - we used to have `d_pixels` which mapped tuples of f(i, j) -> Int[Tensor, "2 len"], and then a zero-padded
+    # tensor `t_pixels` of size (0.5 * n_nodes * (n_nodes + 1), 2, max_pixels). Now we use a `LineTable`, which stores
+    # the same pixels without padding: all the lines concatenated together, plus offsets indexed by f(i, j) (where f is
+    # the function pair_to_index above). We still use a padded tensor of width `max_pixels_guess` while building it, but
+    # only ever for a chunk of lines at a time (except in the non-vectorized reference implementations).
     max_distance = (x**2 + y**2) ** 0.5 if shape == "Rectangle" else max(x, y)
     max_pixels_guess = int(max_distance / step_size) + 2
-    n_lines_total = int(0.5 * n_nodes * (n_nodes - 1))
-    t_pixels = t.zeros((n_lines_total, 2, max_pixels_guess), dtype=t.int16)
+    t_pixels = None
 
     if shape == "Rectangle":
         # we either read the number of nodes and divide them proportionally between sides, or the number of nodes is
@@ -286,100 +1158,25 @@ def build_through_pixels_dict(
 
         # =============== compute archetypal pixels and fill the pixel tensor ===============
 
-        progress_bar = tqdm(
-            desc="Building pixels dict",
-            # total=sum([len(d_joined[i]) for i in d_joined]) // 2,
-            total=len(d_joined),
-        )
-
-        # Build archetypes only when needed and store them in a dictionary
-        def get_archetype(key_type, a, b=None):
-            key = f"{key_type}_{a}" if b is None else f"{key_type}_{a}_{b}"
-            if key not in d_archetypes:
-                if key_type == "vertical":
-                    i, j = n2, (n3 + a) % n4
-                elif key_type == "horizontal":
-                    i, j = n1, n2 + a
-                elif key_type == "diagonal":
-                    if nx >= ny:
-                        i, j = n2 + a, n2 - b
-                    else:
-                        i, j = n2 - a, n2 + b
-                d_archetypes[key] = through_pixels(d_coords[i], d_coords[j], step_size=step_size)
-            return d_archetypes[key].clone()
-
-        for idx, i in enumerate(d_joined):
-            for j in d_joined[i]:
-                if i >= j:
-                    continue
-
-                # === first, check if they're opposite vertical, if so then populate using the archetypes ===
-                if (d_sides[i], d_sides[j]) == (1, 3):
-                    # this makes sure the node with vertex 0 is seen as being on side 3, not side 0
-                    if i == 0:
-                        i_, j_ = j, n4
-                    else:
-                        i_, j_ = i, j
-                    δ = (i_ + j_) - (2 * n2 + ny)
-                    pixels = get_archetype("vertical", abs(δ))
-                    if δ < 0:
-                        pixels[1] = -pixels[1]
-                    pixels[1] += (n2 - i_) * xd
-                    pixels_truncated = truncate_pixels(pixels.to(t.int16), [y, x])
-                    t_pixels[pair_to_index(i, j, n_nodes), :, : pixels_truncated.size(1)] = pixels_truncated
-
-                # === then, check if they're opposite horizontal, if so then populate using the archetypes ===
-                elif (d_sides[i], d_sides[j]) == (0, 2):
-                    δ = (i + j) - (2 * n1 + nx)
-                    pixels = get_archetype("horizontal", abs(δ))
-                    if δ < 0:
-                        pixels[0] = -pixels[0]
-                    pixels[0] += (n1 - i) * yd
-                    pixels_truncated = truncate_pixels(pixels.to(t.int16), [y, x])
-                    t_pixels[pair_to_index(i, j, n_nodes), :, : pixels_truncated.size(1)] = pixels_truncated
-
-                # === finally, the diagonal case ===
-                else:
-                    i_side = d_sides[i]
-                    j_side = d_sides[j]
-
-                    x_side = i_side if (i_side % 2 == 1) else j_side
-                    y_side = i_side if (i_side % 2 == 0) else j_side
-
-                    if i_side == 0 and j_side == 3:
-                        i_, j_ = j, i
-                        i_side, j_side = 3, 0
-                    else:
-                        i_, j_ = i, j
-
-                    i_len = starting_idx_list[i_side + 1] - i_
-                    j_len = j_ - starting_idx_list[j_side]
-
-                    x_len = i_len if (i_side % 2 == 1) else j_len
-                    y_len = i_len if (i_side % 2 == 0) else j_len
-
-                    adj = min(i_len, j_len)
-                    opp = max(i_len, j_len)
-
-                    pixels = get_archetype("diagonal", adj, opp)
-
-                    # flip in x = y
-                    if ((x_len > y_len) != (x > y)) and (x_len != y_len):
-                        pixels = pixels.flip(0)
-                    # flip in x
-                    if x_side == 3:
-                        pixels[0] = y - pixels[0]
-                    # flip in y
-                    if y_side == 0:
-                        pixels[1] = x - pixels[1]
-
-                    pixels_truncated = truncate_pixels(pixels.to(t.int16), [y, x])
-                    t_pixels[pair_to_index(i, j, n_nodes), :, : pixels_truncated.size(1)] = pixels_truncated
-
-            progress_bar.update(1)
-
-        # progress_bar.n = sum([len(d_joined[i]) for i in d_joined]) // 2
-        progress_bar.n = len(d_joined)
+        if line_store == "lazy" and rasterizer == "sampled":
+            build_lines = rectangle_line_builder(d_coords, d_joined, d_sides, nx, ny, x, y, step_size, memory_budget_mb)
+            line_table = LazyLineTable(build_lines, n_lines=n4 * (n4 - 1) // 2, width=x + 1, max_cache_mb=lazy_cache_mb)
+        elif line_store == "lazy":
+            coords = t.stack([d_coords[k] for k in range(n4)])
+            line_table = build_lazy_line_table(coords, [y, x], x + 1, rasterizer, step_size, lazy_cache_mb)
+        elif rasterizer in ["exact", "wu"]:
+            coords = t.stack([d_coords[k] for k in range(n4)])
+            line_table = build_exact_line_table(coords, d_joined, [y, x], x + 1, memory_budget_mb, rasterizer)
+        elif vectorized:
+            line_table = build_rectangle_line_table(
+                d_coords, d_joined, d_sides, nx, ny, x, y, step_size, memory_budget_mb
+            )
+        else:
+            t_pixels = t.zeros((n4 * (n4 - 1) // 2, 2, max_pixels_guess), dtype=t.int16)
+            lengths = fill_rectangle_pixels_loop(
+                t_pixels, d_coords, d_joined, d_sides, d_archetypes, nx, ny, x, y, step_size
+            )
+            line_table = LineTable.from_dense(t_pixels, lengths, width=x + 1)
 
     elif shape == "Ellipse":
         assert x % 2 == 0, "x must be even to take advantage of symmetry"
@@ -419,57 +1216,48 @@ def build_through_pixels_dict(
                 np.mod(range(i + critical_n_nodes_start + 1, i + (n_nodes - critical_n_nodes_end)), n_nodes)
             )
 
-        # The second half are added via symmetry
-        # total = sum([len(d_joined[i]) for i in d_joined]) // 4
-        total = len(d_joined)
-        progress_bar = tqdm(desc="Building pixels dict", total=total)
-
-        for i1 in d_joined:
-            p1 = d_coords[i1]
-            for i0 in d_joined[i1]:
-                # # Avoid double counting: only consider (i0, i1) for i0 < i1
-                # if i0 > i1:
-                #     break
-
-                # # Check if the reflection of this line is already in the dict
-                idx = pair_to_index(i0, i1, n_nodes)
-                reflection_idx = pair_to_index(n_nodes - i1, n_nodes - i0, n_nodes)
-                if t_pixels[reflection_idx].max() > 0:
-                    y_reflected, x_reflected = t_pixels[reflection_idx]
-                    pixels = t.stack([(y - y_reflected).flip(0), x_reflected.flip(0)])
-
-                # If reflection isn't in the dict, we need to create it
-                else:
-                    p0 = d_coords[i0]
-                    pixels = through_pixels(p0, p1, step_size=step_size)
-
-                pixels_truncated = truncate_pixels(pixels.to(t.int16), [y - 1, x - 1])
-                t_pixels[idx, :, : pixels_truncated.size(1)] = pixels_truncated
-
-            progress_bar.update(1)
-
         if only_return_d_coords:
             return d_coords
 
-    # We overestimated to get the size of t_pixels, so we need to truncate it
-    t_pixels_sum = t_pixels.sum(dim=(0, 1))
-    max_pixels = t_pixels_sum.nonzero()[-1].item()
-    t_pixels_cropped = t_pixels[:, :, :max_pixels]
+        if line_store == "symmetric":
+            centre = (0.5 * y - 1, 0.5 * x - 1)
+            line_table = SymmetricCircleLineTable.from_coords(
+                coords, centre, [y - 1, x - 1], x, step_size, lazy_cache_mb
+            )
+        elif line_store == "lazy" and rasterizer == "sampled":
+            build_lines = ellipse_line_builder(coords, d_joined, x, y, step_size, max_pixels_guess, memory_budget_mb)
+            n_lines = n_nodes * (n_nodes - 1) // 2
+            line_table = LazyLineTable(build_lines, n_lines=n_lines, width=x, max_cache_mb=lazy_cache_mb)
+        elif line_store == "lazy":
+            line_table = build_lazy_line_table(coords, [y - 1, x - 1], x, rasterizer, step_size, lazy_cache_mb)
+        elif rasterizer in ["exact", "wu"]:
+            line_table = build_exact_line_table(coords, d_joined, [y - 1, x - 1], x, memory_budget_mb, rasterizer)
+        elif vectorized:
+            line_table = build_ellipse_line_table(coords, d_joined, x, y, step_size, max_pixels_guess, memory_budget_mb)
+        else:
+            t_pixels = t.zeros((n_nodes * (n_nodes - 1) // 2, 2, max_pixels_guess), dtype=t.int16)
+            lengths = fill_ellipse_pixels_loop(t_pixels, d_coords, d_joined, x, y, n_nodes, step_size)
+            line_table = LineTable.from_dense(t_pixels, lengths, width=x)
 
-    # Turn d_joined into a symmetric dict
+    # Turn d_joined into CSR arrays (so we don't need to convert lists when generating), and make it symmetric
+    d_joined = Adjacency.from_dict(d_joined)
     if make_symmetric:
-        for i, j_list in d_joined.items():
-            d_joined[i] = [j for j in j_list if i in d_joined[j]]
+        d_joined = d_joined.symmetrized()
+
+    # Optionally build the inverted index (only possible when we have the full line table)
+    if pixel_index and isinstance(line_table, LineTable):
+        line_table.pixel_index = build_pixel_index(line_table, pixel_index_max_mb)
 
     if debug:
         # > Print the estimated size in MB of each dictionary
         sizes = {
             "d_coords": get_size_mb(d_coords),
-            "d_joined": get_size_mb(d_joined),
+            "d_joined": d_joined.nbytes / (1024 * 1024),
             "d_sides": get_size_mb(d_sides),
             "d_archetypes": get_size_mb(d_archetypes),
             "t_pixels": get_size_mb(t_pixels),
-            "t_pixels_cropped": get_size_mb(t_pixels_cropped),
+            "line_table": line_table.nbytes / (1024 * 1024),
+            "pixel_index": getattr(getattr(line_table, "pixel_index", None), "nbytes", 0) / (1024 * 1024),
         }
         print("\nObject sizes in MB:")
         print("-" * 30)
@@ -509,7 +1297,7 @@ def build_through_pixels_dict(
     else:
         clear_output()
 
-    return d_coords, d_joined, d_sides, t_pixels_cropped
+    return d_coords, d_joined, d_sides, line_table
 
 
 # def node_distance(i: int, j: int, n_nodes: int, signed: bool = False) -> int | tuple[int, int]:
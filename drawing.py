@@ -749,11 +749,11 @@ class Drawing:
                         (best_pixels >= 0).all(axis=0)
                         & (best_pixels < np.array(image.shape)[:, None]).all(axis=0),
                     ]
-                    best_pixels = np.unique(best_pixels, axis=1)
+                    best_pixels = np.unique(yx_to_linear(best_pixels, image.shape[1]))
                 else:
-                    best_pixels = best_coords.astype(np.int32)
+                    best_pixels = yx_to_linear(best_coords.astype(np.int32), image.shape[1])
 
-                image[best_pixels[0], best_pixels[1]] -= darkness
+                image.flat[best_pixels] -= darkness
                 # all_coords[color_string].append(best_coords_uncropped)
                 all_coords[color_string].append(best_coords)
 
@@ -974,17 +974,18 @@ class Drawing:
                     (interpolated_coords >= 0).all(axis=0)
                     & (interpolated_coords < np.array(image.shape)[:, None]).all(axis=0),
                 ].astype(np.int32)
-                pixels.append(interpolated_coords)
+                pixels.append(yx_to_linear(interpolated_coords, image.shape[1]))
                 n_pixels.append(interpolated_coords.shape[1])
             else:
-                pixels.append(coords.astype(np.int32))
+                pixels.append(yx_to_linear(coords.astype(np.int32), image.shape[1]))
                 n_pixels.append(coords.shape[1])
 
-        pixels = np.stack([pad_to_length(p, max(n_pixels)) for p in pixels])  # (n_rand, 2, n_pix)
+        # Concat the (linear) pixels of all shapes, with `shape_ids` mapping each pixel back to its shape
+        pixels = np.concatenate(pixels)  # (total_pix,)
+        shape_ids = np.repeat(np.arange(len(n_pixels)), n_pixels)  # (total_pix,)
 
-        # Get the pixels values of the target image at these coords
-        pixel_values = image[pixels[:, 0], pixels[:, 1]]  # (n_rand, n_pix)
-        pixel_values_mask = np.any(pixels != 0, axis=1)  # (n_rand, n_pix)
+        # Get the pixels values of the target image at these coords (single gather on the flat image)
+        pixel_values = image.reshape(-1).take(pixels)  # (total_pix,)
 
         # Apply negative penalty and weighting
         if self.negative_penalty > 0.0:
@@ -992,13 +993,15 @@ class Drawing:
             pixel_values -= self.negative_penalty * np.maximum(0.0, self.darkness - pixel_values)
 
         if self.target.weight_image is not None:
-            pixel_weights = self.target.weight_image[pixels[:, 0], pixels[:, 1]]  # (n_rand, n_pix)
-            pixel_values_mask = pixel_values_mask.astype(pixel_values.dtype) * pixel_weights
+            pixel_weights = self.target.weight_image.reshape(-1).take(pixels)  # (total_pix,)
+        else:
+            pixel_weights = np.ones_like(pixel_values)
 
         # Average over each pixel array
-        pixel_values = (pixel_values * pixel_values_mask).sum(-1) / (
-            pixel_values_mask.sum(-1) + 1e-8
-        )
+        n_rand = len(n_pixels)
+        pixel_values = np.bincount(
+            shape_ids, weights=pixel_values * pixel_weights, minlength=n_rand
+        ) / (np.bincount(shape_ids, weights=pixel_weights, minlength=n_rand) + 1e-8)
 
         # Pick the darkest shape to draw
         best_idx = np.argmax(pixel_values)
@@ -1250,6 +1253,11 @@ def mask_coords(
     return coords
 
 
+def yx_to_linear(pixels: Int[Arr, "2 n_pixels"], width: int) -> Int[Arr, "n_pixels"]:
+    """Converts (y, x) rows into int32 linear indices into a flattened image with `width` columns."""
+    return pixels[0].astype(np.int32) * width + pixels[1].astype(np.int32)
+
+
 def pad_to_length(arr: np.ndarray, length: int, axis: int = -1, fill_value: float = 0):
     target_shape = list(arr.shape)
     assert length >= target_shape[axis]
@@ -0,0 +1,254 @@
+"""
+Includes the global solver, an alternative to the greedy loop: we solve for how many times to draw every line at once
+(`solve_multiplicities`), then join the chosen lines into a single continuous thread path (`lines_to_path`)
+"""
+
+import math
+
+import numpy as np
+import torch as t
+from jaxtyping import Bool, Float, Int
+from torch import Tensor
+
+from incidence import LineIncidence
+from line_table import index_to_pair
+
+t.classes.__path__ = []
+
+
+def solve_multiplicities(
+    incidence: LineIncidence,
+    image: Float[Tensor, "y x"],
+    darkness: float,
+    w: Float[Tensor, "y x"] | None = None,
+    n_iters: int = 200,
+    n_power_iters: int = 20,
+    max_total: float | None = None,
+) -> Float[Tensor, "n_lines"]:
+    """
+    Finds non-negative (real-valued) multiplicities `x` for every line, minimizing the weighted squared error between
+    the image and the lines drawn `x` times each, i.e. `0.5 * sum(w * (darkness * A.T @ x - image) ** 2)` where `A` is
+    the (unweighted) incidence matrix. We use accelerated projected gradient descent (FISTA), with the step size from
+    a few power iterations. Lines with no pixels (pairs which aren't joined) have zero gradient, so they stay at 0.
+
+    If `max_total` is given, we also constrain `sum(x) <= max_total` (projecting onto this set at every step), which is
+    much better than solving without it & scaling the solution down afterwards, since the best way to spend a small
+    budget isn't a scaled-down version of the best way to spend a big one.
+    """
+    b = image.reshape(-1).float()
+    w_flat = t.ones_like(b) if w is None else w.reshape(-1).float()
+
+    def gradient(x: Tensor) -> Tensor:
+        errors = darkness * incidence.back_project(x) - b
+        return darkness * incidence.sums(w_flat * errors)
+
+    # The gradient is Lipschitz with constant darkness^2 * (largest eigenvalue of A W A^T)
+    v = t.rand(len(incidence), generator=t.Generator().manual_seed(0))
+    eigenvalue = 1.0
+    for _ in range(n_power_iters):
+        v = incidence.sums(w_flat * incidence.back_project(v))
+        eigenvalue = v.norm().item()
+        v = v / max(eigenvalue, 1e-12)
+    step_size = 1.0 / (1.05 * darkness**2 * max(eigenvalue, 1e-12))  # a bit of slack, since power iteration undershoots
+
+    x = t.zeros(len(incidence))
+    y = x
+    momentum = 1.0
+    for _ in range(n_iters):
+        x_next = project_to_budget(y - step_size * gradient(y), max_total)
+        momentum_next = (1 + math.sqrt(1 + 4 * momentum**2)) / 2
+        y = x_next + ((momentum - 1) / momentum_next) * (x_next - x)
+        x, momentum = x_next, momentum_next
+
+    return x
+
+
+def project_to_budget(x: Float[Tensor, "n_lines"], max_total: float | None) -> Float[Tensor, "n_lines"]:
+    """
+    Euclidean projection onto `{x >= 0, sum(x) <= max_total}`. If clamping at zero isn't enough, the projection is
+    `(x - tau).clamp(min=0)` for the threshold `tau` which makes it sum to `max_total`, which we find by sorting.
+    """
+    x = x.clamp(min=0.0)
+    if max_total is None or x.sum().item() <= max_total:
+        return x
+    values = x.sort(descending=True).values
+    cumsums = values.cumsum(0)
+    ranks = t.arange(1, values.size(0) + 1, dtype=values.dtype)
+    n_kept = int((values * ranks > cumsums - max_total).sum().item())  # the number of entries which stay positive
+    tau = (cumsums[n_kept - 1] - max_total) / n_kept
+    return (x - tau).clamp(min=0.0)
+
+
+def round_multiplicities(x: Float[Tensor, "n_lines"], max_lines: int) -> Int[Tensor, "n_lines"]:
+    """
+    Rounds the multiplicities to integers, scaling them down first if they add up to more than `max_lines`. We round
+    down, then give the leftover lines to the largest remainders (so the total is preserved).
+    """
+    total = x.sum().item()
+    if total > max_lines:
+        x = x * (max_lines / total)
+    counts = x.floor()
+    n_leftover = min(int(round(x.sum().item())), max_lines) - int(counts.sum().item())
+    if n_leftover > 0:
+        counts[(x - counts).topk(n_leftover).indices] += 1
+    return counts.long()
+
+
+def residual_line_scores(
+    incidence: LineIncidence,
+    counts: Int[Tensor, "n_lines"],
+    image: Float[Tensor, "y x"],
+    darkness: float,
+    n_nodes: int,
+    w: Float[Tensor, "y x"] | None = None,
+) -> Float[np.ndarray, "n_nodes n_nodes"]:
+    """
+    Scores every line by the mean (weighted) darkness still left to draw along it, once each line has been drawn
+    `counts` times, i.e. the same score as the greedy loop uses. Returned as a symmetric node x node matrix (pairs which
+    aren't lines get 0), for `lines_to_path` to choose its connectors with.
+    """
+    b = image.reshape(-1).float()
+    w_flat = t.ones_like(b) if w is None else w.reshape(-1).float()
+    residual = b - darkness * incidence.back_project(counts.float())
+    line_scores = incidence.sums(w_flat * residual) / incidence.sums(w_flat).clamp(min=1e-12)
+    i, j = index_to_pair(t.arange(len(incidence)), n_nodes)
+    scores = np.zeros((n_nodes, n_nodes))
+    scores[i.numpy(), j.numpy()] = line_scores.numpy()
+    return scores + scores.T
+
+
+def lines_to_path(
+    lines: list[tuple[int, int]],
+    joined: Bool[np.ndarray, "n_nodes n_nodes"],
+    flip_hook_parity: bool,
+    line_scores: Float[np.ndarray, "n_nodes n_nodes"] | None = None,
+) -> tuple[list[tuple[int, int]], int, int]:
+    """
+    Orders (and orients) `lines` into a single thread path, i.e. each line starts at the node after the previous one's
+    end (which is the same node, or its pair if `flip_hook_parity`). Returns the path, the number of connector lines we
+    had to add, and the number of jumps (places where the next line starts somewhere else, because we couldn't connect
+    the two nodes with at most 2 connector lines).
+
+    Leaving from node `s` uses up one line end at `s`, and arriving at node `j` uses one at `j` (and then we leave from
+    next(j)). So a closed path exists iff every node has as many line ends as next(node), i.e. even degrees without
+    `flip_hook_parity`, and balanced pairs with it (plus connectivity). We add connector lines to fix this, then run
+    Hierholzer's algorithm on each connected component, and join the resulting circuits with more connectors. Every
+    connector is a line in `joined` (i.e. `d_joined`), so it respects the `critical_fracs` restrictions. When 2 nodes
+    can't be connected, we join them with a "jump" instead: an edge which isn't in `joined` (so it can't be one of
+    `lines` or a connector), which we cut out of the final path.
+
+    If `line_scores` is given (symmetric, higher is better), then wherever we have a choice of connector we take the
+    highest scoring one, rather than the first one we find. The connectors get drawn like every other line, so this
+    lets them do some useful work.
+    """
+    n_nodes = joined.shape[0]
+    scores = np.zeros((n_nodes, n_nodes)) if line_scores is None else np.where(joined, line_scores, -np.inf)
+
+    def best(candidates: np.ndarray, candidate_scores: np.ndarray) -> int | None:
+        return None if len(candidates) == 0 else int(candidates[np.argmax(candidate_scores[candidates])])
+
+    def next_node(j):
+        return j ^ 1 if flip_hook_parity else j
+
+    # Find how many extra line ends each node needs
+    ends = np.zeros(n_nodes, dtype=np.int64)
+    for i, j in lines:
+        ends[i] += 1
+        ends[j] += 1
+    if flip_hook_parity:
+        surplus = ends - ends[next_node(np.arange(n_nodes))]
+        deficits = [node for node in range(n_nodes) for _ in range(max(-surplus[node], 0))]
+    else:
+        deficits = np.flatnonzero(ends % 2).tolist()
+
+    # Pair the nodes which need extra ends up with connector lines (or via an intermediate node, if they aren't joined)
+    connectors, jumps = [], []
+    unpaired = list(deficits)
+    while unpaired:
+        a = unpaired.pop(0)
+        partner = best(np.flatnonzero(joined[a, unpaired]), scores[a, unpaired])
+        if partner is not None:
+            connectors.append((a, unpaired.pop(partner)))
+            continue
+        if not unpaired:
+            break
+        b = unpaired.pop(0)
+        via = best(
+            np.flatnonzero(joined[a] & joined[next_node(np.arange(n_nodes)), b]),
+            scores[a] + scores[next_node(np.arange(n_nodes)), b],
+        )
+        if via is not None:
+            connectors += [(a, via), (next_node(via), b)]
+        else:
+            jumps.append((a, b))
+    all_lines = list(lines) + connectors + jumps
+
+    # Hierholzer's algorithm, where the state is the node we're leaving from
+    lines_at_node = [[] for _ in range(n_nodes)]
+    for idx, (i, j) in enumerate(all_lines):
+        lines_at_node[i].append(idx)
+        lines_at_node[j].append(idx)
+    used = np.zeros(len(all_lines), dtype=bool)
+    pointers = np.zeros(n_nodes, dtype=np.int64)
+
+    def circuit(start: int) -> list[tuple[int, int]]:
+        stack = [(start, None)]
+        path = []
+        while stack:
+            s = stack[-1][0]
+            while pointers[s] < len(lines_at_node[s]) and used[lines_at_node[s][pointers[s]]]:
+                pointers[s] += 1
+            if pointers[s] == len(lines_at_node[s]):
+                line = stack.pop()[1]
+                if line is not None:
+                    path.append(line)
+            else:
+                idx = lines_at_node[s][pointers[s]]
+                used[idx] = True
+                i, j = all_lines[idx]
+                j = j if i == s else i
+                stack.append((next_node(j), (s, j)))
+        return path[::-1]
+
+    circuits = []
+    for node in range(n_nodes):
+        if any(not used[idx] for idx in lines_at_node[node]):
+            circuits.append(circuit(node))
+
+    # Join the circuits together, rotating each one to start wherever is easiest to get to from the previous one
+    path = circuits[0] if circuits else []
+    n_connectors = len(connectors)
+    for next_circuit in circuits[1:]:
+        end = next_node(path[-1][1])
+        starts = np.array([i for i, _ in next_circuit])
+        is_closed = next_node(next_circuit[-1][1]) == next_circuit[0][0]
+        candidates = range(len(next_circuit)) if is_closed else [0]
+        rotation = next((p for p in candidates if starts[p] == end), None)
+        bridge = []
+        if rotation is None:
+            rotation = best(
+                np.flatnonzero(joined[end, next_node(starts[list(candidates)])]),
+                scores[end, next_node(starts[list(candidates)])],
+            )
+            if rotation is not None:
+                rotation = candidates[rotation]
+                bridge = [(end, next_node(int(starts[rotation])))]
+        if rotation is None:
+            rotation = candidates[0]
+            target = next_node(int(starts[rotation]))
+            via = best(
+                np.flatnonzero(joined[end] & joined[next_node(np.arange(n_nodes)), target]),
+                scores[end] + scores[next_node(np.arange(n_nodes)), target],
+            )
+            if via is not None:
+                bridge = [(end, via), (next_node(via), target)]
+            else:
+                bridge = [(end, target)]  # a jump, which gets cut out below
+        path += bridge + next_circuit[rotation:] + next_circuit[:rotation]
+        n_connectors += int(sum(joined[line] for line in bridge))
+
+    # Cut out the jumps (they're the only edges which aren't in `joined`), and count the breaks this leaves in the path
+    path = [line for line in path if joined[line]]
+    n_jumps = sum(path[n][0] != next_node(path[n - 1][1]) for n in range(1, len(path)))
+
+    return path, n_connectors, n_jumps
@@ -3,21 +3,27 @@ Includes all functions related to producing full-colour images (like the stag).
 """
 
 import copy
+import hashlib
 import json
 import math
+import os
+import queue
+import threading
 import time
 from collections import defaultdict
-from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, fields
+from functools import partial
 from pathlib import Path
 from tkinter import NO
-from typing import Generator, Literal
+from typing import Callable, Generator, Literal
 
 import einops
 import numpy as np
 import plotly.express as px
 import torch as t
 from IPython.display import HTML, display
-from jaxtyping import Float
+from jaxtyping import Float, Int
 from PIL import Image, ImageFilter
 from rich import print as rprint
 from rich.table import Table
@@ -25,7 +31,15 @@ from torch import Tensor
 from tqdm import tqdm
 from tqdm.notebook import tqdm_notebook
 
-from coordinates import build_through_pixels_dict, pair_to_index
+from coordinates import build_through_pixels_dict, pair_to_index, pair_to_index_np
+from adjacency import Adjacency
+from line_engines import ENGINES, NUMBA_AVAILABLE, line_denominators, score_lines
+from incidence import LineIncidence
+from line_scores import LazyGreedySelector, LineScores, PeriodicRescorer
+from residual import ResidualTracker
+from global_solver import lines_to_path, residual_line_scores, round_multiplicities, solve_multiplicities
+from line_cache import DEFAULT_MAX_CACHE_MB, cached_build_through_pixels_dict
+from line_table import LazyLineTable, LineTable, SymmetricCircleLineTable, build_pixel_index, index_to_pair
 from misc import (
     get_color_hash,
     get_img_hash,
@@ -57,9 +71,10 @@ class ThreadArtColorParams:
     palette_restriction: dict = field(default_factory=dict)
     d_coords: dict = field(default_factory=dict)
     # d_pixels: dict = field(default_factory=dict) # Replaced with `t_pixels`
-    d_joined: dict = field(default_factory=dict)
+    d_joined: Adjacency | None = None
     d_sides: dict = field(default_factory=dict)
-    t_pixels: Tensor = field(default_factory=lambda: Tensor())
+    # t_pixels: Tensor = field(default_factory=lambda: Tensor()) # Replaced with `line_table`
+    line_table: LineTable | SymmetricCircleLineTable | LazyLineTable | None = None
     n_consecutive: int = 0
     shape: str = "Rectangle"
     seed: int = 0
@@ -68,7 +83,67 @@ class ThreadArtColorParams:
     other_colors_weighting: list[list[float]] = field(default_factory=list)
     # ^ can be e.g. {"white": 0.1, "*": 0.2} to give all other colors 0.2 weighting but white 0.1
     step_size: float = 1.0
-    # ^ if more than 1.0 then we take slightly larger jumps over pixels when drawing lines (t_pixels uses less memory)
+    # ^ if more than 1.0 then we take slightly larger jumps over pixels when drawing lines (line table uses less memory)
+    rasterizer: Literal["sampled", "exact", "wu"] = "sampled"
+    # ^ "exact" gives each pixel a line crosses exactly once (and ignores step_size), so lines are shorter & faster.
+    # "wu" is the anti-aliased version, which weights pixels by coverage (so results hold up better at smaller `x`).
+    line_store: Literal["table", "symmetric", "lazy"] = "table"
+    lazy_line_cache_mb: float = 512.0
+    # ^ For very large n_nodes. "lazy" only builds d_coords & d_joined, and computes lines when they're first used
+    # (keeping the most recently used ones in an LRU cache of at most `lazy_line_cache_mb`), matching "table" exactly.
+    # "symmetric" (circular frames only) stores just the lines from nodes 0 & 1 and rotates them to get the rest, which
+    # is much faster than "lazy", but the pixels are close to (rather than exactly) the ones in "table".
+    incremental_scores: bool = False
+    # ^ Only used when n_random_lines == "all" (with the default line store). Rather than re-scoring every candidate
+    # line at each step, we keep a running score for every line, and after drawing a line we only update the lines which
+    # share a pixel with it. This gives the same lines, but needs memory for the pixel -> lines index.
+    lazy_greedy: bool = False
+    # ^ Only used when n_random_lines == "all" (and critical_frac_penalty_power_decay is None, since that adds random
+    # noise to the scores). Pixel values only decrease, so the score we last computed for a line is an upper bound on
+    # its current score. We keep a heap of these bounds for each node, and only re-score the top few candidates until
+    # the best one is confirmed. This gives the same lines, and usually only re-scores a small fraction of them.
+    n_color_workers: int = 1
+    # ^ If more than 1, we generate the colors concurrently (each color only ever touches its own image), in a thread
+    # pool with torch pinned to 1 thread per op. Each color then gets its own random seed (derived from `seed`), so the
+    # lines are deterministic but not the same as when n_color_workers == 1. Only used with line_store="table".
+    full_rescore_every: int = 0
+    top_k_rescore: int = 16
+    # ^ If positive (and n_random_lines == "all"), we score every line at once every `full_rescore_every` steps, with a
+    # single sparse matrix-vector product. In between, each step only re-scores the `top_k_rescore` candidates with
+    # the best of those scores. This is approximate, unlike `incremental_scores` or `lazy_greedy`.
+    checkpoint_path: str | None = None
+    checkpoint_every: int = 1000
+    # ^ If `checkpoint_path` is given, `create_canvas_generator` saves its state there every `checkpoint_every` lines,
+    # and `create_canvas_generator(resume_from=checkpoint_path)` carries on from it (giving the same lines as if it
+    # hadn't been interrupted). Not supported with n_color_workers > 1.
+    engine: Literal["torch", "numpy", "numba"] = "torch"
+    # ^ Backend for scoring lines (see `line_engines.py`). "numpy" & "numba" skip torch's per-op overhead, which matters
+    # when each step only scores a few hundred short lines. They need line_store="table"; "numba" needs numba installed
+    # (otherwise we fall back to "numpy").
+    pixel_index_max_mb: float = 1024.0
+    # ^ Cap on the size of that pixel -> lines index. If it would be bigger than this, we don't build it and fall back
+    # to scoring lines from scratch.
+    track_residual: bool = False
+    early_stop_window: int = 0
+    early_stop_tol: float = 1e-3
+    # ^ If `track_residual` (or `early_stop_window > 0`), we keep track of how much of each color is left to draw
+    # (positive mass) or overdrawn (negative mass), weighted by `w`, and save the curves in `Img.residual_curves`. If
+    # `early_stop_window` is positive, we stop drawing a color once its last `early_stop_window` lines improved its
+    # residual by less than `early_stop_tol` (as a fraction of its starting residual).
+    solver: Literal["greedy", "nnls"] = "greedy"
+    nnls_iters: int = 200
+    # ^ "nnls" replaces the greedy loop: for each color we solve for how many times to draw every line at once
+    # (non-negative multiplicities which best reproduce the mono image within the line budget, using projected gradient
+    # descent on the sparse line-pixel matrix), then join the chosen lines into one continuous thread path, adding
+    # connector lines where needed (see `global_solver.py`). The connectors count towards `n_lines_per_color`. On
+    # butterfly_light.png (400px, 300 nodes, 1 color) this left a slightly smaller residual than greedy (145k vs 148k at
+    # 300 lines, 95.6k vs 96.7k at 1500) but took 2-9x as long, and it isn't better everywhere (at 160px with 200 lines
+    # it was 9% worse for black). Needs line_store="table".
+    joint_colors: bool = False
+    # ^ Rather than drawing each color in turn on its own dithered mask, every step scores the candidate lines of all
+    # colors at once (in a single batch) against one shared RGB residual of the target image, and draws the best line
+    # for each color. A color stops once it runs out of lines or its best line would no longer reduce the residual, so
+    # this often needs fewer lines in total. Not compatible with critical_frac_penalty_power_decay.
     debug_through_pixels_dict: bool = False
     # ^ if True, we leave all the debug print statements e.g. tensor sizes, if false then we only print post init time
     mode: Literal["color", "monochrome", "monochrome-draw"] = "color"
@@ -85,6 +160,14 @@ class ThreadArtColorParams:
     # extra multiples of the new negative pixel values to the score. For example if this was 1.5 and our pixel values
     # were [0.5, 0.3, 0.1] with darkness 0.2, then the scores would be [0.5, 0.3, 0.1 + 1.5 * -0.1 = -0.05], the latter
     # because subtracting 0.2 from the 3rd pixel would push it into negative values.
+    legacy_padding_penalty: bool = False
+    # ^ Lines used to be stored zero-padded to the length of the longest line, and the negative value penalty was also
+    # applied to that padding (as if it were pixels of value 0), so shorter lines were penalized more. The line table
+    # doesn't have padding, so by default we don't do this, which changes the lines you get whenever
+    # neg_penalty_multiplier > 0. Set this to True to add the same penalty back, i.e.
+    # `neg_penalty_multiplier * darkness * (max_length - length) / length` (only for the greedy loop without a weighting
+    # `w`, since the padding had zero weight). We also crop the lines like the padded tensor did (see
+    # `LineTable.legacy_cropped`), so this reproduces the lines from before that change. Needs line_store="table".
     flip_hook_parity: bool = True
     # ^ If True, then we leave in a different way than we arrived: this is used for the pieces made with thread, not the
     # drawn pieces.
@@ -92,6 +175,12 @@ class ThreadArtColorParams:
     # ^ for streamlit page, passing through uploaded image not filename
     palette_substitution: list[tuple[int, int, int]] | None = None
     # ^ only used when we supply lists of monochrome images to `filename`, e.g. Bowie
+    use_line_cache: bool = True
+    line_cache_dir: str | None = None
+    line_cache_max_mb: float = DEFAULT_MAX_CACHE_MB
+    # ^ The line table only depends on the frame geometry (not the image), so we cache it on disk & memory-map it on
+    # later runs. The cache dir defaults to `cache/lines`, and least recently used tables are evicted once the cache is
+    # bigger than `line_cache_max_mb`.
 
     @classmethod
     def from_dict(cls, args_dict: dict) -> "ThreadArtColorParams":
@@ -130,17 +219,58 @@ class ThreadArtColorParams:
             "[0] should be bigger i.e. more restrictive (it's for the self-crossing lines), [1] should be smaller"
         )
 
-        self.d_coords, self.d_joined, self.d_sides, self.t_pixels = build_through_pixels_dict(
-            self.x,
-            self.y,
-            self.n_nodes,
-            shape=self.shape,
-            critical_fracs=self.critical_fracs,
-            only_return_d_coords=False,
-            width_to_gap_ratio=self.width_to_gap_ratio,
-            step_size=self.step_size,
-            debug=self.debug_through_pixels_dict,
-        )
+        if self.use_line_cache:
+            self.d_coords, self.d_joined, self.d_sides, self.line_table = cached_build_through_pixels_dict(
+                self.x,
+                self.y,
+                self.n_nodes,
+                shape=self.shape,
+                critical_fracs=self.critical_fracs,
+                width_to_gap_ratio=self.width_to_gap_ratio,
+                step_size=self.step_size,
+                debug=self.debug_through_pixels_dict,
+                rasterizer=self.rasterizer,
+                line_store=self.line_store,
+                lazy_cache_mb=self.lazy_line_cache_mb,
+                pixel_index=self.incremental_scores,
+                pixel_index_max_mb=self.pixel_index_max_mb,
+                cache_dir=self.line_cache_dir,
+                max_cache_mb=self.line_cache_max_mb,
+            )
+        else:
+            self.d_coords, self.d_joined, self.d_sides, self.line_table = build_through_pixels_dict(
+                self.x,
+                self.y,
+                self.n_nodes,
+                shape=self.shape,
+                critical_fracs=self.critical_fracs,
+                only_return_d_coords=False,
+                width_to_gap_ratio=self.width_to_gap_ratio,
+                step_size=self.step_size,
+                debug=self.debug_through_pixels_dict,
+                rasterizer=self.rasterizer,
+                line_store=self.line_store,
+                lazy_cache_mb=self.lazy_line_cache_mb,
+                pixel_index=self.incremental_scores,
+                pixel_index_max_mb=self.pixel_index_max_mb,
+            )
+
+        assert self.engine in ENGINES, f"Unknown engine {self.engine!r}, expected one of {ENGINES}"
+        if self.engine == "numba" and not NUMBA_AVAILABLE:
+            print("numba isn't installed, so we're using the numpy engine instead")
+            self.engine = "numpy"
+        assert self.solver in ["greedy", "nnls"], f"Unknown solver {self.solver!r}"
+        if self.solver == "nnls":
+            assert isinstance(self.line_table, LineTable), "The 'nnls' solver needs line_store='table'"
+        if self.engine != "torch":
+            assert isinstance(self.line_table, LineTable), f"The {self.engine!r} engine needs line_store='table'"
+        if self.legacy_padding_penalty:
+            assert isinstance(self.line_table, LineTable), "legacy_padding_penalty needs line_store='table'"
+            has_pixel_index = self.line_table.pixel_index is not None
+            self.line_table = self.line_table.legacy_cropped()
+            if has_pixel_index:
+                self.line_table.pixel_index = build_pixel_index(self.line_table, self.pixel_index_max_mb)
+
         print(f"ThreadArtColorParams.__init__ done in {time.time() - t0:.2f} seconds")
 
     @property
@@ -162,6 +292,8 @@ class ThreadArtColorParams:
         for k, v in self.__dict__.items():
             if isinstance(v, Tensor):
                 print(f"{k:>22} : tensor of shape {tuple(v.shape)}")
+            elif isinstance(v, (LineTable, SymmetricCircleLineTable, LazyLineTable)):
+                print(f"{k:>22} : {v!r}")
             elif isinstance(v, dict):
                 print(f"{k:>22} : dict of length {len(v)}")
             elif k == "palette":
@@ -174,6 +306,27 @@ class ThreadArtColorParams:
         return ""
 
 
+# Fields of `ThreadArtColorParams` which don't change the lines we generate, so a checkpoint is still valid if they
+# change (see `Img.get_checkpoint_params`). The geometry fields are built from the other params, and `image` is checked
+# by its hash instead.
+CHECKPOINT_IGNORED_PARAMS = {
+    "name",
+    "d_coords",
+    "d_joined",
+    "d_sides",
+    "line_table",
+    "image",
+    "debug_through_pixels_dict",
+    "use_line_cache",
+    "line_cache_dir",
+    "line_cache_max_mb",
+    "lazy_line_cache_mb",
+    "checkpoint_path",
+    "checkpoint_every",
+    "track_residual",
+}
+
+
 # ===================================================================================================
 
 
@@ -211,6 +364,17 @@ class Img:
             #         t.tensor((base_image_mono).convert(mode="L").getdata()).reshape((self.y, self.x)) / 255
             #     )
 
+        # Sparse (lines x pixels) matrix, only built if we need it (see `ThreadArtColorParams.full_rescore_every`)
+        self.incidence: LineIncidence | None = None
+
+        # Per-line arrays which don't change during a run (see `precompute_line_arrays`)
+        self.line_denominators: Float[Tensor, "n_lines"] | None = None
+        self.line_penalties: Float[Tensor, "2 n_lines"] | None = None
+        self.line_padding: Float[Tensor, "n_lines"] | None = None
+
+        # Residual after each line, for every color (see `ThreadArtColorParams.track_residual`)
+        self.residual_curves: dict[tuple, list[float]] = {}
+
         # Process the importance weighting (we'll apply this to all images)
         self.w = None
         if args.w_filename:
@@ -528,14 +692,46 @@ class Img:
         rprint(table)
 
     # Creates the actual art
-    def create_canvas(self) -> dict[str, list[tuple[int, int]]]:
+    def create_canvas(
+        self,
+        resume_from: str | Path | None = None,
+        extend_from: dict[tuple, list[tuple[int, int]]] | None = None,
+        time_budget_s: float | None = None,
+    ) -> dict[str, list[tuple[int, int]]]:
         line_dict = defaultdict(list)
-        for color, i, j in self.create_canvas_generator():
+        for color, i, j in self.create_canvas_generator(
+            resume_from=resume_from, extend_from=extend_from, time_budget_s=time_budget_s
+        ):
             line_dict[color].append((i, j))
 
         return line_dict
 
-    def create_canvas_generator(self) -> Generator:
+    def create_canvas_generator(
+        self,
+        resume_from: str | Path | None = None,
+        extend_from: dict[tuple, list[tuple[int, int]]] | None = None,
+        time_budget_s: float | None = None,
+        yield_residuals: bool = False,
+    ) -> Generator:
+        """
+        Yields `(color_tuple, i, j)` for every line we draw. If `resume_from` is a checkpoint (see
+        `ThreadArtColorParams.checkpoint_path`), we first yield all the lines which were already drawn before it was
+        saved, then carry on from where it left off.
+
+        If `extend_from` is an existing `line_dict` (e.g. from `create_canvas` with fewer `n_lines_per_color`), we
+        subtract all its lines from the images at once, yield them, and then carry on drawing each color from its last
+        node until it has `n_lines_per_color` lines. This costs about the same as generating just the extra lines (but
+        the extra lines won't match a from-scratch run exactly, since the random state is different).
+
+        If `time_budget_s` is given, we time a few steps first and then trade off quality to finish within the budget:
+        first by scoring fewer random lines per step, then (if that isn't enough) by scaling down every color's number
+        of lines proportionally (like `misc.scale_down`). Each color also gets a share of the remaining time, and stops
+        early if it runs out, so we always return every color. What we traded off is saved in `time_budget_report`.
+
+        If `yield_residuals` is True, we yield `(color_tuple, i, j, residual)` instead, where `residual` is that color's
+        residual after drawing the line (see `ThreadArtColorParams.track_residual`), or None for lines which we're only
+        replaying (from `resume_from` or `extend_from`).
+        """
         assert len(self.args.palette) == len(self.args.n_lines_per_color), (
             "Palette and lines per color don't match. Did you change the palette without re-updating params?"
         )
@@ -548,145 +744,879 @@ class Img:
         )
 
         mono_image_dict = {
-            color_tuple: blur_image(mono_image, self.args.blur_rad)
+            color_tuple: blur_image(mono_image, self.args.blur_rad).contiguous()  # so we can index it flattened
             for color_tuple, mono_image in self.mono_images_dict.items()
         }
 
+        # The denominators & penalties of every line's score are fixed, so we compute them once up front
+        self.precompute_line_arrays()
+
+        # Build the sparse incidence matrix once (it doesn't depend on the color), before any workers start
+        if self.use_periodic_rescore and self.incidence is None:
+            n_pixels = next(iter(mono_image_dict.values())).numel()
+            self.incidence = LineIncidence.from_line_table(self.args.line_table, n_pixels, self.w)
+
+        # Maybe decide how to fit within the time budget (before seeding, since timing some steps uses random numbers)
+        plan = None
+        if time_budget_s is not None:
+            assert not self.use_parallel_colors, "Time budgets aren't supported with n_color_workers > 1"
+            plan = self.plan_time_budget(time_budget_s, t0, mono_image_dict, darkness)
+        n_lines_per_color = plan["n_lines_planned"] if plan else list(self.args.n_lines_per_color)
+
         # Setting a random seed at the start of this function ensures the lines will be the same (unless params change)
         global_random_seed(self.args.seed)
 
+        checkpointing = self.args.checkpoint_path is not None or resume_from is not None
+        assert not (checkpointing and self.use_parallel_colors), "Checkpoints aren't supported with n_color_workers > 1"
+        assert not (extend_from and self.use_parallel_colors), "Extending isn't supported with n_color_workers > 1"
+        assert not (extend_from and resume_from), "Can't extend and resume at the same time (resume already extends)"
+        if checkpointing and self.use_periodic_rescore:
+            # This way every checkpoint is at a full rescore, so resuming doesn't change which scores are stale
+            assert self.args.checkpoint_every % self.args.full_rescore_every == 0, (
+                "checkpoint_every should be a multiple of full_rescore_every"
+            )
+
+        if self.args.joint_colors:
+            assert not (checkpointing or extend_from or plan), "Joint colors only support plain runs"
+            assert not yield_residuals, "Joint colors share one RGB residual, so there are no per-color residuals"
+            yield from self.generate_colors_jointly(darkness)
+            print(f"Created canvas in {time.time() - t0:.2f} seconds")
+            return
+
+        if self.args.solver == "nnls":
+            assert not (checkpointing or extend_from or plan), "The 'nnls' solver only supports plain runs"
+            yield from self.generate_colors_nnls(mono_image_dict, darkness, yield_residuals)
+            print(f"Created canvas in {time.time() - t0:.2f} seconds")
+            return
+
+        if self.use_parallel_colors:
+            yield from self.generate_colors_concurrently(mono_image_dict, darkness, yield_residuals)
+            print(f"Created canvas in {time.time() - t0:.2f} seconds")
+            return
+
+        # Maybe replay an existing result which we're extending
+        lines_so_far = defaultdict(list)
+        starts = {}
+        if extend_from:
+            unknown_colors = set(map(tuple, extend_from)) - set(map(tuple, self.args.palette))
+            assert not unknown_colors, f"Colors {unknown_colors} in `extend_from` aren't in the palette"
+            for color_idx, color_tuple in enumerate(self.args.palette):
+                lines = extend_from.get(color_tuple, [])
+                if len(lines) == 0:
+                    continue
+                self.subtract_lines(mono_image_dict[color_tuple], lines, darkness[color_idx])
+                starts[color_idx] = (len(lines), self.get_next_node(lines[-1][1], len(lines)))
+                for i, j in lines:
+                    lines_so_far[color_tuple].append((i, j))
+                    yield (color_tuple, i, j, None) if yield_residuals else (color_tuple, i, j)
+
+        # Maybe restore the state from a checkpoint, and replay the lines we'd already drawn
+        checkpoint = None
+        if resume_from is not None:
+            checkpoint = self.load_checkpoint(resume_from)
+            mono_image_dict = checkpoint["m_images"]
+            self.residual_curves = {
+                color_tuple: list(curve) for color_tuple, curve in checkpoint["residual_curves"].items()
+            }
+            for color_tuple, lines in checkpoint["lines"].items():
+                for i, j in lines:
+                    lines_so_far[color_tuple].append((i, j))
+                    yield (color_tuple, i, j, None) if yield_residuals else (color_tuple, i, j)
+
+        pbar = tqdm(desc="Creating canvas", total=sum(n_lines_per_color))
+        for color_idx, color_tuple in enumerate(self.args.palette):
+            if checkpoint is not None and color_idx < checkpoint["color_idx"]:
+                pbar.update(n_lines_per_color[color_idx])
+                continue
+
+            # If we're resuming partway through this color, pick up the random state, position & residual curve from the
+            # checkpoint
+            start = starts.get(color_idx)
+            residual_history = None
+            if checkpoint is not None and color_idx == checkpoint["color_idx"]:
+                start = (checkpoint["n"], checkpoint["i"])
+                residual_history = self.residual_curves.get(color_tuple)
+                np.random.set_state(checkpoint["numpy_rng_state"])
+                t.set_rng_state(checkpoint["torch_rng_state"])
+                pbar.update(checkpoint["n"])
+
+            def checkpoint_fn(n: int, i: int, color_idx: int = color_idx) -> None:
+                self.save_checkpoint(self.args.checkpoint_path, color_idx, n, i, lines_so_far, mono_image_dict)
+
+            # With a time budget, this color gets its share (by number of lines) of whatever time is left
+            deadline = None
+            if plan is not None:
+                remaining_lines = sum(n_lines_per_color[color_idx:])
+                remaining_time = t0 + time_budget_s - time.time()
+                deadline = time.time() + remaining_time * n_lines_per_color[color_idx] / max(remaining_lines, 1)
+
+            pbar.set_postfix_str(f"Current color: {color_tuple}")
+            for event in self.generate_color_lines(
+                color_idx,
+                mono_image_dict[color_tuple],
+                darkness[color_idx],
+                start=start,
+                checkpoint_fn=checkpoint_fn if self.args.checkpoint_path is not None else None,
+                n_lines=n_lines_per_color[color_idx],
+                n_random_lines=plan["n_random_lines_used"] if plan else None,
+                deadline=deadline,
+                yield_residuals=yield_residuals,
+                residual_history=residual_history,
+            ):
+                lines_so_far[color_tuple].append(event[1:3])
+                yield event
+            pbar.update(n_lines_per_color[color_idx] - (start[0] if start else 0))
+
+        # Record what we traded off to fit within the time budget
+        if plan is not None:
+            self.time_budget_report = plan | dict(
+                elapsed_s=time.time() - t0,
+                n_lines_drawn=[len(lines_so_far[color_tuple]) for color_tuple in self.args.palette],
+                stopped_early=[
+                    color_tuple
+                    for color_idx, color_tuple in enumerate(self.args.palette)
+                    if len(lines_so_far[color_tuple]) < n_lines_per_color[color_idx]
+                ],
+            )
+            print(f"Time budget report: {self.time_budget_report}")
+
+        # If not verbose then we don't have a progress bar, just a single printout at the end
+        print(f"Created canvas in {time.time() - t0:.2f} seconds")
+        if isinstance(self.args.line_table, LazyLineTable):
+            print(f"Line cache stats: {self.args.line_table.cache_info()}")
+
+    def generate_color_lines(
+        self,
+        color_idx: int,
+        m_image: Tensor,
+        darkness: float,
+        rng: np.random.Generator | None = None,
+        generator: t.Generator | None = None,
+        stop: threading.Event | None = None,
+        start: tuple[int, int] | None = None,
+        checkpoint_fn: Callable[[int, int], None] | None = None,
+        n_lines: int | None = None,
+        n_random_lines: int | Literal["all"] | None = None,
+        deadline: float | None = None,
+        yield_residuals: bool = False,
+        residual_history: list[float] | None = None,
+    ) -> Generator:
+        """
+        Runs the greedy loop for a single color, subtracting lines from `m_image` in place and yielding
+        `(color_tuple, i, j)` for each line. By default we use the global numpy & torch random state; `rng` and
+        `generator` replace them (so colors can run concurrently without sharing random state). If `stop` is set, we
+        return early.
+
+        `start = (n, i)` means we've already drawn `n` lines of this color and are at node `i` (when resuming from a
+        checkpoint), and `checkpoint_fn(n, i)` is called every `checkpoint_every` lines.
+
+        `n_lines` and `n_random_lines` override the params (when we're fitting into a time budget), and if
+        `deadline` (a `time.time()` value) passes then we stop early.
+
+        If we're tracking the residual (see `ThreadArtColorParams.track_residual`), its curve is saved in
+        `residual_curves[color_tuple]`, and `yield_residuals` makes us yield `(color_tuple, i, j, residual)` instead.
+        When resuming, `residual_history` is that curve up to line `n` (from the checkpoint), which we carry on from.
+        """
+        rng = rng or np.random
+        color_tuple = self.args.palette[color_idx]
+        n_lines = self.args.n_lines_per_color[color_idx] if n_lines is None else n_lines
+        n_random_lines = n_random_lines or self.args.n_random_lines
+
+        # Choose starting node (i.e. the first node to draw a line from)
+        n_start, i = start or (0, int(rng.choice(self.args.d_joined.n_nodes)))
+
+        # Maybe keep track of the residual as we go (see `ThreadArtColorParams.track_residual`)
+        residual = None
+        if self.use_residual_tracking or yield_residuals:
+            residual = ResidualTracker(m_image, self.w, residual_history)
+            self.residual_curves[color_tuple] = residual.history
+
+        # Maybe set up the running line scores for this color (see `ThreadArtColorParams.incremental_scores`)
+        line_scores = None
+        if self.use_incremental_scores and n_random_lines == "all" and n_lines > 0:
+            line_scores = LineScores(self.args.line_table, m_image, darkness, self.args.neg_penalty_multiplier, self.w)
+
+        # ... or something which chooses lines without scoring all of them (see `ThreadArtColorParams.lazy_greedy` and
+        # `full_rescore_every`). These capture `m_image` (which is modified in place), so they always score lines
+        # against the current image.
+        selector = None
+        score_fn = partial(self.get_line_scores, m_image, darkness=darkness)
+        if n_random_lines == "all" and line_scores is None:
+            if self.use_lazy_greedy:
+                selector = LazyGreedySelector(score_fn)
+            elif self.use_periodic_rescore:
+                selector = PeriodicRescorer(
+                    self.incidence,
+                    m_image,
+                    darkness,
+                    self.args.neg_penalty_multiplier,
+                    score_fn,
+                    self.args.n_nodes,
+                    every=self.args.full_rescore_every,
+                    top_k=self.args.top_k_rescore,
+                )
+
+        for n in range(n_start, n_lines):  # range(n_lines): #, leave=False):
+            if stop is not None and stop.is_set():
+                return
+            if deadline is not None and time.time() > deadline:
+                print(f"Ran out of time for {color_tuple}, stopping after {n}/{n_lines} lines")
+                return
+            if checkpoint_fn is not None and n > n_start and n % self.args.checkpoint_every == 0:
+                checkpoint_fn(n, i)
+
+            # Choose and add line
+            j = self.choose_and_subtract_best_line(
+                m_image=m_image,
+                i=i,
+                darkness=darkness,
+                line_scores=line_scores,
+                selector=selector,
+                rng=rng,
+                generator=generator,
+                n_random_lines=n_random_lines,
+                residual=residual,
+            )
+            if residual is None:
+                yield color_tuple, i, j
+            else:
+                residual.record()
+                yield (color_tuple, i, j, residual.total) if yield_residuals else (color_tuple, i, j)
+
+            i = self.get_next_node(j, n + 1, generator)
+
+            # Stop this color if the last few lines haven't helped much
+            if residual is not None and residual.has_converged(self.args.early_stop_window, self.args.early_stop_tol):
+                print(f"Residual for {color_tuple} converged, stopping after {n + 1}/{n_lines} lines")
+                return
+
+        if isinstance(selector, LazyGreedySelector):
+            print(f"Lazy greedy stats for {color_tuple}: {selector.info()}")
+
+    def plan_time_budget(
+        self,
+        time_budget_s: float,
+        t0: float,
+        mono_image_dict: dict[tuple, Tensor],
+        darkness: list[float],
+        n_calibration_lines: int = 10,
+        calibration_frac: float = 0.02,
+        safety_factor: float = 0.8,
+    ) -> dict:
+        """
+        Decides how to fit `create_canvas_generator` into `time_budget_s` (which started at `t0`). We time a few steps
+        of `generate_color_lines` on a copy of the first image (at least 2 blocks of `n_calibration_lines`, and at least
+        `calibration_frac` of the budget), so we measure the scoring path the run will actually use (e.g. incremental
+        scores or lazy greedy), as a fixed cost per color (setting that path up) plus a cost per line. Timing a few
+        steps is noisy, and it's better to finish early than to run out of time, so we use the slowest block. If that's
+        too slow, we try scoring fewer random lines per step (down to a floor of 10% of the candidates, or 10 lines),
+        which means scoring from scratch: we time that at 2 different numbers of candidates to get a fixed cost per step
+        plus a cost per candidate. If that's still too slow, we scale down the number of lines per color. Returns what
+        we decided (which becomes `time_budget_report`).
+        """
+        n_lines_requested = list(self.args.n_lines_per_color)
+        total_lines = sum(n_lines_requested)
+        n_colors = sum(n > 0 for n in n_lines_requested)
+        mean_degree = float(self.args.d_joined.degrees.mean())
+        requested = self.args.n_random_lines
+        n_candidates = mean_degree if requested == "all" else min(requested, mean_degree)
+        plan = dict(
+            time_budget_s=time_budget_s,
+            n_random_lines_requested=requested,
+            n_random_lines_used=requested,
+            n_lines_requested=n_lines_requested,
+            n_lines_planned=n_lines_requested,
+        )
+        if total_lines == 0:
+            return plan
+
+        color_idx = next(idx for idx, n in enumerate(n_lines_requested) if n > 0)
+
+        # We time every step after the first (which includes the setup) in blocks of `n_calibration_lines`, and with
+        # periodic rescoring, each block needs to include one of the full rescores
+        n_calibration_lines = max(n_calibration_lines, self.args.full_rescore_every if self.use_periodic_rescore else 1)
+
+        def calibrate(n_random_lines: int | None = None) -> tuple[float, float]:
+            # Returns the fixed cost per color & the cost per line (timing on a copy, so we don't change the real image)
+            m_image = mono_image_dict[self.args.palette[color_idx]].clone()
+            times = [time.time()]
+            for _ in self.generate_color_lines(
+                color_idx,
+                m_image,
+                darkness[color_idx],
+                n_lines=max(n_lines_requested[color_idx], 2 * n_calibration_lines) + 1,
+                n_random_lines=n_random_lines,
+            ):
+                times.append(time.time())
+                n_blocks, n_left = divmod(len(times) - 2, n_calibration_lines)
+                if n_left == 0 and n_blocks >= 2 and times[-1] - times[1] >= calibration_frac * time_budget_s:
+                    break
+            block_times = np.diff(times[1::n_calibration_lines])
+            if len(block_times) > 0:
+                line_cost = block_times.max() / n_calibration_lines
+            else:
+                line_cost = (times[-1] - times[1]) / max(len(times) - 2, 1)
+            return max(times[1] - times[0] - line_cost, 0.0), line_cost
+
+        def time_per_line(setup_cost: float) -> float:
+            # How long each line can take, given what's left of the budget
+            return (safety_factor * (time_budget_s - (time.time() - t0)) - n_colors * setup_cost) / total_lines
+
+        setup_cost, line_cost = calibrate()
+        if line_cost <= time_per_line(setup_cost):
+            return plan
+
+        # First, score fewer lines per step (if we can). The fast paths need every line, so this means scoring from
+        # scratch, which costs `step_cost + candidate_cost * n_random_lines` per line.
+        min_candidates = int(min(n_candidates, max(10, 0.1 * mean_degree)))
+        max_candidates = int(n_candidates)
+        if min_candidates < max_candidates:
+            uses_fast_path = requested == "all" and (
+                self.use_incremental_scores or self.use_lazy_greedy or self.use_periodic_rescore
+            )
+            scratch_setup_cost, min_cost = calibrate(min_candidates)
+            max_cost = calibrate(max_candidates)[1] if uses_fast_path else line_cost
+            candidate_cost = max(max_cost - min_cost, 1e-9) / (max_candidates - min_candidates)
+            step_cost = max(min_cost - candidate_cost * min_candidates, 0.0)
+            affordable_candidates = (time_per_line(scratch_setup_cost) - step_cost) / candidate_cost
+            n_random_lines_used = int(np.clip(affordable_candidates, min_candidates, max_candidates))
+            # Timing a few steps is noisy, so we check the cost we extrapolated by timing `n_random_lines_used` itself
+            scratch_line_cost = step_cost + candidate_cost * n_random_lines_used
+            if min_candidates < n_random_lines_used < max_candidates:
+                scratch_line_cost = max(scratch_line_cost, calibrate(n_random_lines_used)[1])
+            if scratch_line_cost < line_cost:
+                plan["n_random_lines_used"] = n_random_lines_used
+                setup_cost, line_cost = scratch_setup_cost, scratch_line_cost
+
+        # Then, if we still can't afford it, draw fewer lines
+        scale = float(np.clip(time_per_line(setup_cost) / line_cost, 0.0, 1.0)) if line_cost > 0 else 1.0
+        plan["n_lines_planned"] = (np.array(n_lines_requested) * scale).astype(int).tolist()
+
+        return plan
+
+    def get_next_node(self, j: int, n_drawn: int, generator: t.Generator | None = None) -> int:
+        """
+        Returns the node we draw the next line from, after drawing `n_drawn` lines of this color (the last one ending
+        at node `j`).
+        """
+        # Get the outgoing node
+        i = (j + 1 if (j % 2 == 0) else j - 1) if self.args.flip_hook_parity else j
+
+        # Maybe jump randomly to a non-consecutive node, for svg security
+        if self.args.n_consecutive != 0 and (n_drawn % self.args.n_consecutive) == 0:
+            i = t.randint(0, self.args.d_joined.n_nodes, (1,), generator=generator).item()
+
+        return i
+
+    def subtract_lines(self, m_image: Tensor, lines: list[tuple[int, int]], darkness: float) -> None:
+        """
+        Vectorized version of calling `subtract_line` for each of `lines`: a single scatter-add into the image. Like
+        `subtract_line`, a line which hits the same pixel twice only subtracts from it once (but a line which is drawn
+        twice subtracts twice).
+        """
+        _, pixels, amounts = self.get_line_amounts(lines, darkness, m_image.numel())
+        m_image.view(-1).index_add_(0, pixels, -amounts.to(m_image.dtype))
+
+    def get_line_amounts(
+        self, lines: list[tuple[int, int]], darkness: float, n_pixels: int
+    ) -> tuple[Int[Tensor, "n"], Int[Tensor, "n"], Float[Tensor, "n"]]:
+        """
+        Returns `(occurrence_ids, pixels, amounts)`: how much each of `lines` subtracts from each (linear) pixel, where
+        `occurrence_ids` is the position in `lines`. Each (occurrence, pixel) pair only appears once.
+        """
+        lines_array = np.array(lines, dtype=np.int64).reshape(-1, 2)
+        line_idx = t.from_numpy(pair_to_index_np(lines_array[:, 0], lines_array[:, 1], self.args.n_nodes))
+        pixels, occurrence_ids, _, coverage = self.args.line_table.get_lines(line_idx)
+
+        # Deduplicate (occurrence, pixel) pairs, keeping the first of each (which is the one whose coverage we use)
+        keys = occurrence_ids * n_pixels + pixels.long()
+        unique_keys, inverse = t.unique(keys, return_inverse=True)
+        first = t.full((unique_keys.size(0),), keys.size(0), dtype=t.int64)
+        first.scatter_reduce_(0, inverse, t.arange(keys.size(0)), reduce="amin")
+
+        amounts = t.full((unique_keys.size(0),), darkness) if coverage is None else darkness * coverage[first]
+        return unique_keys // n_pixels, unique_keys % n_pixels, amounts
+
+    def save_checkpoint(
+        self,
+        path: str | Path,
+        color_idx: int,
+        n: int,
+        i: int,
+        lines: dict[tuple, list[tuple[int, int]]],
+        mono_image_dict: dict[tuple, Tensor],
+    ) -> None:
+        """
+        Saves everything we need to carry on generating from line `n` of color `color_idx` (at node `i`). We write to a
+        temporary file first and then rename it, so a crash while saving never leaves a half-written checkpoint.
+        """
+        checkpoint = dict(
+            params=self.get_checkpoint_params(),
+            color_idx=color_idx,
+            n=n,
+            i=i,
+            lines={color_tuple: list(color_lines) for color_tuple, color_lines in lines.items()},
+            m_images={color_tuple: m_image.clone() for color_tuple, m_image in mono_image_dict.items()},
+            residual_curves={color_tuple: list(curve) for color_tuple, curve in self.residual_curves.items()},
+            numpy_rng_state=np.random.get_state(),
+            torch_rng_state=t.get_rng_state(),
+        )
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        t.save(checkpoint, tmp_path)
+        os.replace(tmp_path, path)
+
+    def load_checkpoint(self, path: str | Path) -> dict:
+        checkpoint = t.load(path, weights_only=False)  # contains the numpy random state, which isn't a tensor
+        params = self.get_checkpoint_params()
+        changed = sorted(
+            k for k in params.keys() | checkpoint["params"].keys() if params.get(k) != checkpoint["params"].get(k)
+        )
+        assert not changed, f"Checkpoint was saved with different params: {changed}"
+        return checkpoint
+
+    def get_checkpoint_params(self) -> dict:
+        """
+        The params which change the lines we generate, used to check a checkpoint matches this `Img`. This is every
+        field of `ThreadArtColorParams` except `CHECKPOINT_IGNORED_PARAMS`, plus `y` (set from the image's aspect ratio)
+        and a hash of `image` (which is all we have if there's no filename).
+        """
+        params = {
+            f.name: getattr(self.args, f.name) for f in fields(self.args) if f.name not in CHECKPOINT_IGNORED_PARAMS
+        }
+        params["palette"] = [tuple(color) for color in self.args.palette]
+        params["y"] = self.args.y
+        params["image_hash"] = hashlib.sha1(self.args.image.tobytes()).hexdigest()
+        return params
+
+    def generate_colors_concurrently(
+        self, mono_image_dict: dict[tuple, Tensor], darkness: list[float], yield_residuals: bool = False
+    ) -> Generator:
+        """
+        Runs `generate_color_lines` for every color in a thread pool, and yields the lines from all of them as they
+        arrive (so lines of different colors are interleaved, but each color's lines are in order). Torch ops release
+        the GIL, and we pin torch to 1 thread per op so the workers don't fight over cores.
+
+        Each color's random state is spawned from `seed`, so the lines for each color are deterministic regardless of
+        how the threads get scheduled.
+        """
+        palette = self.args.palette
+        seeds = np.random.SeedSequence(self.args.seed).spawn(len(palette))
+        events = queue.Queue()
+        stop = threading.Event()
+        done = object()  # each worker puts this on the queue when it finishes (or fails)
+
+        def worker(color_idx: int) -> None:
+            rng = np.random.default_rng(seeds[color_idx])
+            generator = t.Generator().manual_seed(int(seeds[color_idx].generate_state(1)[0]))
+            try:
+                m_image = mono_image_dict[palette[color_idx]]
+                for event in self.generate_color_lines(
+                    color_idx, m_image, darkness[color_idx], rng, generator, stop, yield_residuals=yield_residuals
+                ):
+                    events.put(event)
+            finally:
+                events.put(done)
+
+        n_threads = t.get_num_threads()
+        t.set_num_threads(1)
+        executor = ThreadPoolExecutor(max_workers=min(self.args.n_color_workers, len(palette)))
         pbar = tqdm(desc="Creating canvas", total=sum(self.args.n_lines_per_color))
+        try:
+            futures = [executor.submit(worker, color_idx) for color_idx in range(len(palette))]
+            n_done = 0
+            while n_done < len(palette):
+                event = events.get()
+                if event is done:
+                    n_done += 1
+                    continue
+                pbar.update(1)
+                yield event
+            # Re-raise any errors from the workers
+            for future in futures:
+                future.result()
+        finally:
+            # If the caller stops iterating early, this makes the workers return rather than finishing their colors
+            stop.set()
+            executor.shutdown(wait=True)
+            t.set_num_threads(n_threads)
+
+    def generate_colors_jointly(self, darkness: list[float]) -> Generator:
+        """
+        Draws every color at once against a single RGB residual (see `ThreadArtColorParams.joint_colors`). We model the
+        canvas as white minus `darkness * coverage * (1 - color / 255)` for every line, so the residual starts as
+        `1 - target / 255`. Drawing a line of color c (with darkening vector `a = 1 - color / 255`) changes the squared
+        error of each pixel by `-2 * d * (residual . a) + (d * |a|) ** 2`, so we score lines by the (weighted) mean of
+        `residual . a - d * |a| ** 2 / 2` along them: positive means the line reduces the error.
+        """
+        rng = np.random
+        d_joined = self.args.d_joined
+        palette = self.args.palette
+        assert self.args.critical_frac_penalty_power_decay is None, "Joint colors don't support the random penalty"
+
+        residual = (1 - self.imageRGB.float() / 255).reshape(-1, 3)  # [pixels 3]
+        w_flat = None if self.w is None else self.w.reshape(-1).float()
+        directions = 1 - t.tensor(palette, dtype=t.float32) / 255  # [colors 3]
+        darkness_per_color = t.tensor(darkness, dtype=t.float32)
+        offsets = darkness_per_color * (directions**2).sum(-1) / 2  # [colors]
+
+        # White (or anything with zero darkness) can't reduce the residual, so it's never active
+        n_drawn = [0] * len(palette)
+        active = [
+            self.args.n_lines_per_color[c] > 0 and offsets[c] > 0 and darkness[c] > 0 for c in range(len(palette))
+        ]
+        nodes = [int(rng.choice(d_joined.n_nodes)) for _ in palette]
+
+        pbar = tqdm(desc="Creating canvas (joint colors)", total=sum(self.args.n_lines_per_color))
+        while any(active):
+            # Choose the candidates for every active color, and score them all in a single batch
+            colors = [c for c in range(len(palette)) if active[c]]
+            j_choices = []
+            for c in colors:
+                i = nodes[c]
+                if self.args.n_random_lines == "all" or self.args.n_random_lines > len(d_joined[i]):
+                    j_choices.append(d_joined.neighbours(i))
+                else:
+                    j_choices.append(t.from_numpy(rng.choice(d_joined[i], self.args.n_random_lines, replace=False)))
+            n_candidates = t.tensor([choices.size(0) for choices in j_choices])
+            line_idx = t.cat(
+                [pair_to_index(nodes[c], choices, self.args.n_nodes) for c, choices in zip(colors, j_choices)]
+            )
+            line_colors = t.repeat_interleave(t.tensor(colors), n_candidates)  # [lines]
+
+            pixels, line_ids, _, coverage = self.args.line_table.get_lines(line_idx)
+            pixel_colors = line_colors[line_ids]
+            pixel_weights = t.ones(pixels.size(0)) if coverage is None else coverage.float()
+            values = (residual[pixels] * directions[pixel_colors]).sum(-1) - pixel_weights * offsets[pixel_colors]
+            if w_flat is not None:
+                pixel_weights = pixel_weights * w_flat[pixels]
+            totals = t.zeros(line_idx.size(0)).index_add_(0, line_ids, values * pixel_weights)
+            scores = totals / t.zeros(line_idx.size(0)).index_add_(0, line_ids, pixel_weights)
+            scores = scores.masked_fill(scores.isnan(), float("-inf"))  # lines with no weight (see `score_lines`)
+
+            # Pick the best line for each color (from the same residual), then draw them all
+            for c, color_scores, choices in zip(colors, scores.split(n_candidates.tolist()), j_choices):
+                best = color_scores.argmax()
+                if not color_scores[best] > 0:
+                    active[c] = False
+                    pbar.update(self.args.n_lines_per_color[c] - n_drawn[c])
+                    continue
+                i, j = nodes[c], choices[best].item()
+                best_idx = pair_to_index(i, j, self.args.n_nodes)
+                line_pixels = self.args.line_table.get_line(best_idx)
+                line_coverage = self.args.line_table.get_line_weights(best_idx)
+                amounts = darkness[c] if line_coverage is None else darkness[c] * line_coverage[:, None]
+                residual[line_pixels] -= amounts * directions[c]
+                yield palette[c], i, j
+
+                n_drawn[c] += 1
+                pbar.update(1)
+                nodes[c] = self.get_next_node(j, n_drawn[c])
+                if n_drawn[c] == self.args.n_lines_per_color[c]:
+                    active[c] = False
+
+        print(f"Lines drawn per color: {dict(zip(palette, n_drawn))}")
+
+    def generate_colors_nnls(
+        self, mono_image_dict: dict[tuple, Tensor], darkness: list[float], yield_residuals: bool = False
+    ) -> Generator:
+        """
+        Alternative to `generate_color_lines` for every color (see `ThreadArtColorParams.solver`). We solve for each
+        color's line multiplicities, round them, and join them into a thread path (with connector lines chosen by how
+        much darkness they'd still draw), so that the path has at most `n_lines_per_color` lines including the
+        connectors. The path is yielded in the same `(color_tuple, i, j)` format as the greedy loop.
+        """
+        n_pixels = next(iter(mono_image_dict.values())).numel()
+        incidence = LineIncidence.from_line_table(self.args.line_table, n_pixels)  # unweighted, `w` is in the solve
+        d_joined = self.args.d_joined
+        joined = np.zeros((d_joined.n_nodes, d_joined.n_nodes), dtype=bool)
+        joined[np.repeat(np.arange(d_joined.n_nodes), d_joined.degrees), d_joined.indices] = True
+
         for color_idx, color_tuple in enumerate(self.args.palette):
-            # Setup variables (including the place we'll start)
             n_lines = self.args.n_lines_per_color[color_idx]
+            if n_lines == 0:
+                continue
             m_image = mono_image_dict[color_tuple]
+            t0 = time.time()
+            x = solve_multiplicities(
+                incidence, m_image, darkness[color_idx], self.w, self.args.nnls_iters, max_total=n_lines
+            )
 
-            pbar.set_postfix_str(f"Current color: {color_tuple}")
+            # The connector lines count towards `n_lines` too, so we search for the largest budget (for the lines we
+            # round from `x`) whose path fits. `lo` is the largest budget known to fit (0 always does, since an empty
+            # set of lines needs no connectors) and `hi` is the smallest known not to. We guess the next budget from
+            # the overflow (since the number of connectors barely changes with the budget), but never below halfway.
+            lo, hi, budget = 0, n_lines + 1, n_lines
+            lines, n_connectors, n_jumps = [], 0, 0
+            while hi - lo > 1:
+                counts = round_multiplicities(x, budget)
+                line_idx = t.repeat_interleave(t.arange(counts.size(0)), counts)
+                i_array, j_array = index_to_pair(line_idx, self.args.n_nodes)
+                line_scores = residual_line_scores(
+                    incidence, counts, m_image, darkness[color_idx], self.args.n_nodes, self.w
+                )
+                path, path_connectors, path_jumps = lines_to_path(
+                    list(zip(i_array.tolist(), j_array.tolist())), joined, self.args.flip_hook_parity, line_scores
+                )
+                if len(path) <= n_lines:
+                    lo, (lines, n_connectors, n_jumps) = budget, (path, path_connectors, path_jumps)
+                    budget = (lo + hi) // 2
+                else:
+                    hi = budget
+                    budget = min(max(budget - (len(path) - n_lines), (lo + hi) // 2), hi - 1)
+            print(
+                f"Solved {color_tuple} in {time.time() - t0:.2f} seconds: {len(lines) - n_connectors} lines + "
+                f"{n_connectors} connectors, with {n_jumps} jumps where the thread path isn't continuous"
+            )
 
-            # Choose starting node (i.e. the first node to draw a line from)
-            i = np.random.choice(list(self.args.d_joined.keys())).item()
+            # Maybe keep track of the residual, by subtracting the lines in path order
+            residual = None
+            if self.use_residual_tracking or yield_residuals:
+                residual = ResidualTracker(m_image, self.w)
+                self.residual_curves[color_tuple] = residual.history
+            for i, j in lines:
+                if residual is None:
+                    yield color_tuple, i, j
+                    continue
+                self.subtract_line(m_image, i, j, darkness[color_idx], residual=residual)
+                residual.record()
+                yield (color_tuple, i, j, residual.total) if yield_residuals else (color_tuple, i, j)
 
-            for n in range(n_lines):  # range(n_lines): #, leave=False):
-                # Choose and add line
-                j = self.choose_and_subtract_best_line(m_image=m_image, i=i, darkness=darkness[color_idx])
-                yield color_tuple, i, j
+    @property
+    def use_parallel_colors(self) -> bool:
+        return (
+            self.args.n_color_workers > 1
+            and len(self.args.palette) > 1
+            and not isinstance(self.args.line_table, LazyLineTable)  # its LRU cache isn't thread-safe
+        )
 
-                # Get the outgoing node
-                i = (j + 1 if (j % 2 == 0) else j - 1) if self.args.flip_hook_parity else j
+    @property
+    def use_incremental_scores(self) -> bool:
+        return (
+            self.args.incremental_scores
+            and self.args.n_random_lines == "all"
+            and isinstance(self.args.line_table, LineTable)
+            and self.args.line_table.pixel_index is not None
+        )
 
-                # Maybe jump randomly to a non-consecutive node, for svg security
-                if self.args.n_consecutive != 0 and ((n + 1) % self.args.n_consecutive) == 0:
-                    i = list(self.args.d_joined.keys())[t.randint(0, len(self.args.d_joined), (1,))]
+    @property
+    def use_periodic_rescore(self) -> bool:
+        return (
+            self.args.full_rescore_every > 0
+            and self.args.n_random_lines == "all"
+            and self.args.critical_frac_penalty_power_decay is None
+            and isinstance(self.args.line_table, LineTable)
+        )
 
-            # Update progress bar
-            pbar.update(n_lines)
+    @property
+    def use_residual_tracking(self) -> bool:
+        return self.args.track_residual or self.args.early_stop_window > 0
 
-        # If not verbose then we don't have a progress bar, just a single printout at the end
-        print(f"Created canvas in {time.time() - t0:.2f} seconds")
+    @property
+    def use_lazy_greedy(self) -> bool:
+        return (
+            self.args.lazy_greedy
+            and self.args.n_random_lines == "all"
+            and self.args.critical_frac_penalty_power_decay is None
+        )
 
     # Generates a bunch of random lines and chooses the best one
-    def choose_and_subtract_best_line(self, m_image: Tensor, i: int, darkness: float) -> int:
+    def choose_and_subtract_best_line(
+        self,
+        m_image: Tensor,
+        i: int,
+        darkness: float,
+        line_scores: LineScores | None = None,
+        selector: LazyGreedySelector | PeriodicRescorer | None = None,
+        rng: np.random.Generator | None = None,
+        generator: t.Generator | None = None,
+        n_random_lines: int | Literal["all"] | None = None,
+        residual: ResidualTracker | None = None,
+    ) -> int:
         """
-        Generates a bunch of random lines (choosing them from `d_joined` which is a dictionary mapping node ints to all the
+        Generates a bunch of random lines (choosing them from `d_joined`, the CSR adjacency mapping node ints to all the
         nodes they're connected to), picks the best line, subtracts its darkness from the image, and returns that line.
+
+        If `line_scores` is given, we read the scores from there rather than computing them (and update it after
+        subtracting the line). If `selector` is given, we let it choose the line (it only re-scores a few lines).
+        `rng` and `generator` replace the global numpy & torch random state (see `generate_color_lines`), and
+        `n_random_lines` overrides the param. If `residual` is given, we update it after subtracting the line.
         """
-        w = self.w
-        n_random_lines = self.args.n_random_lines
-        neg_penalty_multiplier = self.args.neg_penalty_multiplier
+        rng = rng or np.random
+        n_random_lines = n_random_lines or self.args.n_random_lines
         d_joined = self.args.d_joined
-        t_pixels = self.args.t_pixels
         n_nodes = self.args.n_nodes
-        critical_fracs = self.args.critical_fracs
         critical_frac_penalty_power_decay = self.args.critical_frac_penalty_power_decay
 
         # Choose `j` random lines (or as many as possible)
         if n_random_lines == "all" or n_random_lines > len(d_joined[i]):
-            j_choices = t.tensor(d_joined[i]).long()
+            j_choices = d_joined.neighbours(i)  # int32 view, no copy
         else:
-            j_choices = t.from_numpy(
-                np.random.choice(d_joined[i], min(len(d_joined[i]), n_random_lines), replace=False)
-            ).long()
+            j_choices = t.from_numpy(rng.choice(d_joined[i], min(len(d_joined[i]), n_random_lines), replace=False))
         n_lines = j_choices.size(0)
 
-        # Get the pixels in the line, and rearrange it
-        coords_yx = t_pixels[pair_to_index(i, j_choices, n_nodes)].int()  # [n_lines 2 pixels]
-        is_zero = (coords_yx == 0).all(dim=1)  # [n_lines pixels]
-        coords_yx = einops.rearrange(coords_yx, "j yx pixels -> yx (j pixels)")  # [2 n_lines*pixels]
-
-        # Get the pixels in the line, and reshape it back to [n_lines, pixels]
-        pixel_values = m_image[coords_yx[0], coords_yx[1]]  # [n_lines*pixels]
-        pixel_values = einops.rearrange(pixel_values, "(j pixels) -> j pixels", j=n_lines).masked_fill(is_zero, 0)
-
-        # If any of our pixels are less than the darkness, and if neg_penalty_multiplier > 0, then we decrease their scores.
-        # The amount they're decreased by equals the negative values they'll have after subtracting the darkness, scaled by
-        # the neg_penalty_multiplier (e.g. if value is 0.2, darkness is 0.5, multiplier is 0.5, then we would decrease the
-        # score by 0.5 * (0.5 - 0.2) = 0.15 to reflect how we're de-incentivising pushing into negative values).
-        assert neg_penalty_multiplier >= 0, "Negative penalty multiplier must be non-negative"
-        if neg_penalty_multiplier > 1e-6:
-            pixel_values -= neg_penalty_multiplier * (darkness - pixel_values).clamp(min=0.0)
-
-        # Optionally index & rearrange the weighting, in the same way as the pixels
-        lengths = (~is_zero).sum(-1).float()  # [n_lines]
-
-        if isinstance(w, Tensor):
-            w_pixel_values = w[coords_yx[0], coords_yx[1]]
-            w_pixel_values = einops.rearrange(w_pixel_values, "(j pixels) -> j pixels", j=n_lines).masked_fill(
-                is_zero, 0
-            )
-            w_sum = w_pixel_values.sum(dim=-1)  # [n_lines]
-            scores = (pixel_values * w_pixel_values).sum(-1) / w_sum  # [n_lines]
+        if selector is not None:
+            best_j = selector.choose(i, j_choices)
+            self.subtract_line(m_image, i, best_j, darkness, residual=residual)
+            return best_j
+
+        if line_scores is not None:
+            line_idx = pair_to_index(i, j_choices, n_nodes)
+            scores = line_scores.get_scores(line_idx)
+            if self.line_padding is not None:
+                scores = scores - self.args.neg_penalty_multiplier * darkness * self.line_padding[line_idx]
         else:
-            scores = pixel_values.sum(-1) / lengths  # [n_lines]
+            scores = self.get_line_scores(m_image, i, j_choices, darkness)
 
         # Add penalties to the scores for short lines. For example, if we aren't allowing clockwise lines of length 20,
         # then we apply a probabilistic filter to lines of length between 20 and 20 * 2 = 40. This gives us a smooth
         # gradient of lines from length 20 to 30, rather than a bunch of lines at 20 creating a radial effect. Note that
         # we deal with clockwise and anticlockwise differently, because they have different thresholds.
         if critical_frac_penalty_power_decay is not None:
-            assert critical_frac_penalty_power_decay > 0.0, "Power decay penalty must be in (0, 1] range"
-
-            if self.args.shape == "Rectangle":
-                raise NotImplementedError()
-                # n_nodes_on_adj_side = nodes_per_side_list[(i_side + 1) % 4]
-                # ac_corner = starting_idx_list[(i_side + 1) % 4]  # node at the corner anticlockwise to `i`
-                # c_corner = starting_idx_list[i_side]  # node at the corner clockwise to `i`
-                # assert c_corner <= i < (ac_corner or n4), f"Error: {c_corner=}, {i=}, {ac_corner=}"
-
-                # banned_anticlockwise = range(
-                #     ac_corner, ac_corner + min(n_nodes_on_adj_side, int((ac_corner - i) * critical_fracs[i % 2]))
-                # )
-                # banned_clockwise = range(
-                #     c_corner - min(n_nodes_on_adj_side, int((i - c_corner) * critical_fracs[1 - i % 2])), c_corner
-                # )
-                # d_joined[i] = sorted(set(d_joined[i]) - set(banned_anticlockwise) - set(banned_clockwise))
+            if self.line_penalties is not None:
+                line_idx = pair_to_index(i, j_choices, n_nodes)
+                penalty = self.line_penalties[(i > j_choices).long(), line_idx]
             else:
-                critical_frac_ac, critical_frac_c = critical_fracs[::-1] if i % 2 == 1 else critical_fracs
-                diff_angles_ac = (j_choices - i) % n_nodes / n_nodes  # in range [critical_frac_ac, 1]
-                diff_angles_c = (i - j_choices) % n_nodes / n_nodes  # in range [critical_frac_c, 1]
-
-            assert diff_angles_ac.min() >= critical_frac_ac, f"Error: {diff_angles_ac.min()} < {critical_frac_ac}"
-            assert diff_angles_c.min() >= critical_frac_c, f"Error: {diff_angles_c.min()} < {critical_frac_c}"
-
-            # penalty_ac should be 1.0 at critical_frac_ac, and 0.0 at 2 * critical_frac_ac
-            penalty_ac = t.clamp((2 * critical_frac_ac - diff_angles_ac) / critical_frac_ac, min=0.0, max=1.0)
-            penalty_c = t.clamp((2 * critical_frac_c - diff_angles_c) / critical_frac_c, min=0.0, max=1.0)
-            assert not ((penalty_ac > 0) & (penalty_c > 0)).any(), (
-                "penalty_ac and penalty_c overlap on nonzero elements"
-            )
+                penalty = self.get_critical_frac_penalties(i, j_choices)
             # Now we use these penalties to maybe replace the scores with neginf, removing those lines from consideration
-            penalty = (penalty_ac + penalty_c) ** critical_frac_penalty_power_decay
-            scores -= 1e4 * (t.rand(size=(n_lines,)) < penalty).float()
+            scores -= 1e4 * (t.rand(size=(n_lines,), generator=generator) < penalty).float()
 
         # Now choose the best remaining option!
         best_j = j_choices[scores.argmax()].item()
-
-        coords_yx = t_pixels[pair_to_index(i, best_j, n_nodes)].int()  # [yx=2 pixels]
-        is_zero = coords_yx.sum(0) == 0  # [pixels]
-        coords_yx = coords_yx[:, ~is_zero]
-        m_image[coords_yx[0], coords_yx[1]] -= darkness
+        self.subtract_line(m_image, i, best_j, darkness, line_scores, residual)
 
         return best_j
 
+    def get_critical_frac_penalties(
+        self, i: int | Int[Tensor, "batch"], j: Int[Tensor, "batch"]
+    ) -> Float[Tensor, "batch"]:
+        """
+        Returns the probability of banning each line from `i` to `j` (see `critical_frac_penalty_power_decay`). This
+        only depends on the nodes, so we usually precompute it for every line (see `precompute_line_arrays`).
+        """
+        critical_fracs = self.args.critical_fracs
+        n_nodes = self.args.n_nodes
+        critical_frac_penalty_power_decay = self.args.critical_frac_penalty_power_decay
+        assert critical_frac_penalty_power_decay > 0.0, "Power decay penalty must be in (0, 1] range"
+
+        if self.args.shape == "Rectangle":
+            raise NotImplementedError()
+            # n_nodes_on_adj_side = nodes_per_side_list[(i_side + 1) % 4]
+            # ac_corner = starting_idx_list[(i_side + 1) % 4]  # node at the corner anticlockwise to `i`
+            # c_corner = starting_idx_list[i_side]  # node at the corner clockwise to `i`
+            # assert c_corner <= i < (ac_corner or n4), f"Error: {c_corner=}, {i=}, {ac_corner=}"
+
+            # banned_anticlockwise = range(
+            #     ac_corner, ac_corner + min(n_nodes_on_adj_side, int((ac_corner - i) * critical_fracs[i % 2]))
+            # )
+            # banned_clockwise = range(
+            #     c_corner - min(n_nodes_on_adj_side, int((i - c_corner) * critical_fracs[1 - i % 2])), c_corner
+            # )
+            # d_joined[i] = sorted(set(d_joined[i]) - set(banned_anticlockwise) - set(banned_clockwise))
+        else:
+            # `i` can be a tensor too, so we pick each line's fracs based on the parity of its `i`
+            odd = t.as_tensor(i) % 2 == 1
+            critical_frac_ac = t.where(odd, critical_fracs[1], critical_fracs[0])
+            critical_frac_c = t.where(odd, critical_fracs[0], critical_fracs[1])
+            diff_angles_ac = (j - i) % n_nodes / n_nodes  # in range [critical_frac_ac, 1]
+            diff_angles_c = (i - j) % n_nodes / n_nodes  # in range [critical_frac_c, 1]
+
+        assert (diff_angles_ac >= critical_frac_ac).all(), "Some lines are shorter than critical_frac_ac"
+        assert (diff_angles_c >= critical_frac_c).all(), "Some lines are shorter than critical_frac_c"
+
+        # penalty_ac should be 1.0 at critical_frac_ac, and 0.0 at 2 * critical_frac_ac
+        penalty_ac = t.clamp((2 * critical_frac_ac - diff_angles_ac) / critical_frac_ac, min=0.0, max=1.0)
+        penalty_c = t.clamp((2 * critical_frac_c - diff_angles_c) / critical_frac_c, min=0.0, max=1.0)
+        assert not ((penalty_ac > 0) & (penalty_c > 0)).any(), "penalty_ac and penalty_c overlap on nonzero elements"
+        return (penalty_ac + penalty_c) ** critical_frac_penalty_power_decay
+
+    def precompute_line_arrays(self) -> None:
+        """
+        Precomputes the parts of each line's score which never change during a run, indexed by `pair_to_index`:
+
+            - `line_denominators`, the weight sum of each line (only when there's a weighting `w` or coverage, since
+              otherwise the denominator is the line length, which we get for free from the line table's offsets)
+            - `line_penalties`, the critical frac penalty of each line (if `critical_frac_penalty_power_decay` is set).
+              The penalty depends on which end we start from, so row 0 is for lines from the smaller node, and row 1
+              from the larger one.
+            - `line_padding`, the amount of padding each line used to have as a fraction of its length (only if
+              `legacy_padding_penalty` is set, and there's no weighting `w`), which we multiply by
+              `neg_penalty_multiplier * darkness` and subtract from the scores.
+
+        Then each step only needs to gather & sum the image values. We only precompute the denominators for the full
+        `LineTable`, since for the other line stores (which build lines on demand) this would build every line.
+        """
+        line_table = self.args.line_table
+        if (
+            self.line_denominators is None
+            and isinstance(line_table, LineTable)
+            and (self.w is not None or line_table.weights is not None)
+        ):
+            self.line_denominators = line_denominators(line_table, None if self.w is None else self.w.reshape(-1))
+
+        if (
+            self.line_penalties is None
+            and self.args.critical_frac_penalty_power_decay is not None
+            and self.args.shape != "Rectangle"
+        ):
+            d_joined = self.args.d_joined
+            i = t.from_numpy(np.repeat(np.arange(d_joined.n_nodes), d_joined.degrees))
+            j = d_joined.indices_torch.long()
+            line_idx = t.from_numpy(pair_to_index_np(i.numpy(), j.numpy(), self.args.n_nodes))
+            self.line_penalties = t.zeros(2, len(line_table))
+            self.line_penalties[(i > j).long(), line_idx] = self.get_critical_frac_penalties(i, j)
+
+        if self.line_padding is None and self.args.legacy_padding_penalty and self.w is None:
+            lengths = line_table.lengths.float()
+            self.line_padding = (lengths.max() - lengths) / lengths.clamp(min=1.0)
+
+    def subtract_line(
+        self,
+        m_image: Tensor,
+        i: int,
+        j: int,
+        darkness: float,
+        line_scores: LineScores | None = None,
+        residual: ResidualTracker | None = None,
+    ) -> None:
+        """Subtracts the line (i, j) from the image, and updates `line_scores` and `residual` if given."""
+        line_table = self.args.line_table
+        trackers = [tracker for tracker in (line_scores, residual) if tracker is not None]
+
+        # Note this is an index_put rather than index_add, so if a line hits the same pixel twice we only subtract once
+        best_idx = pair_to_index(i, j, self.args.n_nodes)
+        pixels = line_table.get_line(best_idx)  # [pixels]
+        coverage = line_table.get_line_weights(best_idx)
+        if trackers:
+            changed_pixels = pixels.unique()
+            old_values = m_image.view(-1)[changed_pixels]
+        m_image.view(-1)[pixels] -= darkness if coverage is None else darkness * coverage
+        if trackers:
+            new_values = m_image.view(-1)[changed_pixels]
+            for tracker in trackers:
+                tracker.update(changed_pixels, old_values, new_values)
+
+    def get_line_scores(self, m_image: Tensor, i: int, j_choices: Tensor, darkness: float) -> Tensor:
+        """
+        Scores the lines from `i` to each of `j_choices` from scratch, i.e. the (weighted) mean of the image values
+        along each line, after applying the negative value penalty (using the engine from `ThreadArtColorParams`), and
+        the padding penalty if we're using `legacy_padding_penalty`.
+        """
+        line_idx = pair_to_index(i, j_choices, self.args.n_nodes)
+        scores = score_lines(
+            self.args.engine,
+            self.args.line_table,
+            m_image.view(-1),
+            line_idx,
+            darkness,
+            self.args.neg_penalty_multiplier,
+            None if self.w is None else self.w.reshape(-1),
+            None if self.line_denominators is None else self.line_denominators[line_idx],
+        )
+        if self.line_padding is not None:
+            scores = scores - self.args.neg_penalty_multiplier * darkness * self.line_padding[line_idx]
+        return scores
+
     # Creates images / animations from the art
     def paint_canvas(
         self,
@@ -6,9 +6,14 @@ from pathlib import Path
 import matplotlib.pyplot as plt
 import numpy as np
 import pyperclip
+import torch
 from IPython.display import clear_output
 from PIL import Image, ImageDraw
 
+from coordinates import pair_to_index_np
+from incidence import LineIncidence
+from line_table import PixelLineIndex
+
 
 def generate_hooks(n_hooks: int, wheel_pixel_size: int):
     r = (wheel_pixel_size / 2) - 1
@@ -62,6 +67,45 @@ def build_through_pixels_dict(hooks, n_hooks):
     return d
 
 
+def build_pixel_index(through_pixels_dict, n_hooks, wheel_pixel_size, max_mb: float = 1024.0):
+    # Inverted version of `through_pixels_dict`, i.e. for each pixel (linear index x * wheel_pixel_size + y) the ids
+    # `pair_to_index(i, j, n_hooks * 2)` of the lines through it. Same format as `Img` uses, see `PixelLineIndex`.
+    # Returns None if it would be bigger than `max_mb`.
+    n_pixels = wheel_pixel_size**2
+    n_entries = sum(len(pixels) for pixels in through_pixels_dict.values())
+    size_mb = PixelLineIndex.estimate_nbytes(n_entries, n_pixels) / (1024 * 1024)
+    if size_mb > max_mb:
+        print(f"Not building pixel index: it would need {size_mb:.1f}MB, which is more than the {max_mb:.1f}MB cap")
+        return None
+
+    line_ids, pixels = get_line_entries(through_pixels_dict, n_hooks, wheel_pixel_size)
+    return PixelLineIndex.from_entries(torch.from_numpy(pixels), torch.from_numpy(line_ids), n_pixels=n_pixels)
+
+
+def build_incidence(through_pixels_dict, n_hooks, wheel_pixel_size, w=False):
+    # Sparse (lines x pixels) version of `through_pixels_dict`, with rows `pair_to_index(i, j, n_hooks * 2)` and pixels
+    # flattened as in `build_pixel_index`. E.g. `build_incidence(...).sums(torch.from_numpy(image).reshape(-1))` gives
+    # the (w-weighted, if w is given) sum of the image along every line at once.
+    n_hook_sides = n_hooks * 2
+    line_ids, pixels = get_line_entries(through_pixels_dict, n_hooks, wheel_pixel_size)
+    return LineIncidence.from_entries(
+        torch.from_numpy(line_ids),
+        torch.from_numpy(pixels),
+        n_lines=n_hook_sides * (n_hook_sides - 1) // 2,
+        n_pixels=wheel_pixel_size**2,
+        w=None if isinstance(w, bool) else torch.from_numpy(np.asarray(w, dtype=np.float32)),
+    )
+
+
+def get_line_entries(through_pixels_dict, n_hooks, wheel_pixel_size):
+    # Flattens `through_pixels_dict` into (line id, linear pixel) entries
+    pairs = np.array(list(through_pixels_dict.keys()))
+    lengths = np.array([len(pixels) for pixels in through_pixels_dict.values()])
+    pixels = np.concatenate(list(through_pixels_dict.values()))
+    line_ids = np.repeat(pair_to_index_np(pairs[:, 0], pairs[:, 1], n_hooks * 2), lengths)
+    return line_ids, pixels[:, 0] * wheel_pixel_size + pixels[:, 1]
+
+
 def fitness(image, through_pixels_dict, line, darkness, lp, w, w_pos, w_neg, line_norm_mode):
     pixels = through_pixels_dict[tuple(sorted(line))]
 
@@ -0,0 +1,142 @@
+"""
+Includes the `LineIncidence` class, which stores the line table as a sparse (n_lines x n_pixels) matrix, so that we can
+score every line against an image with a single sparse matrix-vector product
+"""
+
+from dataclasses import dataclass, field
+
+import torch as t
+from jaxtyping import Float, Int
+from torch import Tensor
+
+from line_table import LineTable
+
+t.classes.__path__ = []
+
+
+@dataclass(eq=False)
+class LineIncidence:
+    """
+    Sparse CSR incidence matrix, where row `pair_to_index(i, j, n_nodes)` holds the pixels of the line (i, j). The value
+    of each entry is the weight that pixel gets when scoring the line: its coverage (for anti-aliased lines) times the
+    importance weighting `w` (if there is one), or just 1. A line which hits the same pixel twice has 2 entries for it,
+    which is the same as how `choose_and_subtract_best_line` counts it.
+
+    So `matrix @ image` gives the weighted sum of every line, and `row_sums` (i.e. `matrix @ 1`) gives the line lengths
+    (or weight sums), which is everything we need for the scores.
+
+    `coverage` is only kept for the negative value penalty on anti-aliased lines, since that depends on the coverage of
+    each entry (so it can't be applied to the image before the product).
+    """
+
+    matrix: Float[Tensor, "n_lines n_pixels"]
+    row_sums: Float[Tensor, "n_lines"]
+    coverage: Float[Tensor, "nnz"] | None = None
+    row_ids: Int[Tensor, "nnz"] | None = field(default=None, repr=False)
+    matrix_t: Float[Tensor, "n_pixels n_lines"] | None = field(default=None, repr=False)
+
+    @classmethod
+    def from_entries(
+        cls,
+        rows: Int[Tensor, "nnz"],
+        pixels: Int[Tensor, "nnz"],
+        n_lines: int,
+        n_pixels: int,
+        coverage: Float[Tensor, "nnz"] | None = None,
+        w: Float[Tensor, "n_pixels"] | None = None,
+    ) -> "LineIncidence":
+        """Builds the matrix from (row, pixel) entries, which don't need to be sorted."""
+        order = t.sort(rows, stable=True).indices
+        crow_indices = t.zeros(n_lines + 1, dtype=t.int64)
+        crow_indices[1:] = t.bincount(rows.long(), minlength=n_lines).cumsum(0)
+        return cls.from_csr(
+            crow_indices,
+            pixels[order],
+            n_pixels,
+            None if coverage is None else coverage[order],
+            w,
+        )
+
+    @classmethod
+    def from_csr(
+        cls,
+        crow_indices: Int[Tensor, "n_lines_plus_1"],
+        pixels: Int[Tensor, "nnz"],
+        n_pixels: int,
+        coverage: Float[Tensor, "nnz"] | None = None,
+        w: Float[Tensor, "n_pixels"] | None = None,
+    ) -> "LineIncidence":
+        # Use int32 indices where we can, since they're half the size
+        index_dtype = t.int32 if max(n_pixels, pixels.size(0)) < 2**31 else t.int64
+        values = t.ones(pixels.size(0)) if coverage is None else coverage.float()
+        if w is not None:
+            values = values * w.reshape(-1).float()[pixels.long()]
+        matrix = t.sparse_csr_tensor(
+            crow_indices.to(index_dtype),
+            pixels.to(index_dtype),
+            values,
+            size=(crow_indices.size(0) - 1, n_pixels),
+        )
+        return cls(matrix=matrix, row_sums=matrix @ t.ones(n_pixels), coverage=coverage)
+
+    @classmethod
+    def from_line_table(
+        cls, line_table: LineTable, n_pixels: int, w: Float[Tensor, "n_pixels"] | None = None
+    ) -> "LineIncidence":
+        """The line table is already CSR, so this doesn't need any sorting (or copying, other than the dtype)."""
+        return cls.from_csr(line_table.offsets, line_table.pixels, n_pixels, line_table.weights, w)
+
+    def __len__(self) -> int:
+        return self.matrix.size(0)
+
+    @property
+    def nbytes(self) -> int:
+        tensors = [self.matrix.crow_indices(), self.matrix.col_indices(), self.matrix.values(), self.row_sums]
+        if self.coverage is not None:
+            tensors.append(self.coverage)
+        if self.matrix_t is not None:
+            tensors += [self.matrix_t.crow_indices(), self.matrix_t.col_indices(), self.matrix_t.values()]
+        return sum(tensor.element_size() * tensor.nelement() for tensor in tensors)
+
+    def sums(self, image: Float[Tensor, "n_pixels"]) -> Float[Tensor, "n_lines"]:
+        """Weighted sum of `image` along every line."""
+        return self.matrix @ image.float()
+
+    def back_project(self, line_values: Float[Tensor, "n_lines"]) -> Float[Tensor, "n_pixels"]:
+        """
+        Transposed product, i.e. the image we'd get by drawing each line `line_values` times (the opposite of `sums`).
+        The CSC version of the matrix is the CSR version of its transpose, so we build that on the first call.
+        """
+        if self.matrix_t is None:
+            matrix_csc = self.matrix.to_sparse_csc()
+            self.matrix_t = t.sparse_csr_tensor(
+                matrix_csc.ccol_indices(),
+                matrix_csc.row_indices(),
+                matrix_csc.values(),
+                size=(self.matrix.size(1), self.matrix.size(0)),
+            )
+        return self.matrix_t @ line_values.float()
+
+    def scores(
+        self, image: Float[Tensor, "n_pixels"], darkness: float = 0.0, neg_penalty_multiplier: float = 0.0
+    ) -> Float[Tensor, "n_lines"]:
+        """
+        Scores every line against the flattened `image` (the same as `choose_and_subtract_best_line` would). Lines with
+        no pixels (i.e. the pairs which aren't joined) get -inf, so they're never chosen.
+        """
+        image = image.float()
+        if neg_penalty_multiplier <= 1e-6:
+            sums = self.matrix @ image
+        elif self.coverage is None:
+            # The penalty only depends on each pixel's value, so we can apply it to the image first
+            sums = self.matrix @ (image - neg_penalty_multiplier * (darkness - image).clamp(min=0.0))
+        else:
+            # The penalty depends on the coverage of each entry, so we evaluate it per entry
+            if self.row_ids is None:
+                lengths = self.matrix.crow_indices().diff().long()
+                self.row_ids = t.repeat_interleave(t.arange(len(self)), lengths)
+            values = image[self.matrix.col_indices().long()]
+            values = values - neg_penalty_multiplier * (darkness * self.coverage - values).clamp(min=0.0)
+            sums = t.zeros(len(self)).index_add_(0, self.row_ids, values * self.matrix.values())
+
+        return t.where(self.row_sums > 0, sums / self.row_sums, float("-inf"))
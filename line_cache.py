@@ -0,0 +1,287 @@
+"""
+Includes all funcs related to caching the line table (i.e. the output of `build_through_pixels_dict`) on disk
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import torch as t
+from torch import Tensor
+
+from adjacency import Adjacency
+from coordinates import build_through_pixels_dict
+from line_table import LazyLineTable, LineTable, PixelLineIndex, SymmetricCircleLineTable, build_pixel_index
+
+t.classes.__path__ = []
+
+# Bump this whenever the contents of the line table change for the same parameters (e.g. a change to how the pixels are
+# computed, or to the storage format below). Old entries are then rebuilt automatically rather than silently reused.
+CACHE_VERSION = 4
+
+DEFAULT_CACHE_DIR = Path(__file__).parent / "cache" / "lines"
+DEFAULT_MAX_CACHE_MB = 2048.0
+
+
+def get_cache_key(
+    x: int,
+    y: int,
+    n_nodes: int | tuple,
+    shape: str,
+    critical_fracs: tuple[float, float | None],
+    width_to_gap_ratio: float,
+    step_size: float,
+    rasterizer: str = "sampled",
+) -> str:
+    """
+    Returns a content-addressed key for the line table. These are exactly the parameters which
+    `build_through_pixels_dict` depends on, plus the cache version (so bumping the version invalidates every existing
+    entry).
+    """
+    key_dict = dict(
+        version=CACHE_VERSION,
+        x=int(x),
+        y=int(y),
+        n_nodes=list(n_nodes) if isinstance(n_nodes, tuple) else int(n_nodes),
+        shape=shape,
+        critical_fracs=list(critical_fracs),
+        width_to_gap_ratio=float(width_to_gap_ratio),
+        step_size=float(step_size),
+        rasterizer=rasterizer,
+    )
+    return hashlib.sha256(json.dumps(key_dict, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def save_through_pixels_dict(
+    entry_dir: Path,
+    d_coords: dict[int, Tensor],
+    d_joined: Adjacency,
+    d_sides: dict[int, int] | None,
+    line_table: LineTable,
+) -> None:
+    """
+    Saves the outputs of `build_through_pixels_dict` into `entry_dir`. We write into a temporary directory first and
+    then rename it, so a crash halfway through never leaves a half-written entry behind.
+    """
+    tmp_dir = entry_dir.with_name(f"{entry_dir.name}.tmp-{os.getpid()}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    nodes = sorted(d_coords.keys())
+    assert nodes == list(range(len(nodes))), "Expected d_coords to be keyed by 0, 1, ..., n_nodes - 1"
+
+    np.save(tmp_dir / "d_coords.npy", t.stack([d_coords[i] for i in nodes]).numpy())
+    np.save(tmp_dir / "joined_indptr.npy", d_joined.indptr)
+    np.save(tmp_dir / "joined_indices.npy", d_joined.indices)
+    if d_sides is not None:
+        np.save(tmp_dir / "d_sides.npy", np.array([d_sides[i] for i in nodes], dtype=np.int64))
+    np.save(tmp_dir / "line_pixels.npy", line_table.pixels.numpy())
+    np.save(tmp_dir / "line_offsets.npy", line_table.offsets.numpy())
+    if line_table.weights is not None:
+        np.save(tmp_dir / "line_weights.npy", line_table.weights.numpy())
+
+    if line_table.pixel_index is not None:
+        save_pixel_index(tmp_dir, line_table.pixel_index)
+
+    meta = dict(version=CACHE_VERSION, created=time.time(), last_used=time.time(), width=line_table.width)
+    (tmp_dir / "meta.json").write_text(json.dumps(meta))
+
+    shutil.rmtree(entry_dir, ignore_errors=True)
+    os.replace(tmp_dir, entry_dir)
+
+
+def save_pixel_index(entry_dir: Path, pixel_index: PixelLineIndex) -> None:
+    """
+    Saves the pixel index into an entry. This is separate from `save_through_pixels_dict` because we might add it to
+    an existing entry (the index is optional, so it isn't part of the cache key). The line ids are written last, since
+    that's the file whose presence `load_pixel_index` checks for.
+    """
+    np.save(entry_dir / "pixel_indptr.npy", pixel_index.indptr.numpy())
+    if pixel_index.weights is not None:
+        np.save(entry_dir / "pixel_weights.npy", pixel_index.weights.numpy())
+    np.save(entry_dir / "pixel_line_ids.npy", pixel_index.line_ids.numpy())
+
+
+def load_pixel_index(entry_dir: Path) -> PixelLineIndex | None:
+    """Loads (memory-mapped) the pixel index from an entry, or returns None if the entry doesn't have one."""
+    if not (entry_dir / "pixel_line_ids.npy").exists():
+        return None
+    pixel_index = PixelLineIndex(
+        indptr=t.from_numpy(np.load(entry_dir / "pixel_indptr.npy", mmap_mode="c")),
+        line_ids=t.from_numpy(np.load(entry_dir / "pixel_line_ids.npy", mmap_mode="c")),
+    )
+    if (entry_dir / "pixel_weights.npy").exists():
+        pixel_index.weights = t.from_numpy(np.load(entry_dir / "pixel_weights.npy", mmap_mode="c"))
+    return pixel_index
+
+
+def load_through_pixels_dict(
+    entry_dir: Path,
+) -> tuple[dict[int, Tensor], Adjacency, dict[int, int] | None, LineTable] | None:
+    """
+    Loads a cache entry, or returns None if it doesn't exist / is stale. The line table's tensors are memory-mapped
+    rather than read into RAM (copy-on-write, so the files on disk are never modified even if the tensors are).
+    """
+    meta_path = entry_dir / "meta.json"
+    if not meta_path.exists():
+        return None
+    try:
+        meta = json.loads(meta_path.read_text())
+        if meta.get("version") != CACHE_VERSION:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+
+        coords = t.from_numpy(np.load(entry_dir / "d_coords.npy"))
+        d_coords = {i: coords[i] for i in range(coords.shape[0])}
+
+        d_joined = Adjacency(np.load(entry_dir / "joined_indptr.npy"), np.load(entry_dir / "joined_indices.npy"))
+
+        d_sides = None
+        if (entry_dir / "d_sides.npy").exists():
+            d_sides = {i: side for i, side in enumerate(np.load(entry_dir / "d_sides.npy").tolist())}
+
+        line_table = LineTable(
+            pixels=t.from_numpy(np.load(entry_dir / "line_pixels.npy", mmap_mode="c")),
+            offsets=t.from_numpy(np.load(entry_dir / "line_offsets.npy", mmap_mode="c")),
+            width=meta["width"],
+        )
+        if (entry_dir / "line_weights.npy").exists():
+            line_table.weights = t.from_numpy(np.load(entry_dir / "line_weights.npy", mmap_mode="c"))
+        line_table.pixel_index = load_pixel_index(entry_dir)
+
+    except (OSError, ValueError, KeyError, json.JSONDecodeError):
+        # Corrupted entry (e.g. disk filled up), so we just throw it away and rebuild
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        return None
+
+    # Record the access time, which is what we use for LRU eviction
+    meta["last_used"] = time.time()
+    meta_path.write_text(json.dumps(meta))
+
+    return d_coords, d_joined, d_sides, line_table
+
+
+def get_dir_size_mb(path: Path) -> float:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file()) / (1024 * 1024)
+
+
+def evict_cache(cache_dir: Path, max_cache_mb: float, keep: str | None = None) -> None:
+    """
+    Deletes the least recently used entries until the cache is under `max_cache_mb`. The entry `keep` (which we've just
+    written) is never evicted, even if it's larger than the whole budget by itself.
+    """
+    entries = []
+    for entry_dir in cache_dir.iterdir():
+        if not entry_dir.is_dir():
+            continue
+        try:
+            last_used = json.loads((entry_dir / "meta.json").read_text())["last_used"]
+        except (OSError, KeyError, json.JSONDecodeError):
+            last_used = 0.0  # orphaned temp dirs or corrupted entries get evicted first
+        entries.append((last_used, entry_dir, get_dir_size_mb(entry_dir)))
+
+    total_mb = sum(size for _, _, size in entries)
+    for _, entry_dir, size in sorted(entries, key=lambda entry: entry[0]):
+        if total_mb <= max_cache_mb:
+            break
+        if entry_dir.name == keep:
+            continue
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_mb -= size
+
+
+def cached_build_through_pixels_dict(
+    x,
+    y,
+    n_nodes,
+    shape: str,
+    critical_fracs: tuple[float, float | None] = (0.02, None),
+    width_to_gap_ratio: float = 1.0,
+    step_size: float = 1.0,
+    debug: bool = False,
+    rasterizer: str = "sampled",
+    line_store: str = "table",
+    lazy_cache_mb: float = 512.0,
+    pixel_index: bool = False,
+    pixel_index_max_mb: float = 1024.0,
+    cache_dir: Path | str | None = None,
+    max_cache_mb: float = DEFAULT_MAX_CACHE_MB,
+) -> tuple[
+    dict[int, Tensor],
+    Adjacency,
+    dict[int, int] | None,
+    LineTable | SymmetricCircleLineTable | LazyLineTable,
+]:
+    """
+    Drop-in replacement for `build_through_pixels_dict` (when we want the full outputs, not just `d_coords`), which
+    reads the result from `cache_dir` if we've built this line table before, and otherwise builds it and writes it
+    there.
+
+    Line stores other than "table" are cheap to build (that's their point), so we don't cache them.
+
+    If `pixel_index` is True, the pixel -> lines index is cached alongside the line table. An entry which was written
+    without it gets it added the first time it's asked for (subject to `pixel_index_max_mb`, like the uncached build).
+
+    Args:
+        cache_dir: directory holding the cache entries (one subdirectory per key). Defaults to `DEFAULT_CACHE_DIR`.
+        max_cache_mb: the least recently used entries are evicted once the cache grows beyond this size.
+    """
+    if line_store != "table":
+        return build_through_pixels_dict(
+            x,
+            y,
+            n_nodes,
+            shape=shape,
+            critical_fracs=critical_fracs,
+            only_return_d_coords=False,
+            width_to_gap_ratio=width_to_gap_ratio,
+            step_size=step_size,
+            debug=debug,
+            rasterizer=rasterizer,
+            line_store=line_store,
+            lazy_cache_mb=lazy_cache_mb,
+        )
+
+    cache_dir = Path(cache_dir or DEFAULT_CACHE_DIR)
+    key = get_cache_key(x, y, n_nodes, shape, critical_fracs, width_to_gap_ratio, step_size, rasterizer)
+    entry_dir = cache_dir / key
+
+    cached = load_through_pixels_dict(entry_dir)
+    if cached is not None:
+        line_table = cached[-1]
+        if pixel_index and line_table.pixel_index is None:
+            line_table.pixel_index = build_pixel_index(line_table, pixel_index_max_mb)
+            if line_table.pixel_index is not None:
+                try:
+                    save_pixel_index(entry_dir, line_table.pixel_index)
+                except OSError as e:
+                    print(f"Couldn't write pixel index to {entry_dir}: {e}")
+        return cached
+
+    d_coords, d_joined, d_sides, line_table = build_through_pixels_dict(
+        x,
+        y,
+        n_nodes,
+        shape=shape,
+        critical_fracs=critical_fracs,
+        only_return_d_coords=False,
+        width_to_gap_ratio=width_to_gap_ratio,
+        step_size=step_size,
+        debug=debug,
+        rasterizer=rasterizer,
+        pixel_index=pixel_index,
+        pixel_index_max_mb=pixel_index_max_mb,
+    )
+
+    # A failure to write the cache (e.g. read-only filesystem on a hosted app) shouldn't stop us from generating art
+    try:
+        save_through_pixels_dict(entry_dir, d_coords, d_joined, d_sides, line_table)
+        evict_cache(cache_dir, max_cache_mb, keep=key)
+    except OSError as e:
+        print(f"Couldn't write line cache to {entry_dir}: {e}")
+
+    return d_coords, d_joined, d_sides, line_table
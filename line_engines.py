@@ -0,0 +1,247 @@
+"""
+Includes the line engines, i.e. the backends which score candidate lines in `choose_and_subtract_best_line`. There are
+3 of them:
+
+    - "torch" (the default) works with every line store
+    - "numpy" avoids torch's per-op dispatch overhead, which dominates when we only have a few hundred candidates of a
+      few hundred pixels each
+    - "numba" (only if numba is installed) JIT-compiles a single loop over the candidates, so we never materialize the
+      gathered pixels at all
+
+The numpy & numba engines need the full `LineTable` (they read its CSR arrays directly). All engines compute the same
+scores (up to float32 rounding, since they sum in different orders).
+"""
+
+from typing import Literal
+
+import numpy as np
+import torch as t
+from jaxtyping import Float, Int
+from torch import Tensor
+
+from line_table import LazyLineTable, LineTable, SymmetricCircleLineTable
+
+try:
+    import numba
+
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+t.classes.__path__ = []
+
+ENGINES = ["torch", "numpy", "numba"]
+
+
+def score_lines_torch(
+    line_table: LineTable | SymmetricCircleLineTable | LazyLineTable,
+    image: Float[Tensor, "n_pixels"],
+    line_idx: Int[Tensor, "batch"],
+    darkness: float,
+    neg_penalty_multiplier: float = 0.0,
+    w: Float[Tensor, "n_pixels"] | None = None,
+    denominators: Float[Tensor, "batch"] | None = None,
+) -> Float[Tensor, "batch"]:
+    """
+    Scores the lines `line_idx` against the flattened `image`, i.e. the (weighted) mean of the image values along each
+    line, after applying the negative value penalty. If given, `denominators` are the precomputed weight sums of the
+    lines (see `line_denominators`), so we only need to sum the numerators.
+    """
+    n_lines = line_idx.size(0)
+
+    # Get the (linear) pixels of all the lines concatenated together, plus `line_ids` which maps each pixel back to its
+    # line. We index into the flattened image, so this is a single gather rather than one per coordinate. If the line
+    # table has coverage weights (anti-aliased lines) then each pixel only gets that fraction of the darkness.
+    pixels, line_ids, lengths, coverage = line_table.get_lines(line_idx)
+    pixel_values = image[pixels]  # [total_pixels]
+    pixel_darkness = darkness if coverage is None else darkness * coverage
+
+    # Add penalties of our pixels are less than the darkness, and if neg_penalty_multiplier > 0, then we decrease their
+    # scores. The amount they're decreased by equals the negative values they'll have after subtracting the darkness,
+    # scaled by the neg_penalty_multiplier (e.g. if value is 0.2, darkness is 0.5, multiplier is 0.5, then we would
+    # decrease the score by 0.5 * (0.5 - 0.2) = 0.15 to reflect how we're de-incentivising pushing into negative
+    # values).
+    assert neg_penalty_multiplier >= 0, "Negative penalty multiplier must be non-negative"
+    if neg_penalty_multiplier > 1e-6:
+        pixel_values -= neg_penalty_multiplier * (pixel_darkness - pixel_values).clamp(min=0.0)
+
+    # Optionally index the weighting in the same way as the pixels, then sum over each line
+    def sum_per_line(values: Tensor) -> Tensor:
+        return t.zeros(n_lines, dtype=values.dtype).index_add_(0, line_ids, values)  # [n_lines]
+
+    if w is not None:
+        w_pixel_values = w[pixels]
+        if coverage is not None:
+            w_pixel_values = w_pixel_values * coverage
+        w_sum = sum_per_line(w_pixel_values) if denominators is None else denominators  # [n_lines]
+        return sum_per_line(pixel_values * w_pixel_values) / w_sum  # [n_lines]
+    elif coverage is not None:
+        coverage_sum = sum_per_line(coverage) if denominators is None else denominators  # [n_lines]
+        return sum_per_line(pixel_values * coverage) / coverage_sum  # [n_lines]
+    else:
+        return sum_per_line(pixel_values) / lengths.float()  # [n_lines]
+
+
+def line_denominators(
+    line_table: LineTable | SymmetricCircleLineTable | LazyLineTable,
+    w: Float[Tensor, "n_pixels"] | None = None,
+    batch_size: int = 65536,
+) -> Float[Tensor, "n_lines"]:
+    """
+    The denominator of every line's score (its weight sum, or just its length if there's no weighting), which never
+    changes during a run. We go through the lines in batches, so we never gather the whole line table at once.
+    """
+    denominators = t.zeros(len(line_table))
+    for start in range(0, len(line_table), batch_size):
+        line_idx = t.arange(start, min(start + batch_size, len(line_table)))
+        pixels, line_ids, lengths, coverage = line_table.get_lines(line_idx)
+        if w is None and coverage is None:
+            denominators[line_idx] = lengths.float()
+            continue
+        entry_weights = w[pixels] if w is not None else coverage
+        if w is not None and coverage is not None:
+            entry_weights = entry_weights * coverage
+        denominators[line_idx] = t.zeros(line_idx.size(0)).index_add_(0, line_ids, entry_weights)
+    return denominators
+
+
+def score_lines_numpy(
+    pixels: Int[np.ndarray, "n_pixels_total"],
+    offsets: Int[np.ndarray, "n_lines_plus_1"],
+    weights: Float[np.ndarray, "n_pixels_total"] | None,
+    image: Float[np.ndarray, "n_pixels"],
+    line_idx: Int[np.ndarray, "batch"],
+    darkness: float,
+    neg_penalty_multiplier: float = 0.0,
+    w: Float[np.ndarray, "n_pixels"] | None = None,
+    denominators: Float[np.ndarray, "batch"] | None = None,
+) -> Float[np.ndarray, "batch"]:
+    """Same as `score_lines_torch`, but reading the line table's CSR arrays directly with numpy."""
+    starts = offsets[line_idx]
+    lengths = offsets[line_idx + 1] - starts
+    ends = lengths.cumsum()
+    seg_starts = ends - lengths  # where each line starts in the concatenated pixels
+    positions = np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - seg_starts, lengths)
+
+    line_pixels = pixels[positions]
+    pixel_values = image[line_pixels]
+    coverage = None if weights is None else weights[positions]
+    pixel_darkness = darkness if coverage is None else darkness * coverage
+
+    assert neg_penalty_multiplier >= 0, "Negative penalty multiplier must be non-negative"
+    if neg_penalty_multiplier > 1e-6:
+        pixel_values = pixel_values - neg_penalty_multiplier * np.maximum(pixel_darkness - pixel_values, 0.0)
+
+    # Lines are contiguous in the concatenated pixels, so we can sum them with `reduceat` (which needs the empty lines
+    # to be left out, else it'd return the next pixel rather than 0 for them)
+    nonempty = lengths > 0
+
+    def sum_per_line(values: np.ndarray) -> np.ndarray:
+        sums = np.zeros(len(line_idx), dtype=values.dtype)
+        if nonempty.any():
+            sums[nonempty] = np.add.reduceat(values, seg_starts[nonempty])
+        return sums
+
+    if w is not None:
+        w_pixel_values = w[line_pixels]
+        if coverage is not None:
+            w_pixel_values = w_pixel_values * coverage
+        w_sum = sum_per_line(w_pixel_values) if denominators is None else denominators
+        return sum_per_line(pixel_values * w_pixel_values) / w_sum
+    elif coverage is not None:
+        coverage_sum = sum_per_line(coverage) if denominators is None else denominators
+        return sum_per_line(pixel_values * coverage) / coverage_sum
+    else:
+        return sum_per_line(pixel_values) / lengths.astype(np.float32)
+
+
+if NUMBA_AVAILABLE:
+
+    @numba.njit(cache=True, error_model="numpy")  # so empty lines give NaN like the other engines, rather than raising
+    def _score_lines_numba_kernel(pixels, offsets, weights, image, line_idx, darkness, neg_penalty_multiplier, w, out):
+        # Empty `weights` / `w` mean "all ones" (numba doesn't like optional arrays)
+        has_weights = weights.shape[0] > 0
+        has_w = w.shape[0] > 0
+        for k in range(line_idx.shape[0]):
+            total = 0.0
+            denominator = 0.0
+            for position in range(offsets[line_idx[k]], offsets[line_idx[k] + 1]):
+                pixel = pixels[position]
+                value = image[pixel]
+                coverage = weights[position] if has_weights else 1.0
+                if neg_penalty_multiplier > 1e-6:
+                    value -= neg_penalty_multiplier * max(darkness * coverage - value, 0.0)
+                weight = coverage * w[pixel] if has_w else coverage
+                total += value * weight
+                denominator += weight
+            out[k] = total / denominator
+
+
+def score_lines_numba(
+    pixels: Int[np.ndarray, "n_pixels_total"],
+    offsets: Int[np.ndarray, "n_lines_plus_1"],
+    weights: Float[np.ndarray, "n_pixels_total"] | None,
+    image: Float[np.ndarray, "n_pixels"],
+    line_idx: Int[np.ndarray, "batch"],
+    darkness: float,
+    neg_penalty_multiplier: float = 0.0,
+    w: Float[np.ndarray, "n_pixels"] | None = None,
+) -> Float[np.ndarray, "batch"]:
+    """Same as `score_lines_numpy`, but with a JIT-compiled loop (compiled on the first call, then cached on disk)."""
+    assert NUMBA_AVAILABLE, "The numba engine needs numba to be installed (`pip install numba`)"
+    assert neg_penalty_multiplier >= 0, "Negative penalty multiplier must be non-negative"
+    empty = np.zeros(0, dtype=np.float32)
+    out = np.zeros(len(line_idx), dtype=np.float32)
+    _score_lines_numba_kernel(
+        pixels,
+        offsets,
+        empty if weights is None else weights,
+        image,
+        line_idx,
+        float(darkness),
+        float(neg_penalty_multiplier),
+        empty if w is None else w,
+        out,
+    )
+    return out
+
+
+def score_lines(
+    engine: Literal["torch", "numpy", "numba"],
+    line_table: LineTable | SymmetricCircleLineTable | LazyLineTable,
+    image: Float[Tensor, "n_pixels"],
+    line_idx: Int[Tensor, "batch"],
+    darkness: float,
+    neg_penalty_multiplier: float = 0.0,
+    w: Float[Tensor, "n_pixels"] | None = None,
+    denominators: Float[Tensor, "batch"] | None = None,
+) -> Float[Tensor, "batch"]:
+    """
+    Scores the lines `line_idx` with the given engine. The inputs & output are always tensors (converting between
+    torch & numpy on CPU shares memory, so it's free). The numba engine ignores `denominators`, since it sums them in
+    the same loop as the numerators anyway.
+
+    Lines with no weight (e.g. lying entirely where `w` is 0) score 0 / 0 = NaN in every engine, which we replace with
+    -inf so they're never chosen. Otherwise `argmax` would pick them first, while `LazyGreedySelector`'s heap (which
+    compares them as neither bigger nor smaller than anything) would order them arbitrarily.
+    """
+    if engine == "torch":
+        scores = score_lines_torch(line_table, image, line_idx, darkness, neg_penalty_multiplier, w, denominators)
+        return scores.masked_fill(scores.isnan(), float("-inf"))
+
+    assert isinstance(line_table, LineTable), f"The {engine!r} engine only works with the full line table"
+    args = (
+        line_table.pixels.numpy(),
+        line_table.offsets.numpy(),
+        None if line_table.weights is None else line_table.weights.numpy(),
+        image.numpy(),
+        line_idx.numpy(),
+        darkness,
+        neg_penalty_multiplier,
+        None if w is None else w.numpy(),
+    )
+    if engine == "numba":
+        scores = t.from_numpy(score_lines_numba(*args))
+    else:
+        scores = t.from_numpy(score_lines_numpy(*args, None if denominators is None else denominators.numpy()))
+    return scores.masked_fill(scores.isnan(), float("-inf"))
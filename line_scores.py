@@ -0,0 +1,203 @@
+"""
+Includes the `LineScores` class, which keeps a running score for every line so we don't have to re-score all the
+candidate lines from scratch every time we draw one, and the `LazyGreedySelector` & `PeriodicRescorer` classes, which
+avoid re-scoring most of them by using stale scores (all used by `Img` when `n_random_lines="all"`)
+"""
+
+import heapq
+from typing import Callable
+
+import torch as t
+from jaxtyping import Float, Int
+from torch import Tensor
+
+from coordinates import pair_to_index
+from incidence import LineIncidence
+from line_table import LineTable, PixelLineIndex
+
+t.classes.__path__ = []
+
+
+class LineScores:
+    """
+    Running (unnormalized) score of every line in `line_table` for a single monochrome image, which is what
+    `choose_and_subtract_best_line` would compute if it scored that line from scratch. The score of a line is the sum
+    of `f(value) * weight` over its pixels, divided by the sum of `weight` (where `weight` is the importance weighting
+    times the coverage, either of which might just be 1, and `f` applies the negative value penalty). Every term only
+    depends on a single pixel, so when we subtract a line we only need to update the lines which share a pixel with it.
+    This makes each step cost (pixels in the line) x (lines per pixel), rather than (candidate lines) x (pixels in
+    each line).
+
+    The sums are kept in float64, so the rounding error from many small updates stays negligible. We use the line
+    table's `pixel_index` if it has one (e.g. loaded from the line cache), otherwise we build it here.
+    """
+
+    def __init__(
+        self,
+        line_table: LineTable,
+        m_image: Float[Tensor, "y x"],
+        darkness: float,
+        neg_penalty_multiplier: float = 0.0,
+        w: Float[Tensor, "y x"] | None = None,
+    ) -> None:
+        self.darkness = darkness
+        self.neg_penalty_multiplier = neg_penalty_multiplier
+        self.w_flat = None if w is None else w.reshape(-1).float()
+        self.pixel_index = line_table.pixel_index
+        if self.pixel_index is None:
+            self.pixel_index = PixelLineIndex.from_line_table(line_table, m_image.numel())
+
+        # Compute the starting sums, and the denominators (which never change)
+        pixels, line_ids, lengths, coverage = line_table.get_lines(t.arange(len(line_table)))
+        entry_weights = self.get_entry_weights(pixels, coverage)
+        values = self.penalized(m_image.view(-1)[pixels], coverage)
+        n_lines = len(line_table)
+        if entry_weights is None:
+            self.sums = t.zeros(n_lines, dtype=t.float64).index_add_(0, line_ids, values.double())
+            self.denominators = lengths.double()
+        else:
+            self.sums = t.zeros(n_lines, dtype=t.float64).index_add_(0, line_ids, (values * entry_weights).double())
+            self.denominators = t.zeros(n_lines, dtype=t.float64).index_add_(0, line_ids, entry_weights.double())
+
+    def get_entry_weights(
+        self, pixels: Int[Tensor, "n"], coverage: Float[Tensor, "n"] | None
+    ) -> Float[Tensor, "n"] | None:
+        """Returns the weight of each (line, pixel) entry, or None if they're all 1."""
+        if self.w_flat is None:
+            return coverage
+        w_pixel_values = self.w_flat[pixels]
+        return w_pixel_values if coverage is None else w_pixel_values * coverage
+
+    def penalized(self, values: Float[Tensor, "n"], coverage: Float[Tensor, "n"] | None) -> Float[Tensor, "n"]:
+        """Applies the negative value penalty, in the same way as `choose_and_subtract_best_line`."""
+        if self.neg_penalty_multiplier <= 1e-6:
+            return values
+        pixel_darkness = self.darkness if coverage is None else self.darkness * coverage
+        return values - self.neg_penalty_multiplier * (pixel_darkness - values).clamp(min=0.0)
+
+    def get_scores(self, line_idx: Int[Tensor, "batch"]) -> Float[Tensor, "batch"]:
+        scores = (self.sums[line_idx] / self.denominators[line_idx]).float()
+        return scores.masked_fill(scores.isnan(), float("-inf"))  # lines with no weight, the same as `score_lines`
+
+    def update(
+        self,
+        pixels: Int[Tensor, "n_changed"],
+        old_values: Float[Tensor, "n_changed"],
+        new_values: Float[Tensor, "n_changed"],
+    ) -> None:
+        """
+        Updates the sums after the image values at `pixels` (which should be unique) changed from `old_values` to
+        `new_values`.
+        """
+        line_ids, pixel_ids, coverage = self.pixel_index.get_entries(pixels)
+        delta = self.penalized(new_values[pixel_ids], coverage) - self.penalized(old_values[pixel_ids], coverage)
+        entry_weights = self.get_entry_weights(pixels[pixel_ids], coverage)
+        if entry_weights is not None:
+            delta = delta * entry_weights
+        self.sums.index_add_(0, line_ids.long(), delta.double())
+
+
+class LazyGreedySelector:
+    """
+    Chooses the best line from a node without re-scoring every candidate ("lazy greedy"). Subtracting a line only ever
+    decreases pixel values, and a line's score is increasing in each of its pixel values (this is still true with the
+    negative value penalty), so a score we computed earlier is an upper bound on the line's current score.
+
+    For each node we keep a max-heap of (possibly stale) scores of the lines from that node. To choose a line we
+    re-score the top of the heap (`batch_size` lines at a time) until the top entry is one we've re-scored during this
+    step. Its score is then at least the upper bound of every other line, so it's the same line `argmax` over fresh
+    scores would choose (ties go to the smallest `j` in both cases).
+
+    `score_fn(i, j_choices)` should return the current scores of the lines from `i` to each of `j_choices`. This isn't
+    compatible with anything which adds randomness to the scores (e.g. `critical_frac_penalty_power_decay`).
+    """
+
+    def __init__(self, score_fn: Callable[[int, Int[Tensor, "batch"]], Float[Tensor, "batch"]], batch_size: int = 8):
+        self.score_fn = score_fn
+        self.batch_size = batch_size
+        self.heaps: dict[int, list[tuple[float, int]]] = {}
+        self.n_steps = 0
+        self.n_rescored = 0
+        self.n_candidates = 0
+
+    def choose(self, i: int, j_choices: Int[Tensor, "n"]) -> int:
+        """Returns the `j` in `j_choices` with the highest current score for the line (i, j)."""
+        self.n_steps += 1
+        self.n_candidates += j_choices.size(0)
+
+        # The first time we visit a node, we score everything (so all entries are fresh)
+        if i not in self.heaps:
+            scores = self.score_fn(i, j_choices)
+            self.n_rescored += j_choices.size(0)
+            heap = [(-score, j) for score, j in zip(scores.tolist(), j_choices.tolist())]
+            heapq.heapify(heap)
+            self.heaps[i] = heap
+            return heap[0][1]
+
+        # Otherwise, re-score the best (stale) candidates until the best candidate is fresh
+        heap = self.heaps[i]
+        fresh = set()
+        while heap[0][1] not in fresh:
+            batch = []
+            while heap and heap[0][1] not in fresh and len(batch) < self.batch_size:
+                batch.append(heapq.heappop(heap)[1])
+            scores = self.score_fn(i, t.tensor(batch, dtype=j_choices.dtype))
+            self.n_rescored += len(batch)
+            for score, j in zip(scores.tolist(), batch):
+                heapq.heappush(heap, (-score, j))
+                fresh.add(j)
+
+        return heap[0][1]
+
+    def info(self) -> dict[str, float]:
+        """Returns how many lines we've re-scored per step, compared to scoring every candidate."""
+        return dict(
+            n_steps=self.n_steps,
+            rescored_per_step=self.n_rescored / max(self.n_steps, 1),
+            candidates_per_step=self.n_candidates / max(self.n_steps, 1),
+        )
+
+
+class PeriodicRescorer:
+    """
+    Chooses lines using a score for every line which we only recompute in full every `every` steps (a single sparse
+    matrix-vector product, see `LineIncidence`). At each step we take the `top_k` candidates with the best of these
+    (stale) scores, re-score just those against the current image, pick the best, and write their fresh scores back.
+
+    Unlike `LazyGreedySelector` this is approximate (a line whose stale score dropped out of the top `top_k` can't be
+    chosen until the next full rescore), but the cost per step is fixed.
+    """
+
+    def __init__(
+        self,
+        incidence: LineIncidence,
+        m_image: Float[Tensor, "y x"],
+        darkness: float,
+        neg_penalty_multiplier: float,
+        score_fn: Callable[[int, Int[Tensor, "batch"]], Float[Tensor, "batch"]],
+        n_nodes: int,
+        every: int,
+        top_k: int = 16,
+    ):
+        self.incidence = incidence
+        self.m_image = m_image
+        self.darkness = darkness
+        self.neg_penalty_multiplier = neg_penalty_multiplier
+        self.score_fn = score_fn
+        self.n_nodes = n_nodes
+        self.every = every
+        self.top_k = top_k
+        self.n_steps = 0
+        self.scores: Float[Tensor, "n_lines"] | None = None
+
+    def choose(self, i: int, j_choices: Int[Tensor, "n"]) -> int:
+        """Returns the best `j` in `j_choices`, among the `top_k` according to the stale scores."""
+        if self.n_steps % self.every == 0:
+            self.scores = self.incidence.scores(self.m_image.view(-1), self.darkness, self.neg_penalty_multiplier)
+        self.n_steps += 1
+
+        line_idx = pair_to_index(i, j_choices, self.n_nodes).long()
+        top = self.scores[line_idx].topk(min(self.top_k, j_choices.size(0))).indices
+        fresh_scores = self.score_fn(i, j_choices[top])
+        self.scores[line_idx[top]] = fresh_scores.float()
+        return j_choices[top[fresh_scores.argmax()]].item()
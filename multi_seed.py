@@ -0,0 +1,140 @@
+"""
+Includes `run_seeds`, which generates the same canvas with several different seeds in a process pool (sharing the line
+table between processes rather than copying it), and returns the one with the lowest final residual
+"""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, fields
+
+import torch as t
+import torch.multiprocessing as mp
+from torch import Tensor
+
+from image_color import Img
+from line_table import LazyLineTable, LineTable
+
+t.classes.__path__ = []
+
+
+@dataclass
+class SeedRun:
+    seed: int
+    residual: float  # sum of every color's final residual (see `ResidualTracker`)
+    residuals: dict[tuple, float]
+    n_lines: int
+    elapsed_s: float
+
+
+@dataclass
+class MultiSeedResult:
+    best_seed: int
+    line_dict: dict[tuple, list[tuple[int, int]]]  # from the best seed
+    runs: list[SeedRun]  # one per seed, in the order they were given
+
+
+def _shared(tensor: Tensor) -> Tensor:
+    # We clone first, since tensors memory-mapped from the line cache (or created from numpy) can't be moved in place
+    return tensor if tensor.is_shared() else tensor.clone().share_memory_()
+
+
+def _share_fields_(obj) -> None:
+    for f in fields(obj):
+        value = getattr(obj, f.name)
+        if isinstance(value, Tensor):
+            setattr(obj, f.name, _shared(value))
+
+
+def share_memory_(img: Img) -> None:
+    """
+    Moves the things every run reads (but never writes) into shared memory: the line table (plus its pixel index),
+    the adjacency and the node coordinates. When `img` is sent to a worker process, torch then only sends a handle to
+    these tensors rather than a copy. Everything else (e.g. the mono images) is small, and gets copied.
+    """
+    args = img.args
+    assert not isinstance(args.line_table, LazyLineTable), "Multi-seed runs need line_store='table'"
+    _share_fields_(args.line_table)
+    if isinstance(args.line_table, LineTable) and args.line_table.pixel_index is not None:
+        _share_fields_(args.line_table.pixel_index)
+
+    # The numpy view is pickled by value, but it's only as big as the adjacency (much smaller than the line table)
+    args.d_joined.indices_torch = _shared(args.d_joined.indices_torch)
+    args.d_joined.indices = args.d_joined.indices_torch.numpy()
+
+    # Stack the coordinates so they're a single shared tensor (rather than one per node)
+    coords = _shared(t.stack([args.d_coords[i] for i in range(len(args.d_coords))]))
+    args.d_coords = {i: coords[i] for i in range(coords.size(0))}
+
+    # Sparse tensors can't be shared, so each worker builds its own incidence matrix if it needs one
+    img.incidence = None
+
+
+def _run_seed(img: Img, seed: int) -> tuple[dict[tuple, list[tuple[int, int]]], SeedRun]:
+    t0 = time.time()
+    img.args.seed = seed
+    img.args.track_residual = True
+    img.residual_curves = {}
+    line_dict = dict(img.create_canvas())
+    residuals = {color_tuple: curve[-1] for color_tuple, curve in img.residual_curves.items()}
+    run = SeedRun(
+        seed=seed,
+        residual=sum(residuals.values()),
+        residuals=residuals,
+        n_lines=sum(len(lines) for lines in line_dict.values()),
+        elapsed_s=time.time() - t0,
+    )
+    return line_dict, run
+
+
+# Each worker process gets its own copy of the `Img` once (via the pool initializer), rather than once per seed
+_WORKER_IMG: Img | None = None
+
+
+def _init_worker(img: Img, n_threads: int) -> None:
+    global _WORKER_IMG
+    _WORKER_IMG = img
+    t.set_num_threads(n_threads)
+
+
+def _run_seed_in_worker(seed: int) -> tuple[dict[tuple, list[tuple[int, int]]], SeedRun]:
+    return _run_seed(_WORKER_IMG, seed)
+
+
+def run_seeds(img: Img, seeds: list[int], n_workers: int | None = None) -> MultiSeedResult:
+    """
+    Runs `img.create_canvas()` once per seed, and returns the `line_dict` with the lowest final residual (summed over
+    colors), plus the metrics for every seed. The runs are independent, so we spread them over `n_workers` processes
+    (default: one per seed, up to the number of CPUs), splitting the CPUs between them for torch's intra-op threads.
+    With `n_workers=1` we just run them one after another in this process.
+    """
+    assert len(seeds) > 0, "Need at least one seed"
+    assert img.args.checkpoint_path is None, "Multi-seed runs would all write to the same checkpoint_path"
+    n_workers = n_workers or min(len(seeds), os.cpu_count() or 1)
+    t0 = time.time()
+
+    if n_workers == 1:
+        original_seed, track_residual = img.args.seed, img.args.track_residual
+        try:
+            results = [_run_seed(img, seed) for seed in seeds]
+        finally:
+            img.args.seed, img.args.track_residual = original_seed, track_residual
+    else:
+        share_memory_(img)
+        n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+        # We spawn rather than fork, since forking a process which has already started torch's thread pools can hang
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(img, n_threads),
+        ) as executor:
+            results = list(executor.map(_run_seed_in_worker, seeds))
+
+    runs = [run for _, run in results]
+    best_idx = min(range(len(runs)), key=lambda idx: runs[idx].residual)
+    for run in runs:
+        print(f"Seed {run.seed:>6}: residual = {run.residual:.2f}, {run.n_lines} lines in {run.elapsed_s:.1f} seconds")
+    print(f"Best seed is {runs[best_idx].seed}, ran {len(seeds)} seeds in {time.time() - t0:.2f} seconds")
+
+    return MultiSeedResult(best_seed=runs[best_idx].seed, line_dict=results[best_idx][0], runs=runs)
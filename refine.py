@@ -0,0 +1,246 @@
+"""
+Includes `refine_line_dict`, a local search which improves a finished `line_dict` after the greedy loop (which never
+revisits a decision), while keeping every color a continuous thread path
+"""
+
+import time
+
+import numpy as np
+import torch as t
+from jaxtyping import Float
+from torch import Tensor
+
+from image_color import Img, blur_image
+from residual import ResidualTracker
+
+t.classes.__path__ = []
+
+
+class LineRefiner:
+    """
+    Local search over a single color's sequence of lines, against that color's residual image (the blurred mono image
+    minus every line). There are 2 moves:
+
+        - replace: for lines a→b then b'→c (where b' is the node after b, i.e. b or its pair if `flip_hook_parity`), try
+          every other intermediate node x instead, giving a→x then x'→c
+        - relocate: remove the node b from the path (a→b, b'→c becomes a→c), then re-insert a node elsewhere by
+          splitting some other line d→e into d→x, x'→e (so the number of lines stays the same)
+
+    Every line we create must be in `d_joined`, so the `critical_fracs` restrictions still hold, and we only ever
+    change nodes which follow from the previous line (lines which start with a random jump, see `n_consecutive`, keep
+    their starting node). We only accept moves which reduce the residual (see `ResidualTracker`), which we evaluate
+    incrementally from the pixels of the lines involved.
+    """
+
+    def __init__(
+        self,
+        img: Img,
+        lines: list[tuple[int, int]],
+        m_image: Float[Tensor, "y x"],
+        darkness: float,
+        rng: np.random.Generator,
+        n_insert_positions: int = 16,
+    ):
+        args = img.args
+        self.img = img
+        self.darkness = darkness
+        self.rng = rng
+        self.n_insert_positions = n_insert_positions
+        self.flip_hook_parity = args.flip_hook_parity
+        self.m_flat = m_image.reshape(-1).double()  # has all of `lines` subtracted already
+        self.n_pixels = self.m_flat.numel()
+        self.w_flat = None if img.w is None else img.w.reshape(-1).double()
+        self.residual = ResidualTracker(m_image, img.w)
+
+        # Dense (n_nodes x n_nodes) version of `d_joined`, so we can check lots of pairs at once
+        d_joined = args.d_joined
+        self.joined = np.zeros((d_joined.n_nodes, d_joined.n_nodes), dtype=bool)
+        self.joined[np.repeat(np.arange(d_joined.n_nodes), d_joined.degrees), d_joined.indices] = True
+
+        # `linked[n]` means line n has to start from the node after line n - 1's end
+        self.lines = [(int(i), int(j)) for i, j in lines]
+        self.linked = [n > 0 and self.lines[n][0] == self.next_node(self.lines[n - 1][1]) for n in range(len(lines))]
+
+        self.n_replaced = 0
+        self.n_relocated = 0
+        self.n_attempts = 0
+
+    def next_node(self, j):
+        # Same as `Img.get_next_node` (without the random jumps), works for ints and arrays
+        return j ^ 1 if self.flip_hook_parity else j
+
+    def apply(self, lines: list[tuple[int, int]], sign: float = 1.0) -> None:
+        """Subtracts `lines` from the residual image (or adds them back, if `sign = -1`)."""
+        if len(lines) == 0:
+            return
+        _, pixels, amounts = self.img.get_line_amounts(lines, self.darkness, self.n_pixels)
+        changed_pixels, inverse = t.unique(pixels, return_inverse=True)
+        totals = t.zeros(changed_pixels.size(0), dtype=t.float64).index_add_(0, inverse, amounts.double())
+        old_values = self.m_flat[changed_pixels]
+        self.m_flat[changed_pixels] = old_values - sign * totals
+        self.residual.update(changed_pixels, old_values, self.m_flat[changed_pixels])
+
+    def evaluate(self, groups: list[list[tuple[int, int]]]) -> Float[Tensor, "n_groups"]:
+        """Returns how much the residual would change if we subtracted each group of lines (on its own)."""
+        lines = [line for group in groups for line in group]
+        group_ids = t.tensor([g for g, group in enumerate(groups) for _ in group], dtype=t.int64)
+        occurrence_ids, pixels, amounts = self.img.get_line_amounts(lines, self.darkness, self.n_pixels)
+
+        # Total amount each group subtracts from each pixel (a group's lines can overlap)
+        keys = group_ids[occurrence_ids] * self.n_pixels + pixels
+        unique_keys, inverse = t.unique(keys, return_inverse=True)
+        totals = t.zeros(unique_keys.size(0), dtype=t.float64).index_add_(0, inverse, amounts.double())
+        unique_pixels = unique_keys % self.n_pixels
+
+        old_values = self.m_flat[unique_pixels]
+        costs = (old_values - totals).abs() - old_values.abs()
+        if self.w_flat is not None:
+            costs = costs * self.w_flat[unique_pixels]
+        return t.zeros(len(groups), dtype=t.float64).index_add_(0, unique_keys // self.n_pixels, costs)
+
+    def split_candidates(self, i: int, k: int | None) -> np.ndarray:
+        """Nodes x such that i→x is a line, and (if `k` isn't None) x'→k is a line too."""
+        xs = np.flatnonzero(self.joined[i])
+        if k is not None:
+            xs = xs[self.joined[self.next_node(xs), k]]
+        return xs
+
+    def try_replace(self, n: int) -> bool:
+        """Tries a better intermediate node for the end of line n (see the class docstring)."""
+        i, j = self.lines[n]
+        next_linked = n + 1 < len(self.lines) and self.linked[n + 1]
+        k = self.lines[n + 1][1] if next_linked else None
+        xs = self.split_candidates(i, k)
+        if len(xs) <= 1:
+            return False
+
+        old_lines = [(i, j), (self.next_node(j), k)] if next_linked else [(i, j)]
+        residual_before = self.residual.total
+        self.apply(old_lines, sign=-1.0)
+        groups = [[(i, x), (self.next_node(x), k)] if next_linked else [(i, x)] for x in xs.tolist()]
+        deltas = self.evaluate(groups)
+        best = int(deltas.argmin())
+        improved = self.residual.total + deltas[best].item() < residual_before - 1e-9 * max(residual_before, 1.0)
+        new_lines = groups[best] if improved else old_lines
+        self.apply(new_lines)
+
+        if improved:
+            self.lines[n : n + len(new_lines)] = new_lines
+            self.n_replaced += 1
+        return improved
+
+    def try_relocate(self, n: int) -> bool:
+        """Tries removing the end node of line n, and re-inserting a node somewhere else (see the class docstring)."""
+        if len(self.lines) < 3:
+            return False
+        lines, linked = list(self.lines), list(self.linked)
+        residual_before = self.residual.total
+
+        # Remove the node (merging lines n & n + 1 if they're linked, otherwise just removing line n)
+        i, j = lines[n]
+        if n + 1 < len(lines) and linked[n + 1]:
+            k = lines[n + 1][1]
+            if not self.joined[i, k]:
+                return False
+            removed, added = [(i, j), lines[n + 1]], [(i, k)]
+            lines[n : n + 2] = added
+            linked[n : n + 2] = [linked[n]]
+        else:
+            removed, added = [(i, j)], []
+            del lines[n], linked[n]
+        self.apply(removed, sign=-1.0)
+        self.apply(added)
+
+        # Find the best place to split a line (d, e) into (d, x), (x', e), out of a few random ones
+        best = None  # (residual after, position, new lines)
+        for m in self.rng.choice(len(lines), min(self.n_insert_positions, len(lines)), replace=False).tolist():
+            d, e = lines[m]
+            xs = self.split_candidates(d, e)
+            if len(xs) == 0:
+                continue
+            self.apply([(d, e)], sign=-1.0)
+            groups = [[(d, x), (self.next_node(x), e)] for x in xs.tolist()]
+            deltas = self.evaluate(groups)
+            idx = int(deltas.argmin())
+            residual_after = self.residual.total + deltas[idx].item()
+            self.apply([(d, e)])
+            if best is None or residual_after < best[0]:
+                best = (residual_after, m, groups[idx])
+
+        if best is not None and best[0] < residual_before - 1e-9 * max(residual_before, 1.0):
+            _, m, new_lines = best
+            self.apply([lines[m]], sign=-1.0)
+            self.apply(new_lines)
+            lines[m : m + 1] = new_lines
+            linked[m : m + 1] = [linked[m], True]
+            self.lines, self.linked = lines, linked
+            self.n_relocated += 1
+            return True
+
+        # No improvement, so undo the removal
+        self.apply(added, sign=-1.0)
+        self.apply(removed)
+        return False
+
+    def refine(self, deadline: float, relocate_frac: float = 0.3) -> None:
+        """
+        Tries random moves until `deadline` (a `time.time()` value), or until we've failed as many times in a row as
+        there are lines (at which point we're probably at a local optimum).
+        """
+        n_failures = 0
+        while time.time() < deadline and n_failures < len(self.lines):
+            self.n_attempts += 1
+            n = self.rng.integers(len(self.lines))
+            move = self.try_relocate if self.rng.random() < relocate_frac else self.try_replace
+            if move(n):
+                self.residual.record()
+                n_failures = 0
+            else:
+                n_failures += 1
+
+
+def refine_line_dict(
+    img: Img,
+    line_dict: dict[tuple, list[tuple[int, int]]],
+    time_budget_s: float = 10.0,
+    seed: int | None = None,
+    relocate_frac: float = 0.3,
+    n_insert_positions: int = 16,
+) -> tuple[dict[tuple, list[tuple[int, int]]], dict[tuple, dict]]:
+    """
+    Runs `LineRefiner` on every color of `line_dict` (e.g. from `img.create_canvas()`), giving each color a share of
+    `time_budget_s` proportional to its number of lines. Returns the refined `line_dict` (each color has the same
+    number of lines as before), and a report for each color (residual before & after, and how many moves we made).
+    """
+    t0 = time.time()
+    rng = np.random.default_rng(img.args.seed if seed is None else seed)
+    darkness = img.args.darkness if isinstance(img.args.darkness, list) else [img.args.darkness] * len(img.args.palette)
+    colors = [color_tuple for color_tuple in img.args.palette if len(line_dict.get(color_tuple, [])) > 0]
+    assert set(map(tuple, line_dict)) <= set(map(tuple, img.args.palette)), "Colors in `line_dict` aren't in palette"
+
+    refined, report = dict(line_dict), {}
+    for idx, color_tuple in enumerate(colors):
+        lines = line_dict[color_tuple]
+        m_image = blur_image(img.mono_images_dict[color_tuple], img.args.blur_rad).contiguous().double()
+        color_darkness = darkness[img.args.palette.index(color_tuple)]
+        img.subtract_lines(m_image, lines, color_darkness)
+
+        # Each color gets its share (by number of lines) of whatever time is left
+        remaining_lines = sum(len(line_dict[c]) for c in colors[idx:])
+        remaining_time = t0 + time_budget_s - time.time()
+        deadline = time.time() + remaining_time * len(lines) / remaining_lines
+
+        refiner = LineRefiner(img, lines, m_image, color_darkness, rng, n_insert_positions)
+        refiner.refine(deadline, relocate_frac)
+        refined[color_tuple] = refiner.lines
+        report[color_tuple] = dict(
+            residual_before=refiner.residual.history[0],
+            residual_after=refiner.residual.total,
+            n_attempts=refiner.n_attempts,
+            n_replaced=refiner.n_replaced,
+            n_relocated=refiner.n_relocated,
+        )
+        print(f"Refined {color_tuple}: {report[color_tuple]}")
+
+    print(f"Refined lines in {time.time() - t0:.2f} seconds")
+    return refined, report
@@ -0,0 +1,69 @@
+"""
+Includes the `ResidualTracker` class, which keeps track of how far a monochrome image is from being fully drawn (so we
+can plot convergence, and stop drawing a color once more lines stop helping)
+"""
+
+import torch as t
+from jaxtyping import Float, Int
+from torch import Tensor
+
+t.classes.__path__ = []
+
+
+class ResidualTracker:
+    """
+    Tracks the residual objective of a monochrome image as we subtract lines from it. The residual is the positive mass
+    (darkness we still haven't drawn) plus the negative mass (places we've drawn too much), each weighted by the
+    importance weighting `w` if there is one. Subtracting a line only changes the pixels it covers, so we update both
+    sums from those pixels' old & new values rather than re-summing the whole image.
+
+    `history[n]` is the residual after `n` lines (so `history[0]` is the residual of the untouched image). When resuming
+    partway through, pass the `history` so far, so that `has_converged` looks at the same numbers as it would have
+    without the interruption.
+    """
+
+    def __init__(
+        self,
+        m_image: Float[Tensor, "y x"],
+        w: Float[Tensor, "y x"] | None = None,
+        history: list[float] | None = None,
+    ):
+        self.w_flat = None if w is None else w.reshape(-1).double()
+        values = m_image.reshape(-1).double()
+        weights = 1.0 if self.w_flat is None else self.w_flat
+        self.positive = float((values.clamp(min=0.0) * weights).sum())
+        self.negative = float(((-values).clamp(min=0.0) * weights).sum())
+        self.history = [self.total] if history is None else list(history)
+
+    @property
+    def total(self) -> float:
+        return self.positive + self.negative
+
+    def update(
+        self,
+        pixels: Int[Tensor, "n_changed"],
+        old_values: Float[Tensor, "n_changed"],
+        new_values: Float[Tensor, "n_changed"],
+    ) -> None:
+        """
+        Updates the sums after the image values at `pixels` (which should be unique) changed from `old_values` to
+        `new_values`.
+        """
+        old_values, new_values = old_values.double(), new_values.double()
+        weights = 1.0 if self.w_flat is None else self.w_flat[pixels]
+        self.positive += float(((new_values.clamp(min=0.0) - old_values.clamp(min=0.0)) * weights).sum())
+        self.negative += float((((-new_values).clamp(min=0.0) - (-old_values).clamp(min=0.0)) * weights).sum())
+
+    def record(self) -> None:
+        """Adds the current residual to `history` (call this once per line)."""
+        self.history.append(self.total)
+
+    def has_converged(self, window: int, tol: float) -> bool:
+        """
+        Returns True if the last `window` lines improved the residual by less than `tol` (as a fraction of the starting
+        residual), i.e. more lines of this color have stopped helping.
+        """
+        if window <= 0 or len(self.history) <= window:
+            return False
+        improvement = self.history[-window - 1] - self.history[-1]
+        return improvement < tol * max(self.history[0], 1e-12)